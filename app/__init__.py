@@ -14,6 +14,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_moment import Moment
 from raven.contrib.flask import Sentry
 from redis import Redis
+from app.compression import Compress
 
 
 # Import config object [which is itself a dict of config objects] from config package
@@ -34,6 +35,7 @@ login_manager.login_message_category = 'info'
 sentry = Sentry()
 ma = Marshmallow()
 moment = Moment()
+compress = Compress()
 
 default_redis_url = 'redis://localhost:6379'
 redis = Redis.from_url(url=os.environ.get('REDIS_URL', default_redis_url))
@@ -69,6 +71,7 @@ def create_app(config_name):
     Principal(app, use_sessions=True)
     ma.init_app(app)
     moment.init_app(app)
+    compress.init_app(app)
     if app.config.get('SERVER_SESSION'):
         Session(app)
 
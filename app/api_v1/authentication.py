@@ -1,4 +1,5 @@
-from flask import g, jsonify, url_for, current_app
+from flask import g, url_for, current_app
+from app.utils.json_backend import jsonify
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from flask_principal import Identity, identity_changed
 from app import db
@@ -22,6 +22,12 @@ class BadRequestError(APIError):
     pass
 
 
+class SearchCostError(APIError):
+    """Raised when a search is rejected because it is expected to be, or was, too costly to run.  Subclass of
+    APIError"""
+    pass
+
+
 class RateLimitError(APIError):
     """Base error for Rate Limit exceptions.  Subclass of APIError"""
     pass
@@ -55,3 +61,13 @@ class BasicAuthError(AuthenticationError):
 class ForbiddenError(AuthenticationError):
     """Forbidden authentication related error.  Subclass of AuthenticationError"""
     pass
+
+
+class BundleEntryError(APIError):
+    """Raised when an entry of a batch or transaction Bundle can not be processed.  Keeps the HTTP status and the
+    OperationOutcome issue type of the entry's response.  Subclass of APIError"""
+
+    def __init__(self, message, status_code=400, issue_type='invalid'):
+        super(BundleEntryError, self).__init__(message)
+        self.status_code = status_code
+        self.issue_type = issue_type
@@ -1,6 +1,9 @@
 from app.api_v1 import api_bp
 from app.api_v1.errors.exceptions import *
-from flask import jsonify, url_for
+from flask import url_for
+from app.utils.json_backend import jsonify
+from sqlalchemy.exc import OperationalError
+from app import db
 from app.api_v1.utils.operation_outcome import create_operation_outcome
 from werkzeug.http import HTTP_STATUS_CODES
 
@@ -125,6 +128,8 @@ def not_modified_handler(e):
     response = fhir_error_response(status_code=304, outcome_list=[
         {'severity': 'error', 'type': 'business-rule',
          'diagnostics': str(e), 'details': 'The requested resource was not modified'}])
+    # Validators of the unchanged representation, set by @etag
+    response.headers.extend(getattr(e, 'headers', {}))
     return response
 
 
@@ -146,3 +151,35 @@ def not_modified_handler(e):
         {'severity': 'fatal', 'type': 'business-rule',
          'diagnostics': error_text, 'details': 'Bad Request - Validation of input failed: {}'.format(error_text)}])
     return response
+
+
+@api_bp.errorhandler(SearchCostError)
+def search_cost_error_handler(e):
+    response = fhir_error_response(status_code=422, outcome_list=[
+        {'severity': 'error', 'type': 'too-costly',
+         'diagnostics': str(e.args[0]), 'details': 'The search was rejected as too costly: {}'.format(str(e.args[0]))}])
+    return response
+
+
+@api_bp.errorhandler(OperationalError)
+def statement_timeout_handler(e):
+    # 57014 query_canceled is raised when a statement runs longer than the statement_timeout set for the search
+    if getattr(e.orig, 'pgcode', None) != '57014':
+        return internal_server_error_handler(e)
+    db.session.rollback()
+    response = fhir_error_response(status_code=422, outcome_list=[
+        {'severity': 'error', 'type': 'too-costly',
+         'diagnostics': str(e.orig).strip(),
+         'details': 'The search was cancelled because it ran longer than the statement timeout for the resource.  '
+                    'Use more selective parameters or request a smaller _count.'}])
+    return response
+
+
+@api_bp.errorhandler(BundleEntryError)
+def bundle_entry_error_handler(e):
+    # A failed entry of a transaction Bundle rolls back the whole transaction
+    db.session.rollback()
+    response = fhir_error_response(status_code=e.status_code, outcome_list=[
+        {'severity': 'error', 'type': e.issue_type,
+         'diagnostics': str(e.args[0]), 'details': 'The transaction failed: {}'.format(str(e.args[0]))}])
+    return response
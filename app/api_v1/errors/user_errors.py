@@ -1,4 +1,4 @@
-from flask import jsonify
+from app.utils.json_backend import jsonify
 from app.api_v1 import api_bp
 
 
@@ -1,6 +1,9 @@
-from flask import jsonify, url_for
+from flask import url_for
+from app.utils.json_backend import jsonify
 from app.api_v1 import api_bp
+from app.api_v1.authentication import token_auth
 from app.api_v1.utils.etag import etag
+from app.api_v1.utils.search_cache import SearchResultCache
 
 
 @api_bp.route('/', methods=['GET'])
@@ -10,10 +13,22 @@ def index():
         {'resources': {'fhir': {'CodeSystem': url_for('api_v1.get_codesystems',
                                                       _external=True),
                                 'ValueSet': url_for('api_v1.get_valuesets', _external=True),
-                                'Patient': url_for('api_v1.patient_search', _external=True)},
+                                'Patient': url_for('api_v1.patient_search', _external=True),
+                                'Organization': url_for('api_v1.organization_search', _external=True)},
                        'unkani': {'User': url_for('api_v1.get_users', _external=True)}},
          'authentication': url_for('api_v1.new_token', _external=True)
          }
     )
     response.status_code = 200
     return response
+
+
+@api_bp.route('/search_cache', methods=['GET'])
+@token_auth.login_required
+def search_cache_stats():
+    """
+    Return the hit, miss, invalidation and eviction counters of each resource's search result cache
+    """
+    response = jsonify({resource: cache.stats() for resource, cache in SearchResultCache.registry.items()})
+    response.status_code = 200
+    return response
@@ -8,6 +8,8 @@ def before_request():  # pragma: no cover
 
 @api_bp.after_request
 def apply_default_response_headers(response):
-    response.headers['Content-Type'] = 'application/fhir+json'
+    # Bulk data files keep their NDJSON content type
+    if response.mimetype != 'application/fhir+ndjson':
+        response.headers['Content-Type'] = 'application/fhir+json'
     response.headers['Charset'] = 'UTF-8'
     return response
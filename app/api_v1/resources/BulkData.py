@@ -0,0 +1,147 @@
+import os
+from flask import request, url_for, current_app, abort, send_from_directory, g
+
+from app.api_v1.authentication import token_auth
+from app.api_v1.errors.user_errors import *
+from app.api_v1.errors.exceptions import ForbiddenError, ValidationError
+from app.api_v1.errors.fhir_errors import fhir_error_response
+from app.api_v1.utils.rate_limit import rate_limit
+from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.api_v1.utils.bulk_export import BulkExport, EXPORT_FORMATS, parse_export_types, parse_export_since
+from app.api_v1.utils.bulk_import import PatientImport, IMPORT_FORMATS
+from app.security import app_permission_patientadmin
+
+
+##############################################################
+# FHIR Bulk Data $export, with the asynchronous request pattern
+##############################################################
+def export_kickoff(level):
+    """
+    Validate an $export kick-off request and queue the export
+    :param level:
+        'system' or 'patient'
+    :return:
+        202 response whose Content-Location header is the URL of the export's status endpoint
+    """
+    if not app_permission_patientadmin.can():
+        raise ForbiddenError('Insufficient permissions to export patient data')
+    if 'respond-async' not in request.headers.get('Prefer', ''):
+        raise ValidationError('The Prefer header of an $export request must be respond-async')
+    output_format = request.args.get('_outputFormat')
+    if output_format is not None and output_format not in EXPORT_FORMATS:
+        raise ValidationError('The value supplied for the _outputFormat parameter must be one of: {}'.format(
+            ', '.join(EXPORT_FORMATS)))
+
+    export = BulkExport.start(level=level, types=parse_export_types(value=request.args.get('_type'), level=level),
+                              since=parse_export_since(value=request.args.get('_since')), request_url=request.url,
+                              base_url=request.host_url, user_id=g.current_user.id)
+    response = current_app.response_class(status=202)
+    response.headers['Content-Location'] = url_for('api_v1.export_status', export_id=export.id, _external=True)
+    return response
+
+
+def load_requested_export(export_id):
+    """
+    Load the export of a status, cancel or file request.  Only the user who requested an export can see it.
+    :return:
+        BulkExport.  ForbiddenError is raised when the user is not a patient admin, and a 404 is returned when the
+        export does not exist, was cancelled, or was requested by another user.
+    """
+    if not app_permission_patientadmin.can():
+        raise ForbiddenError('Insufficient permissions to export patient data')
+    export = BulkExport.load(export_id)
+    if export is None or export.status == BulkExport.CANCELLED or export.user_id != g.current_user.id:
+        abort(404)
+    return export
+
+
+@api_bp.route('/fhir/$export', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+def system_export():
+    """
+    Export every supported resource as NDJSON files
+    """
+    return export_kickoff(level='system')
+
+
+@api_bp.route('/fhir/Patient/$export', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+def patient_export():
+    """
+    Export the resources of every patient as NDJSON files
+    """
+    return export_kickoff(level='patient')
+
+
+@api_bp.route('/fhir/$export-status/<export_id>', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+def export_status(export_id):
+    """
+    Report the progress of an export:  202 with an X-Progress header while it runs, the completion manifest once it
+    completed, and 500 with an OperationOutcome when it failed
+    """
+    export = load_requested_export(export_id)
+    if export.status == BulkExport.ERROR:
+        return fhir_error_response(status_code=500, outcome_list=[
+            {'severity': 'error', 'type': 'exception',
+             'diagnostics': export.error, 'details': 'The export failed: {}'.format(export.error)}])
+    if export.status != BulkExport.COMPLETED:
+        response = current_app.response_class(status=202)
+        response.headers['X-Progress'] = export.progress_message()
+        response.headers['Retry-After'] = str(current_app.config.get('BULK_EXPORT_RETRY_AFTER', 10))
+        return response
+
+    response = jsonify(export.manifest(file_url=lambda export_id, filename: url_for(
+        'api_v1.export_file', export_id=export_id, filename=filename, _external=True)))
+    response.status_code = 200
+    return response
+
+
+@api_bp.route('/fhir/$export-status/<export_id>', methods=['DELETE'])
+@token_auth.login_required
+def export_cancel(export_id):
+    """
+    Cancel an export, or delete the files of a completed export
+    """
+    export = load_requested_export(export_id)
+    export.cancel()
+    return current_app.response_class(status=202)
+
+
+@api_bp.route('/fhir/$export-file/<export_id>/<filename>', methods=['GET'])
+@token_auth.login_required
+def export_file(export_id, filename):
+    """
+    Download an NDJSON file of a completed export
+    """
+    export = load_requested_export(export_id)
+    if export.status != BulkExport.COMPLETED or filename not in [o['file'] for o in export.output]:
+        abort(404)
+    return send_from_directory(os.path.abspath(export.directory), filename, mimetype='application/fhir+ndjson')
+
+
+##############################################################
+# Bulk $import of NDJSON Patient resources
+##############################################################
+@api_bp.route('/fhir/Patient/$import', methods=['POST'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+def patient_import():
+    """
+    Load the NDJSON Patient resources of the request body, see PatientImport.  The body is read line by line, so it
+    is never held in memory as a whole.
+    :return:
+        OperationOutcome with the number of imported, skipped and rejected resources and the errors of rejected lines
+    """
+    if not app_permission_patientadmin.can():
+        raise ForbiddenError('Insufficient permissions to import patient data')
+    if request.mimetype not in IMPORT_FORMATS:
+        raise ValidationError('The Content-Type of an $import request must be one of: {}'.format(
+            ', '.join(IMPORT_FORMATS)))
+    patient_import = PatientImport().run(request.stream)
+    return fhir_error_response(status_code=200, outcome_list=patient_import.outcome_list())
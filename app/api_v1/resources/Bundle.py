@@ -0,0 +1,33 @@
+from flask import request
+
+from app.api_v1.authentication import token_auth
+from app.api_v1.errors.user_errors import *
+from app.api_v1.errors.exceptions import ForbiddenError, ValidationError
+from app.api_v1.utils.rate_limit import rate_limit
+from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.api_v1.utils.bundle_transaction import BundleTransaction
+from app.security import app_permission_patientadmin
+
+
+##############################################################
+# FHIR batch and transaction interactions
+##############################################################
+@api_bp.route('/fhir', methods=['POST'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+def fhir_bundle():
+    """
+    Process a batch or transaction Bundle, see BundleTransaction
+    :return:
+        The batch-response or transaction-response Bundle
+    """
+    bundle = request.get_json(silent=True)
+    if bundle is None:
+        raise ValidationError('The request body must be a FHIR Bundle')
+    transaction = BundleTransaction(bundle)
+    if transaction.writes and not app_permission_patientadmin.can():
+        raise ForbiddenError('Insufficient permissions to write patient data')
+    response = jsonify(transaction.run())
+    response.status_code = 200
+    return response
@@ -1,9 +1,12 @@
 from app.api_v1.authentication import token_auth
 from app.api_v1.errors.user_errors import *
+from app.api_v1.errors.exceptions import ValidationError
 from app.api_v1.utils.rate_limit import rate_limit
 from app.api_v1.utils.etag import etag
-from app.models.fhir.codesets import CodeSystem
-from flask import url_for
+from app.models.fhir.codesets import CodeSystem, CodeSystemConcept, ConceptClosure
+from app import db
+from flask import request, url_for
+from sqlalchemy import tuple_
 
 
 @api_bp.route('/fhir/CodeSystem/<string:resource_id>', methods=['GET'])
@@ -29,4 +32,96 @@ def get_codesystems():
     """
     Return FHIR CodeSystem resources as JSON.
     """
-    return jsonify('Coming Soon!')
\ No newline at end of file
+    return jsonify('Coming Soon!')
+
+
+def get_codesystem_or_404(resource_id=None):
+    """
+    The CodeSystem of an operation:  the CodeSystem with the resource id for instance level requests, otherwise the
+    CodeSystem whose url is the system parameter
+    """
+    if resource_id is not None:
+        return CodeSystem.query.filter(CodeSystem.resource_id == resource_id).first_or_404()
+    system = request.args.get('system')
+    if not system:
+        raise ValidationError('The system parameter is required by CodeSystem operations on the type')
+    return CodeSystem.query.filter(CodeSystem.url == system).order_by(CodeSystem.id).first_or_404()
+
+
+def get_required_arg(name):
+    value = request.args.get(name)
+    if not value:
+        raise ValidationError('The {} parameter is required by this operation'.format(name))
+    return value
+
+
+@api_bp.route('/fhir/CodeSystem/$lookup', methods=['GET'])
+@api_bp.route('/fhir/CodeSystem/<string:resource_id>/$lookup', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+@etag
+def codesystem_lookup(resource_id=None):
+    """
+    Return a FHIR Parameters resource as JSON with the details of a code of a CodeSystem:  its display, definition,
+    parent and children.  The concept is found by primary key in the flattened concept index.
+    """
+    codesystem = get_codesystem_or_404(resource_id)
+    code = get_required_arg('code')
+    concept = CodeSystemConcept.query.get_or_404((codesystem.id, code))
+    children = db.session.query(ConceptClosure.descendant_code) \
+        .filter(ConceptClosure.codesystem_id == codesystem.id, ConceptClosure.ancestor_code == code,
+                ConceptClosure.depth == 1).order_by(ConceptClosure.descendant_code).all()
+
+    parameters = [{'name': 'name', 'valueString': codesystem.data.get('name') or codesystem.resource_id}]
+    if codesystem.version:
+        parameters.append({'name': 'version', 'valueString': codesystem.version})
+    if concept.display:
+        parameters.append({'name': 'display', 'valueString': concept.display})
+    if concept.definition:
+        parameters.append({'name': 'definition', 'valueString': concept.definition})
+    related = [('parent', concept.parent_code)] if concept.parent_code else []
+    related.extend(('child', child) for child, in children)
+    for property_code, value in related:
+        parameters.append({'name': 'property', 'part': [{'name': 'code', 'valueCode': property_code},
+                                                        {'name': 'value', 'valueCode': value}]})
+    response = jsonify({'resourceType': 'Parameters', 'parameter': parameters})
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response.status_code = 200
+    return response
+
+
+@api_bp.route('/fhir/CodeSystem/$subsumes', methods=['GET'])
+@api_bp.route('/fhir/CodeSystem/<string:resource_id>/$subsumes', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+@etag
+def codesystem_subsumes(resource_id=None):
+    """
+    Return a FHIR Parameters resource as JSON whose outcome parameter tells how codeA relates to codeB in the concept
+    hierarchy of a CodeSystem:  equivalent, subsumes, subsumed-by or not-subsumed.
+    """
+    codesystem = get_codesystem_or_404(resource_id)
+    code_a = get_required_arg('codeA')
+    code_b = get_required_arg('codeB')
+
+    # One lookup of the closure finds both codes (their rows of depth 0) and any subsumption between them
+    pairs = set(db.session.query(ConceptClosure.ancestor_code, ConceptClosure.descendant_code).filter(
+        ConceptClosure.codesystem_id == codesystem.id,
+        tuple_(ConceptClosure.ancestor_code, ConceptClosure.descendant_code).in_(
+            [(code_a, code_a), (code_b, code_b), (code_a, code_b), (code_b, code_a)])).all())
+    for code in [code_a, code_b]:
+        if (code, code) not in pairs:
+            raise ValidationError('The code {} is not in the CodeSystem {}'.format(code, codesystem.url))
+
+    if code_a == code_b:
+        outcome = 'equivalent'
+    elif (code_a, code_b) in pairs:
+        outcome = 'subsumes'
+    elif (code_b, code_a) in pairs:
+        outcome = 'subsumed-by'
+    else:
+        outcome = 'not-subsumed'
+    response = jsonify({'resourceType': 'Parameters', 'parameter': [{'name': 'outcome', 'valueCode': outcome}]})
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response.status_code = 200
+    return response
@@ -0,0 +1,92 @@
+from flask import url_for
+
+from app.api_v1.authentication import token_auth
+from app.api_v1.errors.user_errors import *
+from app.api_v1.utils.rate_limit import rate_limit
+from app.api_v1.utils.etag import etag
+from app.api_v1.utils.bundle import create_bundle
+from app.api_v1.utils.search import SearchSupport
+from app.api_v1.utils.cost_guard import guard_search
+from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.security import role_permission_superadmin
+from app.models.fhir.organization import Organization
+
+##############################################################
+# Declare FHIR Search Parameters Supported
+##############################################################
+organization_model_support = {'name': {'modifier': ['exact', 'contains', 'missing'],
+                                       'prefix': [],
+                                       'model': Organization,
+                                       'column': ['name'],
+                                       'type': 'string'},
+                              'type': {'modifier': ['exact', 'missing', 'below', 'above'],
+                                       'prefix': [],
+                                       'model': Organization,
+                                       'column': {'http://hl7.org/fhir/organization-type': 'type'},
+                                       'type': 'token'},
+                              'active': {'modifier': ['not'],
+                                         'prefix': [],
+                                         'model': Organization,
+                                         'column': ['active'],
+                                         'type': 'bool'}
+                              }
+
+# Built on first use by get_organization_search_support.  Compiled search plans are cached on the support object.
+organization_search_support = None
+
+
+def get_organization_search_support():
+    """
+    The SearchSupport of Organization searches, validated once, on the first search.
+
+    Chained searches go through Organization.partOf:  partof.name=X finds the children of organizations named X, and
+    _has:Organization:partof:name=X finds the parents of organizations named X.  Each compiles to one EXISTS subquery
+    on the indexed parent_id column.  Organization.parent is a backref, which only exists once the mappers are
+    configured, so it is looked up here instead of at import.
+    """
+    global organization_search_support
+    if organization_search_support is None:
+        chain_support = {'chain': {'partof': (Organization.parent, organization_model_support)},
+                         '_has': {'Organization:partof': (Organization.children, organization_model_support)}}
+        organization_search_support = SearchSupport(base=Organization, model_support=organization_model_support,
+                                                    chain_support=chain_support)
+    return organization_search_support
+
+
+@api_bp.route('/fhir/Organization/<int:id>', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+@etag
+def organization_read(id):
+    """
+    Return a FHIR STU 3.0 Organization resource as JSON.
+    """
+    org = Organization.query.get_or_404(ident=id)
+    data = org.dump_fhir_json()
+    response = jsonify(data)
+    response.headers['Location'] = url_for('api_v1.organization_read', id=org.id)
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response.status_code = 200
+    return response
+
+
+@api_bp.route('/fhir/Organization', methods=['GET'])
+@token_auth.login_required
+@enforce_fhir_mimetype_charset
+@rate_limit(limit=5, period=15)
+@etag
+def organization_search():
+    # Parse the request args and apply the search under the resource's cost controls.  Return un-executed query
+    query, plan, explain = guard_search(support=get_organization_search_support(), resource='Organization',
+                                        query=Organization.query, explain_permission=role_permission_superadmin)
+    if explain is not None:
+        return jsonify(explain)
+    # Pass the query to be executed to bundle/pagination utility
+    bundle = create_bundle(query=query, paginate=True, sort=plan.sort, includes=plan.includes,
+                           warnings=plan.warnings)
+
+    # Create the response from bundle JSON
+    response = jsonify(bundle.as_json())
+    response.status_code = 200
+    return response
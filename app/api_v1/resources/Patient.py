@@ -1,29 +1,169 @@
-from flask import request, url_for
+from flask import request, url_for, current_app, stream_with_context
 
 from app.api_v1.authentication import token_auth
 from app.api_v1.errors.user_errors import *
 from app.api_v1.utils.rate_limit import rate_limit
-from app.api_v1.utils.etag import etag
-from app.api_v1.utils.bundle import create_bundle
-from app.api_v1.utils.search import fhir_search
+from app.api_v1.utils.etag import etag, search_validator, weak_etag, Validator
+from app.api_v1.utils.bundle import create_bundle, stream_bundle, stream_bundle_requested
+from app.api_v1.utils.search import SearchSupport
+from app.api_v1.utils.cost_guard import guard_search, set_statement_timeout, check_search_cost
+from app.api_v1.utils.search_cache import SearchResultCache
 from app.api_v1.utils.requests import enforce_fhir_mimetype_charset
+from app.security import app_permission_patientadmin
 from app.models.fhir.patient import Patient
 from app.models.fhir.address import Address
 from app.models.fhir.email_address import EmailAddress
 from app.models.fhir.phone_number import PhoneNumber
+from app.models.fhir.patient_resource import patient_source_hash, patient_last_modified
+from app import db
+
+
+##############################################################
+# Declare FHIR Search Parameters Supported
+##############################################################
+patient_model_support = {'active': {'modifier': ['not'],
+                                    'prefix': [],
+                                    'model': Patient,
+                                    'column': ['active'],
+                                    'type': 'bool'},
+                         'deceased': {'modifier': ['not'],
+                                      'prefix': [],
+                                      'model': Patient,
+                                      'column': ['deceased'],
+                                      'type': 'bool'},
+                         'birthdate': {'modifier': [],
+                                       'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                                       'model': Patient,
+                                       'column': ['dob'],
+                                       'type': 'date'},
+                         'death-date': {'modifier': [],
+                                        'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                                        'model': Patient,
+                                        'column': ['deceased_date'],
+                                        'type': 'date'},
+                         'given': {'modifier': ['exact', 'contains', 'missing', 'text'],
+                                   'prefix': [],
+                                   'model': Patient,
+                                   'column': ['first_name', 'middle_name'],  # Will search both with or condition
+                                   'type': 'string'},
+                         'family': {'modifier': ['exact', 'contains', 'missing', 'text'],
+                                    'prefix': [],
+                                    'model': Patient,
+                                    'column': ['last_name'],
+                                    'type': 'string'},
+                         'name': {'modifier': ['exact', 'contains', 'missing', 'text'],
+                                  'prefix': [],
+                                  'model': Patient,
+                                  'column': ['last_name', 'first_name', 'middle_name', 'suffix', 'prefix'],
+                                  'type': 'string'},
+                         'gender': {'modifier': ['exact', 'contains', 'missing'],
+                                    'prefix': [],
+                                    'model': Patient,
+                                    'column': ['sex'],
+                                    'type': 'string'},
+                         'address-city': {'modifier': ['exact', 'contains', 'missing'],
+                                          'prefix': [],
+                                          'model': Address,
+                                          'column': ['city'],
+                                          'type': 'string'},
+                         'address-state': {'modifier': ['exact', 'contains', 'missing'],
+                                           'prefix': [],
+                                           'model': Address,
+                                           'column': ['state'],
+                                           'type': 'string'},
+                         'address-postalcode': {'modifier': ['exact', 'contains', 'missing'],
+                                                'prefix': [],
+                                                'model': Address,
+                                                'column': ['zipcode'],
+                                                'type': 'string'},
+                         'address-country': {'modifier': ['exact', 'contains', 'missing'],
+                                             'prefix': [],
+                                             'model': Address,
+                                             'column': ['country'],
+                                             'type': 'string'},
+                         'address': {'modifier': ['exact', 'contains', 'missing'],
+                                     'prefix': [],
+                                     'model': Address,
+                                     'column': ['address1', 'address2', 'city', 'state', 'zipcode', 'country'],
+                                     'type': 'string'},
+                         'email': {'modifier': ['exact', 'contains', 'missing'],
+                                   'prefix': [],
+                                   'model': EmailAddress,
+                                   'column': ['email'],
+                                   'type': 'string'},  # TODO validate email address w/ exact
+                         'phone': {'modifier': ['exact', 'contains', 'missing'],
+                                   'prefix': [],
+                                   'model': PhoneNumber,
+                                   'column': ['number'],
+                                   'type': 'string'},  # TODO validate phone w/ exact
+                         'language': {'modifier': ['exact', 'contains', 'missing'],
+                                      'prefix': [],
+                                      'model': Patient,
+                                      'column': ['preferred_language'],
+                                      'type': 'string'},
+                         'identifier': {'modifier': ['exact', 'contains'],  # TODO: Support missing
+                                        'prefix': [],
+                                        'model': Patient,
+                                        'column': {'http://unkani.com': 'uuid',
+                                                   'http://hl7.org/fhir/sid/us-ssn': 'ssn'},
+                                        'type': 'token'}  # TODO:  Validate SSN - match without hyphens
+                         }
+
+# Related objects that may be added to a search with _include / _revinclude.  Patient has no outgoing references to
+# _include.  Address and ContactPoint rows reference the patient, but they are data types, not resources, so they
+# can not be bundle entries:  their _revinclude values add a warning pointing to the Patient element holding them.
+patient_include_support = {'_include': {},
+                           '_revinclude': {'Address:patient': 'address', 'ContactPoint:patient': 'telecom'}}
+
+# Validated once at import.  Compiled search plans are cached on the support object.
+patient_search_support = SearchSupport(base=Patient, model_support=patient_model_support,
+                                       include_support=patient_include_support)
+
+# Cached searchset bundles are invalidated by committed changes to any table a Patient bundle is built from
+patient_search_cache = SearchResultCache(resource='Patient', models=[Patient, Address, EmailAddress, PhoneNumber])
+
+
+##############################################################
+# Conditional request validators
+##############################################################
+def patient_read_validator(id):
+    """
+    Validator of a Patient resource from one query:  the weak ETag of the source hash of the patient's rows, and
+    their latest updated_at
+    """
+    row = db.session.query(patient_source_hash(), patient_last_modified()).filter(Patient.id == id).first()
+    if row is None:
+        return None
+    return Validator(etag=weak_etag(row[0]), last_modified=row[1])
+
+
+def patient_search_validator():
+    """
+    Validator of a Patient searchset from the count and max updated_at of the matched patients and their child rows
+    """
+    if '_explain' in request.args:
+        return None
+    query, plan = patient_search_support.search(args=request.args, query=Patient.query)
+    set_statement_timeout('Patient')
+    check_search_cost(query, 'Patient')
+    args = sorted((name, sorted(request.args.getlist(name))) for name in request.args)
+    return search_validator(query=query, model=Patient,
+                            related=[(Address, Address.patient_id), (EmailAddress, EmailAddress.patient_id),
+                                     (PhoneNumber, PhoneNumber.patient_id)],
+                            extra=[request.host_url, args])
 
 
 @api_bp.route('/fhir/Patient/<int:id>', methods=['GET'])
 @token_auth.login_required
 @enforce_fhir_mimetype_charset
 @rate_limit(limit=5, period=15)
-@etag
+@etag(validator=patient_read_validator)
 def patient_read(id):
     """
     Return a FHIR STU 3.0 Patient resource as JSON.
     """
     pt = Patient.query.get_or_404(ident=id)
-    data = pt.dump_fhir_json()
+    data = Patient.load_stored_fhir([pt]).get(pt.id) or pt.dump_fhir_json()
     response = jsonify(data)
     response.headers['Location'] = url_for('api_v1.patient_read', id=pt.id)
     response.headers['Content-Type'] = 'application/fhir+json'
@@ -73,104 +213,23 @@ def patient_vread(id, vid):
 @token_auth.login_required
 @enforce_fhir_mimetype_charset
 @rate_limit(limit=5, period=15)
-@etag
+@patient_search_cache.cached
+@etag(validator=patient_search_validator)
 def patient_search():
-    # Initialize a query that will be added to dynamically according to url params
-    query = Patient.query
-
-    ##############################################################
-    # Declare FHIR Search Parameters Supported
-    ##############################################################
-    model_support = {'active': {'modifier': ['not'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['active'],
-                                'type': 'bool'},
-                     'deceased': {'modifier': ['not'],
-                                  'prefix': [],
-                                  'model': Patient,
-                                  'column': ['deceased'],
-                                  'type': 'bool'},
-                     'birthdate': {'modifier': [],
-                                   'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                   'model': Patient,
-                                   'column': ['dob'],
-                                   'type': 'date'},
-                     'death-date': {'modifier': [],
-                                    'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                    'model': Patient,
-                                    'column': ['deceased_date'],
-                                    'type': 'date'},
-                     'given': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': Patient,
-                               'column': ['first_name', 'middle_name'],  # Will search both with or condition
-                               'type': 'string'},
-                     'family': {'modifier': ['exact', 'contains', 'missing'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['last_name'],
-                                'type': 'string'},
-                     'name': {'modifier': ['exact', 'contains', 'missing'],
-                              'prefix': [],
-                              'model': Patient,
-                              'column': ['last_name', 'first_name', 'middle_name', 'suffix', 'prefix'],
-                              'type': 'string'},
-                     'gender': {'modifier': ['exact', 'contains', 'missing'],
-                                'prefix': [],
-                                'model': Patient,
-                                'column': ['sex'],
-                                'type': 'string'},
-                     'address-city': {'modifier': ['exact', 'contains', 'missing'],
-                                      'prefix': [],
-                                      'model': Address,
-                                      'column': ['city'],
-                                      'type': 'string'},
-                     'address-state': {'modifier': ['exact', 'contains', 'missing'],
-                                       'prefix': [],
-                                       'model': Address,
-                                       'column': ['state'],
-                                       'type': 'string'},
-                     'address-postalcode': {'modifier': ['exact', 'contains', 'missing'],
-                                            'prefix': [],
-                                            'model': Address,
-                                            'column': ['zipcode'],
-                                            'type': 'string'},
-                     'address-country': {'modifier': ['exact', 'contains', 'missing'],
-                                         'prefix': [],
-                                         'model': Address,
-                                         'column': ['country'],
-                                         'type': 'string'},
-                     'address': {'modifier': ['exact', 'contains', 'missing'],
-                                 'prefix': [],
-                                 'model': Address,
-                                 'column': ['address1', 'address2', 'city', 'state', 'zipcode', 'country'],
-                                 'type': 'string'},
-                     'email': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': EmailAddress,
-                               'column': ['email'],
-                               'type': 'string'},  # TODO validate email address w/ exact
-                     'phone': {'modifier': ['exact', 'contains', 'missing'],
-                               'prefix': [],
-                               'model': PhoneNumber,
-                               'column': ['number'],
-                               'type': 'string'},  # TODO validate phone w/ exact
-                     'language': {'modifier': ['exact', 'contains', 'missing'],
-                                  'prefix': [],
-                                  'model': Patient,
-                                  'column': ['preferred_language'],
-                                  'type': 'string'},
-                     'identifier': {'modifier': ['exact', 'contains'],  # TODO: Support missing
-                                    'prefix': [],
-                                    'model': Patient,
-                                    'column': {'http://unkani.com': 'uuid', 'http://hl7.org/fhir/sid/us-ssn': 'ssn'},
-                                    'type': 'token'}  # TODO:  Validate SSN - match without hyphens
-                     }
-    # Parse the request args and execute the search.  Return un-executed query
-    query = fhir_search(args=request.args, model_support=model_support, base=Patient, query=query)
+    # Parse the request args and apply the search under the resource's cost controls.  Return un-executed query
+    query, plan, explain = guard_search(support=patient_search_support, resource='Patient', query=Patient.query,
+                                       explain_permission=app_permission_patientadmin)
+    if explain is not None:
+        return jsonify(explain)
+    # Large pages are written to the response as their rows are read
+    if stream_bundle_requested(paginate=True):
+        chunks = stream_bundle(query=query, paginate=True, sort=plan.sort, includes=plan.includes,
+                               warnings=plan.warnings)
+        return current_app.response_class(stream_with_context(chunks), mimetype='application/json')
+
     # Pass the query to be executed to bundle/pagination utility
-    bundle = create_bundle(query=query, paginate=True)
+    bundle = create_bundle(query=query, paginate=True, sort=plan.sort, includes=plan.includes,
+                           warnings=plan.warnings)
 
     # Create the response from bundle JSON
     response = jsonify(bundle.as_json())
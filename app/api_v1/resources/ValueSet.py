@@ -1,9 +1,19 @@
+import uuid
 from app.api_v1.authentication import token_auth
 from app.api_v1.errors.user_errors import *
+from app.api_v1.errors.exceptions import ValidationError
 from app.api_v1.utils.rate_limit import rate_limit
 from app.api_v1.utils.etag import etag
-from app.models.fhir.codesets import ValueSet
-from flask import url_for
+from app.api_v1.utils.search import escape_like
+from app.models.fhir.codesets import ValueSet, ValueSetExpansion
+from app.utils.fhir_utils import fhir_datetime_json
+from app import db
+from flask import request, url_for
+from sqlalchemy import and_, or_
+
+# Number of concepts of an $expand page, when not set with the count parameter, and the largest page served
+EXPAND_DEFAULT_COUNT = 100
+EXPAND_MAX_COUNT = 1000
 
 
 @api_bp.route('/fhir/ValueSet/<string:resource_id>', methods=['GET'])
@@ -31,3 +41,105 @@ def get_valuesets():
     Return FHIR ValueSet resources as JSON.
     """
     return jsonify('Coming Soon!')
+
+
+def get_int_arg(name, default):
+    """
+    Read a non-negative integer request parameter.  ValidationError is raised for any other value.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise ValidationError('The value supplied for the {} parameter must be a non-negative integer'.format(name))
+    return value
+
+
+@api_bp.route('/fhir/ValueSet/<string:resource_id>/$expand', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+@etag
+def valueset_expand(resource_id):
+    """
+    Return a page of the materialized expansion of a FHIR ValueSet as JSON.  The filter parameter keeps the
+    concepts whose code or display starts with its value, ignoring case in the display.  Pages are selected with the
+    offset and count parameters.  The expansion identifier is derived from the ValueSet and the time it was expanded,
+    so the response, and its ETag, only change when the expansion does.
+    """
+    valueset = ValueSet.query.filter(ValueSet.resource_id == resource_id).first_or_404()
+    offset = get_int_arg('offset', 0)
+    count = min(get_int_arg('count', EXPAND_DEFAULT_COUNT), EXPAND_MAX_COUNT)
+    text_filter = request.args.get('filter')
+
+    query = ValueSetExpansion.query.filter(ValueSetExpansion.valueset_id == valueset.id)
+    parameters = [{'name': 'offset', 'valueInteger': offset}, {'name': 'count', 'valueInteger': count}]
+    if text_filter:
+        prefix = escape_like(text_filter) + '%'
+        query = query.filter(or_(ValueSetExpansion.code.like(prefix), ValueSetExpansion.display.ilike(prefix)))
+        parameters.append({'name': 'filter', 'valueString': text_filter})
+    total = query.count()
+    concepts = query.order_by(ValueSetExpansion.system, ValueSetExpansion.code).offset(offset).limit(count).all()
+
+    data = {'resourceType': 'ValueSet', 'id': valueset.resource_id, 'url': valueset.url,
+            'status': valueset.data.get('status')}
+    if valueset.version:
+        data['version'] = valueset.version
+    expanded_at = valueset.expanded_at or valueset.updated_at
+    identifier = uuid.uuid5(uuid.NAMESPACE_URL, '{}|{}'.format(valueset.url or valueset.resource_id, expanded_at))
+    data['expansion'] = {'identifier': 'urn:uuid:{}'.format(identifier),
+                         'timestamp': fhir_datetime_json(value=expanded_at),
+                         'total': total, 'offset': offset, 'parameter': parameters,
+                         'contains': [concept.as_json() for concept in concepts]}
+    response = jsonify(data)
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response.status_code = 200
+    return response
+
+
+@api_bp.route('/fhir/ValueSet/<string:resource_id>/$validate-code', methods=['GET'])
+@token_auth.login_required
+@rate_limit(limit=5, period=15)
+@etag
+def valueset_validate_code(resource_id):
+    """
+    Return a FHIR Parameters resource as JSON, whose result parameter tells whether the code, and the system and
+    display when supplied, is in the materialized expansion of the ValueSet.
+    """
+    code = request.args.get('code')
+    system = request.args.get('system')
+    display = request.args.get('display')
+    if not code:
+        raise ValidationError('The code parameter is required by $validate-code')
+
+    # One indexed lookup finds the ValueSet and the concept, which is None when the code is not in the expansion
+    conditions = [ValueSetExpansion.valueset_id == ValueSet.id, ValueSetExpansion.code == code]
+    if system:
+        conditions.append(ValueSetExpansion.system == system)
+    row = db.session.query(ValueSet.url, ValueSetExpansion.code, ValueSetExpansion.display) \
+        .outerjoin(ValueSetExpansion, and_(*conditions)) \
+        .filter(ValueSet.resource_id == resource_id).first_or_404()
+    url, found, found_display = row
+
+    if found is None:
+        result = False
+        coding = '{}|{}'.format(system, code) if system else code
+        message = 'The code {} is not in the ValueSet {}'.format(coding, url)
+    elif display and display != found_display:
+        result = False
+        message = 'The display {} does not match the display {} of the code {}'.format(display, found_display, code)
+    else:
+        result = True
+        message = None
+    parameters = [{'name': 'result', 'valueBoolean': result}]
+    if message:
+        parameters.append({'name': 'message', 'valueString': message})
+    if found_display:
+        parameters.append({'name': 'display', 'valueString': found_display})
+    response = jsonify({'resourceType': 'Parameters', 'parameter': parameters})
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response.status_code = 200
+    return response
@@ -1 +1 @@
-from app.api_v1.resources import User, Patient, CodeSystem, ValueSet
+from app.api_v1.resources import User, Patient, Organization, CodeSystem, ValueSet, BulkData, Bundle
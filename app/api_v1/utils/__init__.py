@@ -1 +1,2 @@
-from app.api_v1.utils import bundle, etag, operation_outcome, pagination, rate_limit, requests, search
+from app.api_v1.utils import bundle, etag, explain, operation_outcome, pagination, rate_limit, requests, search, \
+    search_cache
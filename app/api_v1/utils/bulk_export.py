@@ -0,0 +1,321 @@
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from pytz import utc
+from app import db, redis
+from app.api_v1.errors.exceptions import ValidationError
+from app.api_v1.utils.bundle import render_search_entries
+from app.models.fhir.patient import Patient
+from app.models.fhir.organization import Organization
+from app.models.fhir.patient_resource import patient_last_modified
+from app.utils.json_backend import dumpb
+from app.utils.type_validation import validate_datetime, DatetimeParseError
+
+# Accepted values of the _outputFormat parameter
+EXPORT_FORMATS = ['application/fhir+ndjson', 'application/ndjson', 'ndjson']
+
+# Resources included in a system level export, in export order, with the SQL expression of the last time a
+# resource's state changed, used by _since.  The Patient resource includes its child rows.
+EXPORT_RESOURCES = OrderedDict([('Patient', (Patient, patient_last_modified)),
+                                ('Organization', (Organization, lambda: Organization.updated_at))])
+
+# Resources in the Patient compartment, exported by Patient level exports
+PATIENT_EXPORT_RESOURCES = ['Patient']
+
+# Lua script that stores an export's JSON document unless the export is gone or was cancelled.  The check and the
+# write run atomically in Redis, so a job's progress update can not overwrite a concurrent cancellation.
+# KEYS[1]: export key, ARGV[1]: JSON document, ARGV[2]: expiry in seconds.  Returns 1 when the document was stored.
+UPDATE_UNLESS_CANCELLED = """
+local current = redis.call('GET', KEYS[1])
+if not current or cjson.decode(current)['status'] == 'cancelled' then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+def parse_export_types(value, level):
+    """
+    Validate the _type parameter of an export kick-off request
+    :param value:
+        Comma separated resource types, or None for every resource of the export level
+    :param level:
+        'system' or 'patient'
+    :return:
+        List of resource types, in export order.  ValidationError is raised for unsupported types.
+    """
+    supported = list(EXPORT_RESOURCES) if level == 'system' else PATIENT_EXPORT_RESOURCES
+    if not value:
+        return supported
+    requested = [t.strip() for t in value.split(',') if t.strip()]
+    unknown = [t for t in requested if t not in supported]
+    if unknown:
+        raise ValidationError('The _type parameter included resources that can not be exported: {}'.format(
+            ', '.join(unknown)))
+    return [t for t in supported if t in requested]
+
+
+def parse_export_since(value):
+    """
+    Validate the _since parameter of an export kick-off request
+    :return:
+        Naive UTC datetime, or None.  ValidationError is raised for values that are not FHIR instants.
+    """
+    if not value:
+        return None
+    try:
+        since = validate_datetime(value=value, error_out=True)
+    except DatetimeParseError:
+        raise ValidationError('The value supplied for the _since parameter must be a FHIR instant')
+    if since is None:
+        raise ValidationError('The value supplied for the _since parameter must be a FHIR instant')
+    if since.tzinfo is not None:
+        since = since.astimezone(utc).replace(tzinfo=None)
+    return since
+
+
+def format_instant(value):
+    """
+    Format a naive UTC datetime as a FHIR instant.  Fractions of a second are kept, so that the transactionTime of
+    an export can be used as the _since of the next one without missing or repeating changes.
+    """
+    return value.isoformat() + 'Z'
+
+
+class BulkExport(object):
+    """
+    An asynchronous FHIR Bulk Data $export request.
+
+    The state of an export is kept in Redis as a JSON document that expires BULK_EXPORT_EXPIRES seconds after its
+    last update.  It records the id of the user who requested the export, who is the only one allowed to check its
+    status, cancel it or download its files.  The export itself runs as an rq job (see app.jobs.run_bulk_export), which writes one NDJSON file
+    per resource type to a directory of its own under BULK_EXPORT_DIR, and records its progress after every batch.
+    """
+    key_prefix = 'bulk-export'
+
+    # Values of status
+    QUEUED = 'queued'
+    IN_PROGRESS = 'in-progress'
+    COMPLETED = 'completed'
+    ERROR = 'error'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, id, level, types, since=None, request_url=None, transaction_time=None, status=QUEUED,
+                 progress=None, output=None, error=None, user_id=None):
+        self.id = id
+        self.user_id = user_id
+        self.level = level
+        self.types = types
+        self.since = since
+        self.request_url = request_url
+        self.transaction_time = transaction_time
+        self.status = status
+        self.progress = progress or OrderedDict((t, {'exported': 0, 'total': None}) for t in types)
+        self.output = output or []
+        self.error = error
+
+    def __repr__(self):  # pragma: no cover
+        return '<BulkExport {}:{}>'.format(self.id, self.status)
+
+    @staticmethod
+    def make_key(export_id):
+        return '{}:{}'.format(BulkExport.key_prefix, export_id)
+
+    @property
+    def directory(self):
+        return os.path.join(current_app.config['BULK_EXPORT_DIR'], self.id)
+
+    @property
+    def finished(self):
+        return self.status in (self.COMPLETED, self.ERROR, self.CANCELLED)
+
+    def as_dict(self):
+        return {'id': self.id, 'user_id': self.user_id, 'level': self.level, 'types': self.types,
+                'since': self.since.isoformat() if self.since else None, 'request_url': self.request_url,
+                'transaction_time': self.transaction_time, 'status': self.status, 'progress': self.progress,
+                'output': self.output, 'error': self.error}
+
+    def save(self):
+        redis.set(self.make_key(self.id), json.dumps(self.as_dict()),
+                  ex=current_app.config.get('BULK_EXPORT_EXPIRES', 86400))
+
+    def update(self):
+        """
+        Save the state of a running export, unless it was cancelled or has expired in the meantime
+        :return:
+            False when the export was cancelled or has expired, and the state was not saved
+        """
+        saved = redis.register_script(UPDATE_UNLESS_CANCELLED)(
+            keys=[self.make_key(self.id)],
+            args=[json.dumps(self.as_dict()), current_app.config.get('BULK_EXPORT_EXPIRES', 86400)])
+        if not saved:
+            self.status = self.CANCELLED
+        return bool(saved)
+
+    @classmethod
+    def load(cls, export_id):
+        """
+        :return:
+            The BulkExport with the id, or None when it does not exist or has expired
+        """
+        data = redis.get(cls.make_key(export_id))
+        if data is None:
+            return None
+        data = json.loads(data.decode('utf-8'))
+        if data.get('since'):
+            data['since'] = validate_datetime(value=data['since'], error_out=True)
+        data['progress'] = OrderedDict((t, data['progress'][t]) for t in data['types'])
+        return cls(**data)
+
+    @classmethod
+    def start(cls, level, types, since=None, request_url=None, base_url=None, user_id=None):
+        """
+        Record a new export and queue the job that runs it
+        :param level:
+            'system' or 'patient'
+        :param types:
+            Resource types to export, see parse_export_types
+        :param since:
+            Only resources changed after this naive UTC datetime are exported
+        :param request_url:
+            The URL of the kick-off request, echoed in the completion manifest
+        :param base_url:
+            Root URL of the kick-off request, used for the absolute URLs of the exported resources
+        :param user_id:
+            Id of the user who requested the export
+        :return:
+            BulkExport
+        """
+        from app.jobs import get_queue, run_bulk_export
+        export = cls(id=uuid.uuid4().hex, level=level, types=types, since=since, request_url=request_url,
+                     transaction_time=format_instant(datetime.utcnow()), user_id=user_id)
+        export.save()
+        get_queue().enqueue(run_bulk_export, export.id, base_url, job_id=export.id,
+                            timeout=current_app.config.get('BULK_EXPORT_TIMEOUT', 3600))
+        return export
+
+    def cancel(self):
+        """
+        Cancel the export and delete its files.  A running job stops after its current batch, because its next
+        update finds the export cancelled.
+        """
+        self.status = self.CANCELLED
+        self.save()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def progress_message(self):
+        """
+        Human readable progress of the export, ex: 'Patient: 1000 of 5000 exported; Organization: queued'
+        """
+        parts = []
+        for resource_type, progress in self.progress.items():
+            if progress['total'] is None:
+                parts.append('{}: queued'.format(resource_type))
+            else:
+                parts.append('{}: {} of {} exported'.format(resource_type, progress['exported'], progress['total']))
+        return '; '.join(parts)
+
+    def manifest(self, file_url):
+        """
+        The completion manifest returned by the status endpoint
+        :param file_url:
+            Function of (export id, file name) that returns the absolute URL of an output file
+        """
+        return {'transactionTime': self.transaction_time,
+                'request': self.request_url,
+                'requiresAccessToken': True,
+                'output': [{'type': o['type'], 'url': file_url(self.id, o['file']), 'count': o['count']}
+                           for o in self.output],
+                'error': []}
+
+    ##############################################################################################
+    # Export job
+    ##############################################################################################
+    def run(self):
+        """
+        Write the NDJSON file of each resource type, reading the rows with a server-side cursor in batches of
+        BULK_EXPORT_BATCH_SIZE.  Each resource type is exported in id order within a single REPEATABLE READ
+        transaction, so its count and its file are a consistent snapshot.  Different resource types are read in
+        different transactions, so they are not a snapshot of the same moment.
+        """
+        if self.finished:
+            return
+        self.status = self.IN_PROGRESS
+        if not self.update():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            for resource_type in self.types:
+                count = self.export_resource(resource_type)
+                if count is None:
+                    shutil.rmtree(self.directory, ignore_errors=True)
+                    return
+                if count:
+                    self.output.append({'type': resource_type, 'file': '{}.ndjson'.format(resource_type),
+                                        'count': count})
+        except Exception as e:
+            db.session.rollback()
+            self.status = self.ERROR
+            self.error = str(e)
+            self.update()
+            raise
+        self.status = self.COMPLETED
+        if not self.update():
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def export_resource(self, resource_type):
+        """
+        Write the NDJSON file of one resource type
+        :return:
+            The number of resources written, or None when the export was cancelled
+        """
+        model, last_modified = EXPORT_RESOURCES[resource_type]
+        # The isolation level can only be set before the transaction's first statement
+        db.session.rollback()
+        db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        try:
+            return self.write_resource_file(resource_type, model, last_modified)
+        finally:
+            db.session.rollback()
+
+    def write_resource_file(self, resource_type, model, last_modified):
+        query = model.query
+        if self.since:
+            query = query.filter(last_modified() > self.since)
+        progress = self.progress[resource_type]
+        progress['total'] = query.order_by(None).count()
+        progress['exported'] = 0
+        if not self.update():
+            return None
+
+        batch_size = current_app.config.get('BULK_EXPORT_BATCH_SIZE', 1000)
+        path = os.path.join(self.directory, '{}.ndjson'.format(resource_type))
+        batch = []
+        with open(path + '.part', 'wb') as f:
+            for obj in query.order_by(model.id).yield_per(batch_size):
+                batch.append(obj)
+                if len(batch) == batch_size:
+                    if not self.write_batch(f, model, batch, progress):
+                        return None
+                    batch = []
+            if batch and not self.write_batch(f, model, batch, progress):
+                return None
+        os.replace(path + '.part', path)
+        return progress['exported']
+
+    def write_batch(self, f, model, batch, progress):
+        """
+        Render a batch of rows as NDJSON lines and record the progress of the export
+        :return:
+            False when the export was cancelled
+        """
+        for obj, entry in render_search_entries(base=model, records=batch):
+            resource = entry['resource'] if isinstance(entry, dict) else entry.resource.as_json()
+            f.write(dumpb(resource) + b'\n')
+            progress['exported'] += 1
+        return self.update()
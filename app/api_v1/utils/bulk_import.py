@@ -0,0 +1,479 @@
+"""
+Bulk loading of NDJSON Patient resources, used by the $import operation and the import_patients CLI command.
+
+Creating patients through the ORM builds a Patient, its child objects and their version rows one object at a time.
+An import works on batches of BULK_IMPORT_BATCH_SIZE resources instead:
+    1) Each line is parsed, validated and normalized into dicts of column values, see parse_patient.
+    2) Ids for the whole batch are taken from the table sequences, and row hashes, address hashes and search keys are
+       computed with the same functions the models use, so imported rows are identical to rows written by the ORM.
+    3) The rows are written to temporary staging tables with COPY.
+    4) The staged rows are merged into the patient, address, email_address and phone_number tables, and their version
+       rows are written for one versioning transaction, with an INSERT ... SELECT statement per table.
+Patients whose unkani identifier (their uuid) already exists are skipped, with their child rows.
+"""
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime
+from io import StringIO
+from flask import current_app, has_request_context, request
+from sqlalchemy import text
+from sqlalchemy_continuum import version_class, transaction_class
+from app import db
+from app.models import fetch_current_user_id
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.models.fhir.email_address import EmailAddress
+from app.models.fhir.phone_number import PhoneNumber
+from app.utils.demographics import normalize_name, validate_phone, validate_contact_type, validate_email, \
+    validate_ssn, validate_sex, validate_dob, validate_race, validate_ethnicity, validate_marital_status, \
+    validate_language, validate_state, ethnicity_dict
+from app.utils.general import fold_search_key
+from app.utils.json_backend import loads
+from app.utils.type_validation import validate_datetime
+
+# Accepted Content-Type values of an $import request
+IMPORT_FORMATS = ['application/fhir+ndjson', 'application/ndjson', 'application/x-ndjson']
+
+UNKANI_IDENTIFIER_SYSTEM = 'http://unkani.com'
+SSN_IDENTIFIER_SYSTEM = 'http://hl7.org/fhir/sid/us-ssn'
+RACE_EXTENSION_URL = 'http://hl7.org/fhir/StructureDefinition/us-core-race'
+ETHNICITY_EXTENSION_URL = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
+
+# Tables loaded by an import, in merge order, with the columns copied to them and the functions computing the
+# columns derived from the others.  Child rows are merged after the patients they belong to.
+IMPORT_TABLES = OrderedDict([
+    (Patient, {'columns': ['id', 'uuid'] + list(Patient.row_hash_columns) +
+                          ['created_at', 'updated_at', 'row_hash'] + list(Patient.search_keys.values()),
+               'derived': {}}),
+    (Address, {'columns': ['id', 'primary', 'active'] + list(Address.row_hash_columns) +
+                          ['created_at', 'updated_at', 'address_hash', 'row_hash'] + list(Address.search_keys.values()),
+               'derived': {'address_hash': Address.hash_address}}),
+    (EmailAddress, {'columns': ['id', 'email', 'primary', 'active', 'patient_id', 'user_id', 'avatar_hash',
+                                'created_at', 'updated_at', 'row_hash'],
+                    'derived': {'avatar_hash': lambda row: EmailAddress.make_avatar_hash(row['email'])}}),
+    (PhoneNumber, {'columns': ['id', 'number', 'type', 'active', 'primary', 'patient_id', 'user_id', 'created_at',
+                               'updated_at', 'row_hash'],
+                   'derived': {}})])
+
+
+##############################################################################################
+# Parsing and validation
+##############################################################################################
+def parse_date(value):
+    """
+    Parse a FHIR date or dateTime into a date.  Plain dates are parsed without dateutil.
+    """
+    if isinstance(value, str) and len(value) == 10:
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            pass
+    return validate_datetime(value=value, error_out=True, to_date=True)
+
+
+def first_coding(codeable_concept):
+    """
+    The code and display of the first coding of a CodeableConcept, falling back to its text
+    :return:
+        Tuple of (code, display)
+    """
+    codeable_concept = codeable_concept or {}
+    codings = codeable_concept.get('coding') or [{}]
+    return codings[0].get('code'), codings[0].get('display') or codeable_concept.get('text')
+
+
+def parse_name(names):
+    """
+    Column values of the official (or usual, or first) HumanName of a Patient resource
+    """
+    if not names:
+        return {}
+    name = next((n for n in names if n.get('use') == 'official'),
+                next((n for n in names if n.get('use') == 'usual'), names[0]))
+    given = name.get('given') or []
+    return {'first_name': normalize_name(given[0]) if given else None,
+            'middle_name': normalize_name(' '.join(given[1:])) if len(given) > 1 else None,
+            'last_name': normalize_name(name.get('family')),
+            'prefix': normalize_name((name.get('prefix') or [None])[0]),
+            'suffix': normalize_name((name.get('suffix') or [None])[0])}
+
+
+def parse_address(fhir_address):
+    """
+    Column values of an address row from a FHIR Address
+    """
+    lines = fhir_address.get('line') or []
+    state = fhir_address.get('state')
+    if state:
+        state = state.strip().upper()
+        # Two letter abbreviations are used as is, only state names are looked up
+        if len(state) != 2:
+            state = validate_state(state)
+    use = (fhir_address.get('use') or '').upper()
+    address_type = fhir_address.get('type')
+    period = fhir_address.get('period') or {}
+    start_date = parse_date(period['start']) if period.get('start') else None
+    end_date = parse_date(period['end']) if period.get('end') else None
+    if start_date and end_date and start_date > end_date:
+        raise ValueError('Invalid address period: The end date was not after the start date.')
+    return {'address1': lines[0].strip().upper() if lines else None,
+            'address2': ' '.join(lines[1:]).strip().upper() if len(lines) > 1 else None,
+            'city': (fhir_address.get('city') or '').strip().upper() or None,
+            'state': state or None,
+            'zipcode': (fhir_address.get('postalCode') or '').strip() or None,
+            'district': (fhir_address.get('district') or '').strip().upper() or None,
+            'country': (fhir_address.get('country') or '').strip().upper() or None,
+            'use': use if use in ('HOME', 'WORK', 'TEMP', 'OLD') else None,
+            'is_postal': address_type in (None, 'postal', 'both'),
+            'is_physical': address_type in (None, 'physical', 'both'),
+            'start_date': start_date,
+            'end_date': end_date,
+            'active': True,
+            'primary': False,
+            'user_id': None}
+
+
+def parse_telecom(contact_points):
+    """
+    Email address and phone number rows from the telecom ContactPoints of a Patient resource.  ContactPoints of other
+    systems are ignored.  A ContactPoint whose use is 'old' is inactive, and the rank 1 ContactPoint of each system is
+    primary.
+    :return:
+        Tuple of (list of email address rows, list of phone number rows)
+    """
+    emails, phones = [], []
+    for cp in contact_points or []:
+        system = cp.get('system')
+        active = cp.get('use') != 'old'
+        primary = active and cp.get('rank') == 1
+        if system == 'email':
+            emails.append({'email': validate_email(cp.get('value')), 'active': active, 'primary': primary,
+                           'user_id': None})
+        elif system == 'phone':
+            phone_type = validate_contact_type(cp['use']) if active and cp.get('use') else 'HOME'
+            phones.append({'number': validate_phone(cp.get('value')), 'type': phone_type, 'active': active,
+                           'primary': primary, 'user_id': None})
+    return emails, phones
+
+
+def parse_patient(resource):
+    """
+    Validate and normalize a FHIR Patient resource into the column values of the rows it is loaded as
+    :param resource:
+        dict of FHIR Patient JSON
+    :return:
+        Tuple of (patient row, dict of lists of child rows by model).  Rows are dicts of column values, without the
+        ids, timestamps, hashes and search keys computed when their batch is loaded.
+        ValueError is raised for resources that can not be loaded.
+    """
+    if not isinstance(resource, dict) or resource.get('resourceType') != 'Patient':
+        raise ValueError('The resource is not a Patient resource')
+
+    patient = {column: None for column in Patient.row_hash_columns}
+    patient.update(parse_name(resource.get('name')))
+    for identifier in resource.get('identifier') or []:
+        if identifier.get('system') == UNKANI_IDENTIFIER_SYSTEM:
+            patient['uuid'] = uuid.UUID(identifier.get('value'))
+        elif identifier.get('system') == SSN_IDENTIFIER_SYSTEM:
+            patient['ssn'] = validate_ssn(identifier.get('value'))
+    patient.setdefault('uuid', uuid.uuid4())
+
+    # The Patient model only stores male and female, and stores other genders as null
+    gender = resource.get('gender')
+    patient['sex'] = validate_sex(gender) if gender in ('male', 'female') else None
+    if resource.get('birthDate'):
+        patient['dob'] = validate_dob(resource['birthDate'])
+    patient['deceased'] = bool(resource.get('deceasedBoolean') or resource.get('deceasedDateTime'))
+    if resource.get('deceasedDateTime'):
+        patient['deceased_date'] = parse_date(resource['deceasedDateTime'])
+    patient['multiple_birth'] = bool(resource.get('multipleBirthBoolean', False))
+    patient['active'] = resource.get('active', True) is not False
+
+    if resource.get('maritalStatus'):
+        patient['marital_status'] = validate_marital_status(first_coding(resource['maritalStatus'])[0])
+    communication = resource.get('communication') or []
+    if communication:
+        preferred = next((c for c in communication if c.get('preferred')), communication[0])
+        language = first_coding(preferred.get('language'))[0]
+        if language:
+            patient['preferred_language'] = validate_language(language)
+    for ext in resource.get('extension') or []:
+        if ext.get('url') == RACE_EXTENSION_URL:
+            patient['race'] = validate_race(first_coding(ext.get('valueCodeableConcept'))[0])
+        elif ext.get('url') == ETHNICITY_EXTENSION_URL:
+            code, display = first_coding(ext.get('valueCodeableConcept'))
+            patient['ethnicity'] = validate_ethnicity(code if code in ethnicity_dict else display)
+
+    addresses = [parse_address(a) for a in resource.get('address') or []]
+    if addresses:
+        # As in Patient.__init__, the first address is the primary address
+        addresses[0]['primary'] = True
+    emails, phones = parse_telecom(resource.get('telecom'))
+    return patient, {Address: addresses, EmailAddress: emails, PhoneNumber: phones}
+
+
+##############################################################################################
+# Loading
+##############################################################################################
+def copy_value(value):
+    """
+    Format a value for the text format of COPY
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def quote_columns(columns, alias=None):
+    prefix = '{}.'.format(alias) if alias else ''
+    return ', '.join('{}"{}"'.format(prefix, column) for column in columns)
+
+
+def staging_table(model):
+    return 'import_{}'.format(model.__table__.name)
+
+
+class PatientImport(object):
+    """
+    A bulk load of NDJSON Patient resources.  Lines that can not be loaded are rejected and reported with their line
+    number, without failing the rest of the import.  Each batch is committed in its own transaction.
+    """
+
+    def __init__(self, batch_size=None, max_errors=100):
+        """
+        :param batch_size:
+            Number of resources loaded per transaction, defaults to BULK_IMPORT_BATCH_SIZE
+        :param max_errors:
+            Number of rejected lines whose errors are kept for the outcome
+        """
+        self.batch_size = batch_size or current_app.config.get('BULK_IMPORT_BATCH_SIZE', 5000)
+        self.max_errors = max_errors
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.errors = []
+        self.patient_ids = []
+
+    def __repr__(self):  # pragma: no cover
+        return '<PatientImport {} imported, {} skipped, {} rejected>'.format(self.imported, self.skipped,
+                                                                              self.rejected)
+
+    def run(self, lines):
+        """
+        Load NDJSON lines, one Patient resource per line.  Blank lines are ignored.
+        :param lines:
+            Iterable of lines, str or UTF-8 bytes, ex: an open file or a request stream
+        :return:
+            self
+        """
+        batch = []
+        seen = set()
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            self.read += 1
+            try:
+                patient, children = parse_patient(loads(line))
+            except (ValueError, TypeError, AttributeError, KeyError, IndexError) as e:
+                self.reject(line_number, e)
+                continue
+            # Resources repeated within the import are loaded once
+            if patient['uuid'] in seen:
+                self.skipped += 1
+                continue
+            seen.add(patient['uuid'])
+            batch.append((patient, children))
+            if len(batch) == self.batch_size:
+                self.load_batch(batch)
+                batch = []
+        if batch:
+            self.load_batch(batch)
+        return self
+
+    def reject(self, line_number, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            message = str(error.args[0]) if error.args else type(error).__name__
+            self.errors.append({'line': line_number, 'message': message})
+
+    def outcome_list(self):
+        """
+        The outcome of the import, as the outcome_list of an OperationOutcome, see create_operation_outcome
+        """
+        outcome = [{'severity': 'information', 'type': 'informational',
+                    'details': '{} Patient resources read: {} imported, {} skipped as already loaded, '
+                               '{} rejected'.format(self.read, self.imported, self.skipped, self.rejected)}]
+        for error in self.errors:
+            outcome.append({'severity': 'error', 'type': 'invalid', 'location': ['line {}'.format(error['line'])],
+                            'diagnostics': error['message'],
+                            'details': 'Line {} was not imported: {}'.format(error['line'], error['message'])})
+        return outcome
+
+    def load_batch(self, batch):
+        """
+        Load a batch of parsed resources in one transaction
+        :param batch:
+            List of (patient row, child rows by model) tuples, see parse_patient
+        """
+        try:
+            patient_ids = load_patients(batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.imported += len(patient_ids)
+        self.skipped += len(batch) - len(patient_ids)
+        self.patient_ids.extend(patient_ids)
+
+
+def load_patients(batch, now=None):
+    """
+    Write parsed Patient resources and their child rows in the current transaction, without committing it.  Ids are
+    set on the rows of the batch.
+    :param batch:
+        List of (patient row, child rows by model) tuples, see parse_patient
+    :param now:
+        created_at and updated_at of the rows, defaults to the current time
+    :return:
+        The ids of the patients written.  Patients whose uuid already exists are not written.
+    """
+    now = now or datetime.utcnow()
+    rows = OrderedDict((model, []) for model in IMPORT_TABLES)
+    for patient, children in batch:
+        rows[Patient].append(patient)
+    prepare_rows(Patient, rows[Patient], now)
+    for patient, children in batch:
+        for model, child_rows in children.items():
+            for row in child_rows:
+                row['patient_id'] = patient['id']
+            rows[model].extend(child_rows)
+    for model in list(IMPORT_TABLES)[1:]:
+        prepare_rows(model, rows[model], now)
+
+    for model, model_rows in rows.items():
+        copy_rows(model, model_rows)
+    return merge(now)
+
+
+def allocate_ids(model, number):
+    """
+    Take ids for new rows of a model from its table's sequence
+    :return:
+        List of ids
+    """
+    if not number:
+        return []
+    result = db.session.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :number)"),
+        {'table': model.__table__.name, 'number': number})
+    return [row[0] for row in result]
+
+
+def prepare_rows(model, rows, now):
+    """
+    Set the ids, timestamps, row hashes, search keys and derived columns of new rows.  Hashes are computed after
+    the ids are set, since the row hashes of child rows include their patient_id.
+    """
+    derived = IMPORT_TABLES[model]['derived']
+    search_keys = getattr(model, 'search_keys', {})
+    for row_id, row in zip(allocate_ids(model, len(rows)), rows):
+        row['id'] = row_id
+        row['created_at'] = now
+        row['updated_at'] = now
+        row['row_hash'] = model.hash_row(row)
+        for column, key_column in search_keys.items():
+            row[key_column] = fold_search_key(row.get(column))
+        for column, function in derived.items():
+            row[column] = function(row)
+
+
+def copy_rows(model, rows):
+    """
+    Write rows to a temporary staging table of the model's table with COPY.  The staging table is dropped when
+    the transaction ends.
+    """
+    table = model.__table__.name
+    columns = IMPORT_TABLES[model]['columns']
+    db.session.execute('DROP TABLE IF EXISTS {}'.format(staging_table(model)))
+    db.session.execute('CREATE TEMPORARY TABLE {} (LIKE "{}" INCLUDING DEFAULTS) ON COMMIT DROP'.format(
+        staging_table(model), table))
+    if not rows:
+        return
+    buffer = StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(row.get(column)) for column in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(staging_table(model), quote_columns(columns)), buffer)
+
+
+def merge(now):
+    """
+    Merge the staging tables into their tables, and write the version rows of the merged rows
+    :return:
+        The ids of the merged patients
+    """
+    transaction_table = transaction_class(Patient).__table__
+    transaction_id = db.session.execute(transaction_table.insert().values(
+        issued_at=now, user_id=fetch_current_user_id(),
+        remote_addr=request.remote_addr if has_request_context() else None)
+        .returning(transaction_table.c.id)).scalar()
+
+    patient_ids = []
+    for model, spec in IMPORT_TABLES.items():
+        table = model.__table__.name
+        columns = quote_columns(spec['columns'])
+        if model is Patient:
+            result = db.session.execute(
+                'INSERT INTO patient ({}) SELECT {} FROM {} ON CONFLICT (uuid) DO NOTHING RETURNING id'.format(
+                    columns, columns, staging_table(model)))
+            patient_ids = [row[0] for row in result]
+        else:
+            # Patient ids were just taken from the sequence, so a patient with the id of a staged row's
+            # patient_id exists only if that patient was merged
+            db.session.execute('INSERT INTO "{}" ({}) SELECT {} FROM {} s JOIN patient p ON p.id = s.patient_id'
+                               .format(table, columns, quote_columns(spec['columns'], alias='s'),
+                                       staging_table(model)))
+        insert_versions(model, transaction_id)
+
+    # Let the after_commit listeners of the search cache and the Patient resource store see the rows written
+    # without the ORM
+    db.session.info.setdefault('search_cache_changed', set()).update(IMPORT_TABLES)
+    db.session.info.setdefault('resource_store_changed', set()).update(patient_ids)
+    return patient_ids
+
+
+def insert_versions(model, transaction_id):
+    """
+    Write the version rows of merged rows, as SQLAlchemy-Continuum writes them for inserts:  operation_type 0,
+    no end transaction, and the modified flag of each column set when the column has a value
+    """
+    staged = set(IMPORT_TABLES[model]['columns'])
+    version_table = version_class(model).__table__
+    names, values = [], []
+    for column in version_table.columns:
+        name = column.name
+        names.append(name)
+        if name in staged:
+            values.append('s."{}"'.format(name))
+        elif name == 'transaction_id':
+            values.append(':transaction_id')
+        elif name == 'operation_type':
+            values.append('0')
+        elif name.endswith('_mod') and name[:-len('_mod')] in staged:
+            values.append('s."{}" IS NOT NULL'.format(name[:-len('_mod')]))
+        elif name.endswith('_mod'):
+            values.append('false')
+        else:
+            values.append('NULL')
+    db.session.execute(text('INSERT INTO "{}" ({}) SELECT {} FROM {} s JOIN "{}" t ON t.id = s.id'.format(
+        version_table.name, quote_columns(names), ', '.join(values), staging_table(model),
+        model.__table__.name)), {'transaction_id': transaction_id})
@@ -1,12 +1,429 @@
-from flask import request, url_for
+from itertools import chain, islice
+from math import ceil
+from flask import request, url_for, current_app, abort
 from fhirclient.models.bundle import BundleLink, BundleEntry, BundleEntrySearch, Bundle
 from fhirclient.models.fhirabstractbase import FHIRAbstractBase
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_, tuple_, literal, func
+from sqlalchemy.orm import Load
+from sqlalchemy.types import Date, DateTime
+from app.api_v1.errors.exceptions import ValidationError
+from app.api_v1.utils.explain import estimate_query_rows
+from app.api_v1.utils.operation_outcome import create_operation_outcome
+from app.api_v1.utils.search import sort_expression, sort_order
+from app.utils.fhir_utils import use_fhirclient_serializer
+from app.utils.general import json_serial
+from app.utils.json_backend import dumps
+from app.utils.type_validation import validate_datetime, DatetimeParseError
 
+# Value of the _cursor parameter that opts a search into keyset pagination, starting from the first page
+CURSOR_START = 'first'
 
-def paginate_query(query):
+
+# Accepted values of the _total parameter
+TOTAL_MODES = ['none', 'estimate', 'accurate']
+
+
+def get_total_mode(default='accurate'):
+    """
+    Read and validate the _total request parameter
+    :param default:
+        Mode used when the _total parameter is not supplied
+    :return:
+        One of 'none', 'estimate' or 'accurate'.  ValidationError is raised for any other value.
+    """
+    mode = request.args.get('_total', default)
+    if mode not in TOTAL_MODES:
+        raise ValidationError('The value supplied for the _total parameter must be one of: {}'.format(
+            ', '.join(TOTAL_MODES)))
+    return mode
+
+
+# Accepted values of the _summary parameter
+SUMMARY_MODES = ['true', 'false', 'text', 'data', 'count']
+
+# Elements that are part of every rendered resource and may be named in _elements without effect
+ELEMENTS_ALWAYS_RENDERED = ['id', 'meta']
+
+
+class ElementProjection(object):
+    """
+    The subset of a resource's elements requested with the _summary or _elements parameters.  The search query only
+    loads the columns behind the requested elements, and the resource is serialized without the elements and child
+    collections that were left out.
+    """
+
+    def __init__(self, model, elements=None, include_narrative=True):
+        self.model = model
+        self.elements = elements
+        self.include_narrative = include_narrative
+
+    @property
+    def load_columns(self):
+        """
+        The column attribute names to load, or None when every column is needed.  The narrative describes the whole
+        resource, so all columns are loaded when it is rendered.
+        """
+        if self.elements is None or self.include_narrative:
+            return None
+        return self.model.fhir_element_columns(self.elements)
+
+    def apply(self, query):
+        """
+        Restrict the columns loaded for the base model of a search query
+        :param query:
+            Un-executed SQLAlchemy query whose first entity is the projected model
+        :return:
+            SQLAlchemy query
+        """
+        columns = self.load_columns
+        if columns is None:
+            return query
+        return query.options(Load(self.model).load_only(*columns))
+
+    @property
+    def prefetch_elements(self):
+        """
+        The elements whose related rows are read while rendering, or None for every element.  Rendering the
+        narrative builds the whole resource.
+        """
+        return None if self.load_columns is None else self.elements
+
+    def render(self, obj):
+        """
+        Build the fhirclient object for the requested elements of an ORM object
+        """
+        return obj.build_fhir_object(elements=self.elements, include_narrative=self.include_narrative)
+
+    def render_dict(self, obj):
+        """
+        Build the FHIR JSON dict for the requested elements of an ORM object, without the fhirclient object
+        """
+        return obj.build_fhir_dict(elements=self.elements, include_narrative=self.include_narrative)
+
+
+def get_element_projection(model):
+    """
+    Read and validate the _summary and _elements request parameters
+    :param model:
+        The SQLAlchemy ORM model of the searched resource.  Projection is supported by models that declare
+        fhir_elements, fhir_summary_elements, fhir_element_columns and build_fhir_object, ex: Patient
+    :return:
+        ElementProjection, or None when the full resource is requested.  ValidationError is raised for unknown
+        _summary values or elements, or when both parameters are supplied.
+    """
+    summary = request.args.get('_summary')
+    elements = request.args.get('_elements')
+    if summary is not None and summary not in SUMMARY_MODES:
+        raise ValidationError('The value supplied for the _summary parameter must be one of: {}'.format(
+            ', '.join(SUMMARY_MODES)))
+    if summary in (None, 'false', 'count') and elements is None:
+        return None
+    if summary not in (None, 'false') and elements is not None:
+        raise ValidationError('The _summary and _elements parameters can not be combined')
+    if not hasattr(model, 'fhir_elements'):
+        raise ValidationError('The _summary and _elements parameters are not supported for this resource')
+
+    if summary == 'true':
+        return ElementProjection(model=model, elements=list(model.fhir_summary_elements), include_narrative=False)
+    if summary == 'text':
+        return ElementProjection(model=model, elements=[], include_narrative=True)
+    if summary == 'data':
+        return ElementProjection(model=model, elements=None, include_narrative=False)
+
+    requested = [e.strip() for e in elements.split(',') if e.strip()]
+    unknown = [e for e in requested if e not in model.fhir_elements and e not in ELEMENTS_ALWAYS_RENDERED + ['text']]
+    if unknown:
+        raise ValidationError('The _elements parameter included unsupported elements: {}'.format(', '.join(unknown)))
+    return ElementProjection(model=model, elements=[e for e in requested if e in model.fhir_elements],
+                             include_narrative='text' in requested)
+
+
+def count_query(query, mode='accurate'):
+    """
+    Count the rows matched by a search query
+    :param query:
+        Un-executed SQLAlchemy query
+    :param mode:
+        'accurate' runs a SELECT count(*) in the database, 'estimate' uses the query planner's row estimate and
+        'none' skips counting altogether
+    :return:
+        int, or None when the mode is 'none'
+    """
+    if mode == 'none':
+        return None
+    if mode == 'estimate':
+        return estimate_query_rows(query)
+    base = query.column_descriptions[0]['entity']
+    return query.order_by(None).with_entities(func.count(base.id)).scalar()
+
+
+class OffsetPage(object):
+    """
+    A single page of results fetched with LIMIT / OFFSET.  Mirrors the attributes of the flask_sqlalchemy Pagination
+    object used to build searchset bundles, but only knows the number of pages when an accurate total was counted.
+    """
+
+    def __init__(self, items, page, per_page, total=None, has_next=False, total_mode='accurate'):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.total_mode = total_mode
+        self._has_next = has_next
+
+    @property
+    def pages(self):
+        if self.total_mode != 'accurate' or self.total is None:
+            return None
+        if self.per_page == 0:
+            return 0
+        return max(1, int(ceil(self.total / float(self.per_page))))
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1
+
+    @property
+    def has_next(self):
+        return self._has_next
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+
+def get_page_args():
+    """
+    Read the page and _count request parameters of page number pagination
+    :return:
+        Tuple of (page, per_page).  A 404 is raised for a page below 1 or a negative _count.
+    """
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('_count', 10, type=int)
-    return query.paginate(page=page, per_page=per_page), per_page
+    if page < 1 or per_page < 0:
+        abort(404)
+    return page, per_page
+
+
+def paginate_query(query, total_mode='accurate'):
+    """
+    Page number (LIMIT / OFFSET) pagination.  One extra row is fetched to find out whether a next page exists, so
+    the COUNT(*) query is only run when an accurate total was requested.
+    :param query:
+        Un-executed SQLAlchemy query
+    :param total_mode:
+        One of 'none', 'estimate' or 'accurate'
+    :return:
+        Tuple of (OffsetPage, per_page)
+    """
+    page, per_page = get_page_args()
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    if not rows and page != 1:
+        abort(404)
+    has_next = len(rows) > per_page
+    items = rows[:per_page]
+
+    if total_mode == 'accurate' and page == 1 and not has_next:
+        # The whole result set fits on the first page, so it has already been counted
+        total = len(items)
+    else:
+        total = count_query(query=query, mode=total_mode)
+    return OffsetPage(items=items, page=page, per_page=per_page, total=total, has_next=has_next,
+                      total_mode=total_mode), per_page
+
+
+class CursorPage(object):
+    """
+    A single page of results fetched with keyset (seek) pagination.  Exposes the subset of the
+    flask_sqlalchemy Pagination attributes that are needed to build a searchset bundle.
+    """
+
+    def __init__(self, items, per_page, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def get_cursor_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='fhir-bundle-cursor')
+
+
+def encode_cursor(sort_signature, sort_value, last_id):
+    """
+    Create an opaque, signed cursor that holds the sort key tuple of the last row on a page
+    :param sort_signature:
+        String describing the sort the cursor was generated for.  A cursor is only valid for the same sort.
+    :param sort_value:
+        The value of the sort column for the last row on the page
+    :param last_id:
+        The primary key of the last row on the page, used as a tie-breaker
+    :return:
+        URL safe, signed string
+    """
+    if sort_value is not None:
+        try:
+            sort_value = json_serial(sort_value)
+        except TypeError:
+            pass
+    return get_cursor_serializer().dumps({'s': sort_signature, 'k': [sort_value, last_id]})
+
+
+def decode_cursor(token, sort_signature, sort_column=None):
+    """
+    Validate a cursor generated by encode_cursor and return the sort key tuple it holds
+    :param token:
+        The value of the _cursor request parameter
+    :param sort_signature:
+        String describing the sort of the current request.  Must match the sort the cursor was generated for.
+    :param sort_column:
+        The column the search is sorted on.  Used to restore date and datetime values from their JSON representation.
+    :return:
+        Tuple of (sort_value, last_id)
+        ValidationError is raised if the cursor is invalid, tampered with, or was generated for another sort
+    """
+    try:
+        data = get_cursor_serializer().loads(token)
+        sort_value, last_id = data['k']
+        if data['s'] != sort_signature:
+            raise ValueError
+        if sort_value is not None and sort_column is not None:
+            column_type = getattr(sort_column, 'type', None)
+            if isinstance(column_type, (Date, DateTime)):
+                sort_value = validate_datetime(value=sort_value, error_out=True,
+                                               to_date=not isinstance(column_type, DateTime))
+        return sort_value, int(last_id)
+    except (BadSignature, KeyError, TypeError, ValueError, DatetimeParseError):
+        raise ValidationError('The value supplied for the _cursor parameter was invalid or expired for this search')
+
+
+def keyset_filter(sort_column, id_column, direction, sort_value, last_id):
+    """
+    Build the WHERE clause that seeks past the last row of the previous page:  (sort_column, id) > (value, last_id)
+    The row value comparison matches a composite (sort_column, id) index.  PostgreSQL sorts NULL values last in
+    ascending order and first in descending order, so rows with a NULL sort key are handled explicitly.
+    """
+    if direction == 'desc':
+        if sort_value is None:
+            return or_(and_(sort_column.is_(None), id_column < last_id), sort_column.isnot(None))
+        return tuple_(sort_column, id_column) < tuple_(literal(sort_value, type_=sort_column.type),
+                                                       literal(last_id, type_=id_column.type))
+    if sort_value is None:
+        return and_(sort_column.is_(None), id_column > last_id)
+    return or_(tuple_(sort_column, id_column) > tuple_(literal(sort_value, type_=sort_column.type),
+                                                       literal(last_id, type_=id_column.type)),
+               sort_column.is_(None))
+
+
+def cursor_page_query(query, sort=None):
+    """
+    Build the keyset (seek) query of the page requested with the _cursor and _count parameters.  Instead of OFFSET,
+    the page is fetched with an index-backed WHERE (sort_key, id) > (last_sort_key, last_id) LIMIT n, so the cost of
+    a page does not grow with its depth.  One extra row is fetched to find out whether another page exists.
+
+    :param query:
+        Un-executed SQLAlchemy query.  Any order_by already applied to it is replaced by the keyset sort.
+    :param sort:
+        The _sort entry of a fhir_search_spec ({'op': 'asc'|'desc', 'model': Model, 'column': [...]}) or None to
+        sort on the primary key only
+    :return:
+        Tuple of (SQLAlchemy query, per_page, sort_signature).  Rows of sorted searches carry their sort key in a
+        'cursor_sort_key' column.  A 404 is raised for a negative _count, as with page numbers.
+    """
+    per_page = request.args.get('_count', 10, type=int)
+    if per_page < 0:
+        abort(404)
+    token = request.args.get('_cursor', CURSOR_START)
+    base = query.column_descriptions[0]['entity']
+    id_column = base.id
+
+    if sort:
+        sort_column = sort_expression(base=base, sort=sort)
+        direction = sort.get('op')
+        sort_signature = '{}.{}:{}'.format(sort.get('model').__name__, sort.get('column')[0], direction)
+    else:
+        sort_column = None
+        direction = 'asc'
+        sort_signature = 'id:asc'
+
+    if token and token != CURSOR_START:
+        sort_value, last_id = decode_cursor(token=token, sort_signature=sort_signature, sort_column=sort_column)
+        if sort_column is not None:
+            query = query.filter(keyset_filter(sort_column=sort_column, id_column=id_column, direction=direction,
+                                               sort_value=sort_value, last_id=last_id))
+        elif direction == 'desc':
+            query = query.filter(id_column < last_id)
+        else:
+            query = query.filter(id_column > last_id)
+
+    order = [getattr(id_column, direction)()]
+    if sort_column is not None:
+        order.insert(0, sort_order(sort_column, direction))
+        query = query.add_columns(sort_column.label('cursor_sort_key'))
+
+    return query.order_by(None).order_by(*order).limit(per_page + 1), per_page, sort_signature
+
+
+def next_page_cursor(row, sort_signature):
+    """
+    Build the cursor of the page that follows a row of a keyset page query
+    """
+    last, score = split_search_row(row)
+    return encode_cursor(sort_signature=sort_signature, sort_value=getattr(row, 'cursor_sort_key', None),
+                         last_id=last.id)
+
+
+def cursor_paginate_query(query, sort=None):
+    """
+    Keyset (seek) pagination, see cursor_page_query
+    :return:
+        Tuple of (CursorPage, per_page)
+    """
+    page_query, per_page, sort_signature = cursor_page_query(query=query, sort=sort)
+    items = page_query.all()
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        # A page of _count=0 has no last row to continue from, so it has no next link
+        if items:
+            next_cursor = next_page_cursor(row=items[-1], sort_signature=sort_signature)
+    return CursorPage(items=items, per_page=per_page, next_cursor=next_cursor), per_page
+
+
+def set_bundle_cursor_links(bundle, page, per_page):
+    addtnl_args = request.args.to_dict(flat=False)
+    for x in ['page', '_count', '_cursor']:
+        try:
+            del addtnl_args[x]
+        except KeyError:
+            pass
+    link_self = BundleLink()
+    link_self.relation = 'self'
+    link_self.url = url_for(request.endpoint, _cursor=request.args.get('_cursor', CURSOR_START), _count=per_page,
+                            _external=True, **addtnl_args)
+
+    link_first = BundleLink()
+    link_first.relation = 'first'
+    link_first.url = url_for(request.endpoint, _cursor=CURSOR_START, _count=per_page, _external=True, **addtnl_args)
+
+    bundle.link = [link_self, link_first]
+
+    if page.has_next:
+        link_next = BundleLink()
+        link_next.relation = 'next'
+        link_next.url = url_for(request.endpoint, _cursor=page.next_cursor, _count=per_page, _external=True,
+                                **addtnl_args)
+        bundle.link.append(link_next)
+
+    return bundle
 
 
 def set_bundle_page_links(bundle, pagination, per_page):
@@ -28,11 +445,15 @@ def set_bundle_page_links(bundle, pagination, per_page):
     link_first.relation = 'first'
     link_first.url = url_for(request.endpoint, page=1, _count=per_page, _external=True, **addtnl_args)
 
-    link_last = BundleLink()
-    link_last.relation = 'last'
-    link_last.url = url_for(request.endpoint, page=pagination.pages, _count=per_page, _external=True, **addtnl_args)
+    bundle.link = [link_self, link_first]
 
-    bundle.link = [link_self, link_first, link_last]
+    # The last page is only known when the total was counted accurately
+    if pagination.pages is not None:
+        link_last = BundleLink()
+        link_last.relation = 'last'
+        link_last.url = url_for(request.endpoint, page=pagination.pages, _count=per_page, _external=True,
+                                **addtnl_args)
+        bundle.link.append(link_last)
 
     if pagination.has_prev:
         link_prev = BundleLink()
@@ -51,9 +472,107 @@ def set_bundle_page_links(bundle, pagination, per_page):
     return bundle
 
 
-def create_bundle_search_entry(obj):
+class SearchsetBundle(Bundle):
+    """
+    fhirclient Bundle that can also carry entries rendered to JSON up front:  match entries of resources serialized
+    directly as dicts, entries for included related resources, and an OperationOutcome entry of warnings about the
+    search.  They are added to the entry list when the bundle is serialized.
+    """
+
+    def __init__(self, jsondict=None, strict=True):
+        self.match_entries = []
+        self.included_entries = []
+        self.outcome_entries = []
+        super(SearchsetBundle, self).__init__(jsondict=jsondict, strict=strict)
+
+    def as_json(self):
+        js = super(SearchsetBundle, self).as_json()
+        if self.match_entries:
+            js['entry'] = self.match_entries + js.get('entry', [])
+        if self.included_entries:
+            js.setdefault('entry', []).extend(self.included_entries)
+        if self.outcome_entries:
+            js.setdefault('entry', []).extend(self.outcome_entries)
+        return js
+
+
+def load_included(objects, includes, seen=None):
+    """
+    Load the objects related to a page of search results.  Each relationship is loaded with a single
+    WHERE key IN (...) query for the whole page, using the join columns declared on the relationship.  When the rows
+    of a relationship were already prefetched on every object to serialize it (see Patient.prefetch_fhir), they are
+    reused instead.
+    :param objects:
+        The SQLAlchemy ORM objects matched by the search
+    :param includes:
+        List of relationship attributes on the base model, ex: [Patient.addresses, Patient.phone_numbers]
+    :param seen:
+        Set of (model, id) identities already included, shared by the batches of a streamed bundle.  Updated with
+        the identities of the returned objects.
+    :return:
+        List of related ORM objects, without duplicates
+    """
+    included = []
+    seen = set() if seen is None else seen
+    for relationship in includes:
+        prop = relationship.property
+        local_column, remote_column = prop.local_remote_pairs[0]
+        local_key = prop.parent.get_property_by_column(local_column).key
+        remote_key = prop.mapper.get_property_by_column(remote_column).key
+        remote_attr = getattr(prop.mapper.class_, remote_key)
+        keys = set(getattr(obj, local_key) for obj in objects) - {None}
+        if not keys:
+            continue
+        target = prop.mapper.class_
+        prefetched = [getattr(obj, '_fhir_prefetch', None) or {} for obj in objects]
+        if all(prop.key in p for p in prefetched):
+            rows = sorted((r for p in prefetched for r in p[prop.key]), key=lambda r: (getattr(r, remote_key), r.id))
+        else:
+            rows = target.query.filter(remote_attr.in_(keys)).order_by(remote_attr, target.id).all()
+        for related in rows:
+            identity = (target, related.id)
+            if identity not in seen:
+                seen.add(identity)
+                included.append(related)
+    return included
+
+
+def create_bundle_include_entry(obj):
+    """
+    Render an included related object as a searchset bundle entry dict with search mode 'include'
+    """
+    fhir_obj = obj.fhir
+    resource = fhir_obj.as_json()
+    resource.setdefault('resourceType', fhir_obj.resource_type)
+    return {'resource': resource, 'search': {'mode': 'include'}}
+
+
+def create_bundle_outcome_entry(warnings):
+    """
+    Render warnings about a search, ex: SearchPlan.warnings, as a searchset bundle entry dict with search mode
+    'outcome'
+    """
+    outcome = create_operation_outcome([{'severity': 'warning', 'type': 'not-supported', 'diagnostics': warning,
+                                         'details': warning} for warning in warnings])
+    return {'resource': outcome.as_json(), 'search': {'mode': 'outcome'}}
+
+
+def split_search_row(row):
+    """
+    Split a row returned by a search query into the matched object and its relevance score
+    :param row:
+        A SQLAlchemy ORM object, or a result tuple that starts with the object when columns were added to the query
+    :return:
+        Tuple of (obj, score).  The score is the 'search_score' column added by ranked searches, or None.
+    """
+    if isinstance(row, tuple):
+        return row[0], getattr(row, 'search_score', None)
+    return row, None
+
+
+def create_bundle_search_entry(obj, score=None, projection=None):
     try:
-        fhir_obj = obj.fhir
+        fhir_obj = projection.render(obj) if projection else obj.fhir
         if not isinstance(fhir_obj, FHIRAbstractBase):
             raise TypeError
 
@@ -62,52 +581,277 @@ def create_bundle_search_entry(obj):
         e.resource = fhir_obj
         e.search = BundleEntrySearch()
         e.search.mode = 'match'
-        # TODO: Allow modified certainty code of 0 to 1
-        e.search.score = 1
+        # Ranked (:text) searches supply a similarity score between 0 and 1
+        e.search.score = round(float(score), 4) if score is not None else 1
         return e
 
     except AttributeError or TypeError:
         raise TypeError('Object did not have an attribute FHIR that generates an FHIR object')
 
 
-def create_bundle(query, paginate=True):
+def create_bundle_search_entry_dict(obj, score=None, projection=None, resource=None):
+    """
+    Build a searchset bundle entry as a dict, for ORM objects that serialize themselves with build_fhir_dict
+    :param resource:
+        The object's pre-rendered FHIR JSON, ex: from the materialized resource store.  Rendered when None.
+    """
+    if resource is None:
+        resource = projection.render_dict(obj) if projection else obj.build_fhir_dict()
+    if not isinstance(resource, dict):
+        raise TypeError('Object did not build a FHIR JSON dict')
+    # Ranked (:text) searches supply a similarity score between 0 and 1
+    return {'fullUrl': resource.get('id'),
+            'resource': resource,
+            'search': {'mode': 'match', 'score': round(float(score), 4) if score is not None else 1}}
+
+
+def render_search_entries(base, records, projection=None):
+    """
+    Build the match entries of a page, or a batch, of search rows.  Full resources are taken from the model's
+    materialized store when it has a current copy, and the related rows the other entries are built from are
+    prefetched in a fixed number of queries instead of a few per entry.
+    :param base:
+        The searched SQLAlchemy ORM model
+    :param records:
+        Rows returned by the search query
+    :param projection:
+        ElementProjection of the _summary or _elements parameters, or None
+    :return:
+        List of (obj, entry) tuples.  Entries are dicts for models with a build_fhir_dict method, unless the
+        fhirclient serializer is configured, and BundleEntry objects otherwise.
+    """
+    as_dicts = hasattr(base, 'build_fhir_dict') and not use_fhirclient_serializer()
+    objects = [split_search_row(r)[0] for r in records]
+    stored = {}
+    if as_dicts and not projection and hasattr(base, 'load_stored_fhir'):
+        stored = base.load_stored_fhir(objects)
+    if hasattr(base, 'prefetch_fhir'):
+        base.prefetch_fhir([o for o in objects if o.id not in stored],
+                           elements=projection.prefetch_elements if projection else None)
+
+    entries = []
+    for r in records:
+        try:
+            # Try creating a search entry for the bundle
+            obj, score = split_search_row(r)
+            if as_dicts:
+                e = create_bundle_search_entry_dict(obj=obj, score=score, projection=projection,
+                                                    resource=stored.get(obj.id))
+            else:
+                e = create_bundle_search_entry(obj=obj, score=score, projection=projection)
+            entries.append((obj, e))
+        # Silently ignore items returned in the query that can't be turned into bundle entries
+        except TypeError:
+            # TODO: Improve error handling or feedback on this function for items that fail to be created
+            pass
+    return entries
+
+
+def create_bundle(query, paginate=True, sort=None, includes=None, warnings=None):
+    """
+    Execute a search query and wrap the results in a FHIR searchset Bundle
+    :param query:
+        Un-executed SQLAlchemy query
+    :param paginate:
+        When True, results are paged with the page and _count params.  When the _cursor param is present,
+        keyset pagination is used instead of page numbers.
+        The _total param controls how Bundle.total is calculated: 'accurate' (the default for page numbers) runs a
+        COUNT(*), 'estimate' uses the query planner's estimate and 'none' (the default for cursors) omits it.
+    :param sort:
+        The _sort entry of the fhir_search_spec applied to the query.  Required to build cursors for sorted searches.
+    :param includes:
+        Relationship attributes whose related objects are added to the bundle with search mode 'include'.  They are
+        loaded in one query per relationship for the page, ex: SearchPlan.includes
+    :param warnings:
+        Messages added to the bundle in an OperationOutcome entry with search mode 'outcome', ex: SearchPlan.warnings
+    The _summary (true, text, data or count) and _elements params limit each entry to a subset of the resource's
+    elements.  Only the columns needed for those elements are loaded.
+    Models with a build_fhir_dict method are serialized directly to dicts, unless the validating fhirclient
+    serializer is configured with FHIR_SERIALIZER = 'fhirclient'.
+    :return:
+        fhirclient Bundle object
+    """
     # Initialize searchset bundle
-    b = Bundle()
+    b = SearchsetBundle()
     b.type = 'searchset'
 
     # Handle _summary arg
-    # TODO: Refactor into separate function or decorator
-    summary = request.args.get('_summary')
-    if summary:
-        if summary == 'count':
-            b.total = len(query.all())
-            return b
-    # TODO: Handle summary = True and summary = Text and summary = Data
+    base = query.column_descriptions[0]['entity']
+    projection = get_element_projection(model=base)
+    if request.args.get('_summary') == 'count':
+        total_mode = get_total_mode()
+        b.total = count_query(query=query, mode='estimate' if total_mode == 'estimate' else 'accurate')
+        return b
+    # Handle _summary = true | text | data and _elements by loading only the columns needed for the entries
+    if projection:
+        query = projection.apply(query)
+
     # Apply pagination if desired and set links
-    if paginate:
-        p, per_page = paginate_query(query=query)
+    if paginate and '_cursor' in request.args:
+        total_mode = get_total_mode(default='none')
+        p, per_page = cursor_paginate_query(query=query, sort=sort)
+        b = set_bundle_cursor_links(bundle=b, page=p, per_page=per_page)
+        records = p.items
+        total = count_query(query=query, mode=total_mode)
+        if total is not None:
+            b.total = total
+    elif paginate:
+        p, per_page = paginate_query(query=query, total_mode=get_total_mode())
         b = set_bundle_page_links(bundle=b, pagination=p, per_page=per_page)
         records = p.items
-        b.total = p.total
+        if p.total is not None:
+            b.total = p.total
     # Otherwise, execute query as-is
     else:
         records = query.all()
         b.total = len(records)
 
     # Loop through results to generate bundle entries
-    for r in records:
-        try:
-            # Try creating a search entry for the bundle
-            e = create_bundle_search_entry(obj=r)
+    matches = []
+    for obj, e in render_search_entries(base=base, records=records, projection=projection):
+        if isinstance(e, dict):
+            b.match_entries.append(e)
+        else:
             # If entry can be made (e.g. if object has working fhir attribute) append to bundle
             try:
                 b.entry.append(e)
             except AttributeError:
                 b.entry = [e]
-        # Silently ignore items returned in the query that can't be turned into bundle entries
-        except TypeError:
-            # TODO: Improve error handling or feedback on this function for items that fail to be created
-            pass
+        matches.append(obj)
+
+    # Add the related objects requested with _include and _revinclude
+    if includes and matches:
+        b.included_entries = [create_bundle_include_entry(obj=o) for o in load_included(objects=matches,
+                                                                                         includes=includes)]
+    if warnings:
+        b.outcome_entries = [create_bundle_outcome_entry(warnings=warnings)]
 
     # TODO: Add OperationOutcome to bundle attribute
-    return b
\ No newline at end of file
+    return b
+
+
+def stream_bundle_requested(paginate=True):
+    """
+    Whether the searchset bundle of the current request is streamed with stream_bundle:  unpaginated searches, and
+    pages whose _count is at least the BUNDLE_STREAM_THRESHOLD config value (None disables streaming of pages).
+    """
+    if request.args.get('_summary') == 'count':
+        return False
+    if not paginate:
+        return True
+    threshold = current_app.config.get('BUNDLE_STREAM_THRESHOLD')
+    return threshold is not None and request.args.get('_count', 10, type=int) >= threshold
+
+
+def stream_bundle(query, paginate=True, sort=None, includes=None, warnings=None):
+    """
+    Execute a search query and write its FHIR searchset Bundle as a stream of JSON text, for large pages and
+    unpaginated searches.  Takes the same arguments, and honors the same request parameters, as create_bundle.
+
+    Rows are read from a server-side cursor (yield_per) in batches of BUNDLE_STREAM_BATCH_SIZE.  Each batch is
+    prefetched, rendered and written before the next one is read, so memory use does not grow with the number of
+    entries, and the first entries are sent before the last rows are read.  Included objects are written after the
+    matches of their batch, and the OperationOutcome of warnings after every match.  The links and total depend on
+    the rows read, so they follow the entries in the JSON object.
+
+    The first row is read before the generator is returned, so a failing search query, or a page past the last one,
+    is answered with an error response instead of a truncated bundle.
+    :return:
+        Generator of JSON text chunks, to be wrapped with stream_with_context in a response
+    """
+    base = query.column_descriptions[0]['entity']
+    projection = get_element_projection(model=base)
+    if projection:
+        query = projection.apply(query)
+
+    # Build the query of the requested page, see cursor_paginate_query and paginate_query
+    page = per_page = sort_signature = None
+    total_mode = 'accurate'
+    if paginate and '_cursor' in request.args:
+        total_mode = get_total_mode(default='none')
+        page_query, per_page, sort_signature = cursor_page_query(query=query, sort=sort)
+    elif paginate:
+        total_mode = get_total_mode()
+        page, per_page = get_page_args()
+        page_query = query.limit(per_page + 1).offset((page - 1) * per_page)
+    else:
+        page_query = query
+
+    rows = iter(page_query.yield_per(current_app.config.get('BUNDLE_STREAM_BATCH_SIZE', 100)))
+    first = next(rows, None)
+    if first is None and page is not None and page != 1:
+        abort(404)
+    return write_bundle_stream(query=query, rows=rows, first=first, base=base, projection=projection,
+                               includes=includes, page=page, per_page=per_page, sort_signature=sort_signature,
+                               total_mode=total_mode,
+                               outcomes=[create_bundle_outcome_entry(warnings=warnings)] if warnings else [])
+
+
+def write_bundle_stream(query, rows, first, base, projection, includes, page, per_page, sort_signature, total_mode,
+                        outcomes=()):
+    """
+    Generator of the JSON text of a streamed searchset Bundle, see stream_bundle
+    """
+    batch_size = current_app.config.get('BUNDLE_STREAM_BATCH_SIZE', 100)
+    sort_keys = current_app.config.get('JSON_SORT_KEYS', True)
+    yield '{"resourceType": "Bundle", "type": "searchset"'
+
+    # FHIR JSON does not allow empty arrays, so the entry array is opened with the first entry
+    written = 0
+    has_next = False
+    last_row = None
+    seen = set()
+    separator = ', "entry": ['
+    rows = chain([first], rows) if first is not None else rows
+    while not has_next:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        if per_page is not None and written + len(batch) > per_page:
+            # The extra row fetched to find out whether another page exists is not part of the page
+            has_next = True
+            batch = batch[:per_page - written]
+            if not batch:
+                break
+
+        entries = render_search_entries(base=base, records=batch, projection=projection)
+        chunk = [e if isinstance(e, dict) else e.as_json() for obj, e in entries]
+        if includes and entries:
+            chunk.extend(create_bundle_include_entry(obj=o) for o in load_included(
+                objects=[obj for obj, e in entries], includes=includes, seen=seen))
+        for entry in chunk:
+            yield separator + dumps(entry, sort_keys=sort_keys)
+            separator = ', '
+        written += len(batch)
+        last_row = batch[-1]
+    for entry in outcomes:
+        yield separator + dumps(entry, sort_keys=sort_keys)
+        separator = ', '
+    if separator == ', ':
+        yield ']'
+
+    # Links and total, see create_bundle
+    b = SearchsetBundle()
+    total = None
+    if sort_signature is not None:
+        cursor = None
+        if has_next and last_row is not None:
+            cursor = next_page_cursor(row=last_row, sort_signature=sort_signature)
+        set_bundle_cursor_links(bundle=b, page=CursorPage(items=[], per_page=per_page, next_cursor=cursor),
+                                per_page=per_page)
+        total = count_query(query=query, mode=total_mode)
+    elif page is not None:
+        if total_mode == 'accurate' and page == 1 and not has_next:
+            total = written
+        else:
+            total = count_query(query=query, mode=total_mode)
+        set_bundle_page_links(bundle=b, pagination=OffsetPage(items=[], page=page, per_page=per_page, total=total,
+                                                              has_next=has_next, total_mode=total_mode),
+                              per_page=per_page)
+    else:
+        total = written
+    if b.link:
+        yield ', "link": ' + dumps([link.as_json() for link in b.link], sort_keys=sort_keys)
+    if total is not None:
+        yield ', "total": ' + dumps(total)
+    yield '}'
@@ -0,0 +1,369 @@
+"""
+Processing of FHIR batch and transaction Bundles posted to the base URL of the FHIR API.
+
+Entries are grouped by operation, and each group is executed as a set, in the order FHIR requires of transactions:
+    DELETE:  the patients are loaded with one query and deleted in one flush
+    POST:  the new patients are written with load_patients, the COPY based loader of $import
+    PUT:  the patients and their child rows are loaded with one query per table, updated in place and flushed together
+    GET:  the patients are loaded and rendered together.  Only reads of a resource id are supported:  a search entry,
+          ex: GET Patient?name=x, fails with a 405 not-supported OperationOutcome.  Search the Patient endpoint
+          directly instead.
+Every write happens in one database transaction.  The fullUrl of a created entry (ex: urn:uuid:...) is resolved to
+the URL of the created resource in the request URLs and reference elements of the entries processed after it.
+
+In a transaction Bundle, the first entry that fails rolls back the transaction, and the request fails with the entry's
+status (see BundleEntryError).  In a batch Bundle, a failed entry gets an OperationOutcome in its response, and the
+other entries are processed.
+"""
+import re
+import uuid
+from collections import OrderedDict
+from werkzeug.http import HTTP_STATUS_CODES
+from app import db
+from app.api_v1.errors.exceptions import BundleEntryError, ValidationError
+from app.api_v1.utils.bulk_import import parse_patient, load_patients, UNKANI_IDENTIFIER_SYSTEM
+from app.api_v1.utils.etag import weak_etag, etag_matches
+from app.api_v1.utils.operation_outcome import create_operation_outcome
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.models.fhir.email_address import EmailAddress
+from app.models.fhir.phone_number import PhoneNumber
+from app.models.fhir.patient_resource import patient_source_hash, patient_last_modified
+from app.utils.fhir_utils import fhir_datetime_json
+
+# Bundle types accepted, with the type of their response Bundle
+BUNDLE_RESPONSE_TYPES = {'batch': 'batch-response', 'transaction': 'transaction-response'}
+
+# Order in which the operations of a transaction are processed
+OPERATION_ORDER = ['DELETE', 'POST', 'PUT', 'GET']
+
+# Operations supported by resource type
+SUPPORTED_OPERATIONS = {'Patient': OPERATION_ORDER}
+
+# Columns identifying the same child row across updates of a patient.  Addresses are matched by their address_hash.
+CHILD_KEY_COLUMNS = OrderedDict([(Address, ('address1', 'address2', 'city', 'state', 'zipcode', 'country')),
+                                 (EmailAddress, ('email',)),
+                                 (PhoneNumber, ('number', 'type'))])
+
+# Columns of a child row set from the resource on update
+CHILD_UPDATE_COLUMNS = {Address: ('primary', 'active') + Address.row_hash_columns,
+                        EmailAddress: ('email', 'primary', 'active'),
+                        PhoneNumber: ('number', 'type', 'active', 'primary')}
+
+TARGET_RE = re.compile(r'(?:^|/)(?P<type>[A-Z][A-Za-z]+)(?:/(?P<id>[^/?]+))?/?(?:\?.*)?$')
+
+
+def response_status(code):
+    return '{} {}'.format(code, HTTP_STATUS_CODES[code])
+
+
+def child_key(model, values):
+    """
+    The key matching a child row of a patient to the same row in an updated resource
+    :param values:
+        dict of the row's column values
+    """
+    if model is Address:
+        return Address.hash_address(values)
+    return tuple(values.get(column) for column in CHILD_KEY_COLUMNS[model])
+
+
+def resolve_references(obj, references):
+    """
+    Replace the reference elements of a resource that point to the fullUrl of a created entry, in place
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == 'reference' and isinstance(value, str) and value in references:
+                obj[key] = references[value]
+            else:
+                resolve_references(value, references)
+    elif isinstance(obj, list):
+        for value in obj:
+            resolve_references(value, references)
+
+
+class BundleEntry(object):
+    """
+    An entry of a batch or transaction Bundle, and the response built for it
+    """
+
+    def __init__(self, index, entry):
+        if not isinstance(entry, dict):
+            entry = {}
+        request = entry.get('request') or {}
+        self.index = index
+        self.full_url = entry.get('fullUrl')
+        self.resource = entry.get('resource')
+        self.method = str(request.get('method') or '').upper()
+        self.url = request.get('url') or ''
+        self.if_match = request.get('ifMatch')
+        self.resource_type = None
+        self.id = None
+        self.response = None
+        self.response_resource = None
+
+    @property
+    def failed(self):
+        return self.response is not None and 'outcome' in self.response
+
+    def resolve(self, references):
+        """
+        Resolve the request URL and resource references to created entries, and parse the target of the request
+        """
+        self.url = references.get(self.url, self.url)
+        if self.resource is not None:
+            resolve_references(self.resource, references)
+        match = TARGET_RE.search(self.url)
+        if not match:
+            raise BundleEntryError('Entry {}: The request URL {} is not a FHIR resource URL'.format(
+                self.index, self.url))
+        self.resource_type = match.group('type')
+        if self.method not in SUPPORTED_OPERATIONS.get(self.resource_type, []):
+            raise BundleEntryError('Entry {}: {} of {} resources is not supported'.format(
+                self.index, self.method, self.resource_type), status_code=405, issue_type='not-supported')
+        if self.method == 'POST':
+            if match.group('id'):
+                raise BundleEntryError('Entry {}: The request URL of a create must be the resource type'.format(
+                    self.index))
+            if not isinstance(self.resource, dict) or self.resource.get('resourceType') != self.resource_type:
+                raise BundleEntryError('Entry {}: The entry must include a {} resource'.format(
+                    self.index, self.resource_type))
+            return
+        if self.method == 'GET' and not match.group('id'):
+            raise BundleEntryError('Entry {}: Searches of {} resources are not supported in batch and transaction '
+                                   'Bundles, only reads of a resource id'.format(self.index, self.resource_type),
+                                   status_code=405, issue_type='not-supported')
+        try:
+            self.id = int(match.group('id'))
+        except (TypeError, ValueError):
+            raise BundleEntryError('Entry {}: The request URL must include the id of the {} resource'.format(
+                self.index, self.resource_type))
+        if self.method == 'PUT' and (not isinstance(self.resource, dict) or
+                                     self.resource.get('resourceType') != self.resource_type):
+            raise BundleEntryError('Entry {}: The entry must include a {} resource'.format(
+                self.index, self.resource_type))
+
+    def fail(self, error):
+        self.response = {'status': response_status(error.status_code),
+                         'outcome': create_operation_outcome([
+                             {'severity': 'error', 'type': error.issue_type, 'diagnostics': str(error.args[0]),
+                              'details': str(error.args[0])}]).as_json()}
+
+    def as_json(self):
+        entry = OrderedDict()
+        if self.full_url:
+            entry['fullUrl'] = self.full_url
+        if self.response_resource is not None:
+            entry['resource'] = self.response_resource
+        entry['response'] = self.response
+        return entry
+
+
+class BundleTransaction(object):
+    """
+    Process a batch or transaction Bundle, see the module docstring
+    """
+
+    def __init__(self, bundle):
+        """
+        :param bundle:
+            dict of FHIR Bundle JSON.  ValidationError is raised when it is not a batch or transaction Bundle.
+        """
+        if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+            raise ValidationError('The request body must be a FHIR Bundle')
+        if bundle.get('type') not in BUNDLE_RESPONSE_TYPES:
+            raise ValidationError('The Bundle type must be one of: {}'.format(', '.join(BUNDLE_RESPONSE_TYPES)))
+        self.type = bundle['type']
+        self.entries = [BundleEntry(index, entry) for index, entry in enumerate(bundle.get('entry') or [])]
+        # URLs of created resources, by the fullUrl of their entries
+        self.references = {}
+
+    @property
+    def is_transaction(self):
+        return self.type == 'transaction'
+
+    @property
+    def writes(self):
+        return any(entry.method in ('POST', 'PUT', 'DELETE') for entry in self.entries)
+
+    def fail(self, entry, error):
+        """
+        Fail an entry:  a transaction fails as a whole, a batch entry gets an OperationOutcome
+        """
+        if self.is_transaction:
+            raise error
+        entry.fail(error)
+
+    def run(self):
+        """
+        Process the entries in one database transaction
+        :return:
+            dict of the response Bundle JSON
+        """
+        try:
+            for entry in self.entries:
+                if entry.method not in OPERATION_ORDER:
+                    self.fail(entry, BundleEntryError('Entry {}: The request method must be one of: {}'.format(
+                        entry.index, ', '.join(OPERATION_ORDER))))
+            for method in OPERATION_ORDER:
+                entries = []
+                for entry in self.entries:
+                    if entry.method != method:
+                        continue
+                    try:
+                        entry.resolve(self.references)
+                        entries.append(entry)
+                    except BundleEntryError as e:
+                        self.fail(entry, e)
+                if entries:
+                    getattr(self, 'process_{}'.format(method.lower()))(entries)
+            db.session.flush()
+            self.set_validators([e for e in self.entries if e.method in ('POST', 'PUT') and not e.failed])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return OrderedDict([('resourceType', 'Bundle'), ('type', BUNDLE_RESPONSE_TYPES[self.type]),
+                            ('entry', [entry.as_json() for entry in self.entries])])
+
+    def load_targets(self, entries):
+        """
+        Load the patients targeted by entries with one query, and check their ifMatch preconditions with another
+        :return:
+            dict of Patient by id, of the entries that did not fail
+        """
+        ids = set(entry.id for entry in entries)
+        patients = {pt.id: pt for pt in Patient.query.filter(Patient.id.in_(ids)).all()} if ids else {}
+        etags = {}
+        if any(entry.if_match for entry in entries):
+            etags = {pt_id: weak_etag(source_hash) for pt_id, source_hash in
+                     db.session.query(Patient.id, patient_source_hash()).filter(Patient.id.in_(ids)).all()}
+        for entry in entries:
+            if entry.id not in patients:
+                self.fail(entry, BundleEntryError('Entry {}: Patient {} was not found'.format(entry.index, entry.id),
+                                                  status_code=404, issue_type='not-found'))
+            elif entry.if_match and not etag_matches(etags.get(entry.id), entry.if_match, strong=True):
+                self.fail(entry, BundleEntryError('Entry {}: The ifMatch precondition failed for Patient {}'.format(
+                    entry.index, entry.id), status_code=412, issue_type='conflict'))
+        return patients
+
+    def process_delete(self, entries):
+        patients = self.load_targets(entries)
+        for entry in entries:
+            if not entry.failed and entry.id in patients:
+                pt = patients.pop(entry.id)
+                db.session.delete(pt)
+                entry.response = {'status': response_status(204)}
+            elif not entry.failed:
+                # The patient was deleted by an earlier entry of the Bundle
+                entry.response = {'status': response_status(204)}
+        db.session.flush()
+
+    def process_post(self, entries):
+        batch = []
+        for entry in entries:
+            try:
+                patient, children = parse_patient(entry.resource)
+            except (ValueError, TypeError, AttributeError, KeyError, IndexError) as e:
+                self.fail(entry, BundleEntryError('Entry {}: {}'.format(
+                    entry.index, e.args[0] if e.args else type(e).__name__)))
+                continue
+            # A urn:uuid fullUrl is kept as the identifier of a Patient created without one
+            identifiers = [i.get('system') for i in entry.resource.get('identifier') or []]
+            if UNKANI_IDENTIFIER_SYSTEM not in identifiers and str(entry.full_url or '').startswith('urn:uuid:'):
+                try:
+                    patient['uuid'] = uuid.UUID(entry.full_url[len('urn:uuid:'):])
+                except ValueError:
+                    pass
+            batch.append((entry, patient, children))
+        if not batch:
+            return
+        written = set(load_patients([(patient, children) for entry, patient, children in batch]))
+        for entry, patient, children in batch:
+            if patient['id'] not in written:
+                self.fail(entry, BundleEntryError('Entry {}: A Patient with the identifier {} already exists'.format(
+                    entry.index, patient['uuid']), status_code=409, issue_type='duplicate'))
+                continue
+            entry.id = patient['id']
+            location = 'Patient/{}'.format(entry.id)
+            entry.response = {'status': response_status(201), 'location': location}
+            if entry.full_url:
+                self.references[entry.full_url] = location
+
+    def process_put(self, entries):
+        patients = self.load_targets(entries)
+        entries = [entry for entry in entries if not entry.failed]
+        parsed = []
+        for entry in entries:
+            try:
+                parsed.append((entry,) + parse_patient(entry.resource))
+            except (ValueError, TypeError, AttributeError, KeyError, IndexError) as e:
+                self.fail(entry, BundleEntryError('Entry {}: {}'.format(
+                    entry.index, e.args[0] if e.args else type(e).__name__)))
+        ids = [entry.id for entry, patient, children in parsed]
+        existing = {}
+        for model in CHILD_KEY_COLUMNS:
+            for row in model.query.filter(model.patient_id.in_(ids)).all() if ids else []:
+                existing.setdefault((model, row.patient_id), []).append(row)
+
+        for entry, patient, children in parsed:
+            pt = patients[entry.id]
+            # The uuid identifies the patient, and is not changed by an update
+            for column in Patient.row_hash_columns:
+                setattr(pt, column, patient[column])
+            for model, rows in children.items():
+                self.update_children(pt, model, existing.get((model, pt.id), []), rows)
+            entry.response = {'status': response_status(200)}
+        db.session.flush()
+
+    @staticmethod
+    def update_children(pt, model, current, rows):
+        """
+        Update the child rows of a patient to the rows of an updated resource:  matching rows are updated in place,
+        new rows are added and rows missing from the resource are deleted
+        """
+        by_key = OrderedDict()
+        for obj in current:
+            by_key.setdefault(child_key(model, {c: getattr(obj, c) for c in CHILD_KEY_COLUMNS[model]}), obj)
+        for row in rows:
+            obj = by_key.pop(child_key(model, row), None)
+            if obj is None:
+                obj = model()
+                obj.patient_id = pt.id
+                db.session.add(obj)
+            for column in CHILD_UPDATE_COLUMNS[model]:
+                if column in row and column not in ('patient_id', 'user_id'):
+                    setattr(obj, column, row[column])
+        for obj in by_key.values():
+            db.session.delete(obj)
+
+    def process_get(self, entries):
+        patients = self.load_targets(entries)
+        found = [patients[entry.id] for entry in entries if not entry.failed and entry.id in patients]
+        Patient.prefetch_fhir(found)
+        stored = Patient.load_stored_fhir(found)
+        for entry in entries:
+            if entry.failed or entry.id not in patients:
+                continue
+            pt = patients[entry.id]
+            entry.response_resource = stored.get(pt.id) or pt.dump_fhir_json()
+            entry.response = {'status': response_status(200)}
+        self.set_validators([entry for entry in entries if not entry.failed])
+
+    @staticmethod
+    def set_validators(entries):
+        """
+        Set the etag and lastModified of entry responses, from one query over the patients of the entries
+        """
+        ids = set(entry.id for entry in entries if entry.id is not None)
+        if not ids:
+            return
+        rows = db.session.query(Patient.id, patient_source_hash(), patient_last_modified()) \
+            .filter(Patient.id.in_(ids)).all()
+        validators = {pt_id: (source_hash, last_modified) for pt_id, source_hash, last_modified in rows}
+        for entry in entries:
+            if entry.id in validators:
+                source_hash, last_modified = validators[entry.id]
+                entry.response['etag'] = weak_etag(source_hash)
+                entry.response['lastModified'] = fhir_datetime_json(value=last_modified, to_date=False)
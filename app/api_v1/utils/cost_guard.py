@@ -0,0 +1,134 @@
+import json
+import time
+from flask import current_app, request
+from app import db
+from app.api_v1.errors.exceptions import ForbiddenError, SearchCostError, ValidationError
+from app.api_v1.utils.explain import compile_query, explain_query
+from app.utils.general import json_serial
+from app.utils.type_validation import validate_bool
+
+
+def get_resource_setting(name, resource):
+    """
+    Read a per resource setting from the app config
+    :param name:
+        Config key of a dict of settings keyed by resource name, with a 'default' entry for other resources,
+        ex: SEARCH_STATEMENT_TIMEOUT
+    :param resource:
+        FHIR resource name, ex: 'Patient'
+    :return:
+        The resource's setting, the default setting or None
+    """
+    settings = current_app.config.get(name) or {}
+    return settings.get(resource, settings.get('default'))
+
+
+def set_statement_timeout(resource):
+    """
+    Limit the run time of every statement in the current transaction with PostgreSQL's statement_timeout.  SET LOCAL
+    only lasts until the transaction ends, so the timeout does not leak to other requests using the connection.
+    :param resource:
+        FHIR resource name used to look up SEARCH_STATEMENT_TIMEOUT
+    :return:
+        The timeout in milliseconds, or None when no timeout is configured
+    """
+    timeout = get_resource_setting('SEARCH_STATEMENT_TIMEOUT', resource)
+    if timeout:
+        db.session.connection().execute('SET LOCAL statement_timeout = {:d}'.format(int(timeout)))
+    return timeout or None
+
+
+def page_query(query):
+    """
+    Limit a search query to the rows fetched for the requested page, which is what create_bundle executes
+    """
+    per_page = request.args.get('_count', 10, type=int)
+    page = request.args.get('page', 1, type=int)
+    offset = 0 if '_cursor' in request.args else max(page - 1, 0) * max(per_page, 0)
+    return query.limit(max(per_page, 0) + 1).offset(offset)
+
+
+def check_search_cost(query, resource):
+    """
+    Run a pre-flight EXPLAIN of the page query and reject searches the planner expects to be too costly
+    :param query:
+        Un-executed SQLAlchemy search query
+    :param resource:
+        FHIR resource name used to look up SEARCH_MAX_PLAN_COST
+    :return:
+        The planner's total cost estimate, or None when no threshold is configured.  SearchCostError is raised when
+        the estimate is above the threshold.
+    """
+    max_cost = get_resource_setting('SEARCH_MAX_PLAN_COST', resource)
+    if max_cost is None:
+        return None
+    cost = explain_query(page_query(query))['Plan']['Total Cost']
+    if cost > max_cost:
+        raise SearchCostError('The estimated cost of this {} search ({:.0f}) is above the allowed limit ({}).  Use '
+                              'more selective parameters, such as a starts with match instead of :contains, or '
+                              'request a smaller _count.'.format(resource, cost, max_cost))
+    return cost
+
+
+def explain_requested():
+    try:
+        return validate_bool(value=request.args.get('_explain', 'false'), error=True)
+    except ValueError:
+        raise ValidationError('The value supplied for the _explain parameter must be true or false')
+
+
+def explain_search(query, resource, compile_ms=None):
+    """
+    Run the page query with EXPLAIN ANALYZE and describe it for debugging
+    :param query:
+        Un-executed SQLAlchemy search query
+    :param resource:
+        FHIR resource name
+    :param compile_ms:
+        Milliseconds spent parsing the request args and building the query
+    :return:
+        dict with the generated SQL, its bound parameters, the PostgreSQL plan and timings
+    """
+    page = page_query(query)
+    sql, params = compile_query(page)
+    started = time.time()
+    plan = explain_query(page, analyze=True)
+    explain_ms = (time.time() - started) * 1000
+    return {'resource': resource,
+            'sql': sql,
+            'parameters': json.loads(json.dumps(params, default=json_serial)),
+            'plan': plan,
+            'statement_timeout_ms': get_resource_setting('SEARCH_STATEMENT_TIMEOUT', resource),
+            'max_plan_cost': get_resource_setting('SEARCH_MAX_PLAN_COST', resource),
+            'timing': {'compile_ms': round(compile_ms, 3) if compile_ms is not None else None,
+                       'planning_ms': plan.get('Planning Time'),
+                       'execution_ms': plan.get('Execution Time'),
+                       'explain_ms': round(explain_ms, 3)}}
+
+
+def guard_search(support, resource, query, explain_permission):
+    """
+    Apply a search with cost controls:  the search runs under the resource's statement_timeout, and is rejected up
+    front when its planner cost estimate is above the resource's SEARCH_MAX_PLAN_COST.
+    :param support:
+        The resource's SearchSupport
+    :param resource:
+        FHIR resource name, ex: 'Patient'
+    :param query:
+        Un-executed SQLAlchemy base query
+    :param explain_permission:
+        flask_principal Permission required to use _explain=true, which returns the SQL, plan and timings of the
+        search instead of a bundle
+    :return:
+        Tuple of (query, plan, explain).  explain is None unless _explain=true was requested.
+    """
+    started = time.time()
+    query, plan = support.search(args=request.args, query=query)
+    compile_ms = (time.time() - started) * 1000
+    set_statement_timeout(resource)
+    if explain_requested():
+        if not explain_permission.can():
+            raise ForbiddenError('Insufficient permissions to explain {} searches'.format(resource))
+        return query, plan, explain_search(query=query, resource=resource, compile_ms=compile_ms)
+    check_search_cost(query=query, resource=resource)
+    return query, plan, None
@@ -1,32 +1,170 @@
 import functools
 import hashlib
+import json
+from collections import namedtuple
 from flask import request, make_response
+from sqlalchemy import func, select
+from werkzeug.http import http_date, parse_date
+from app import db
 from app.api_v1.errors.exceptions import NotModifiedError, PreconditionFailedError
 
+# A cheap validator of a response:  its ETag and Last-Modified datetime (naive UTC, or None)
+Validator = namedtuple('Validator', ['etag', 'last_modified'])
 
-def etag(f):
-    """This decorator adds an ETag header to the response."""
+
+def weak_etag(value):
+    """
+    Build a weak ETag from a version number or hash, ex: W/"3"
+    """
+    return 'W/"{}"'.format(value)
+
+
+def etag_matches(etag, header, strong=False):
+    """
+    Check an ETag against the list of an If-Match or If-None-Match header
+    :param etag:
+        ETag of the current representation, or None when there is none
+    :param header:
+        Value of the If-Match or If-None-Match header, ex: W/"3", W/"4"
+    :param strong:
+        With weak comparison (If-None-Match), the W/ prefix is ignored, so a FHIR version ETag W/"3" matches "3".
+        With strong comparison (If-Match), the tags must be identical, W/ prefix included, so a precondition on a
+        write is only met by the exact ETag the server sent.
+    :return:
+        True when the header is * or lists a matching ETag
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    if '*' in tags:
+        return True
+    if etag is None:
+        return False
+    if strong:
+        return etag in tags
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    return any((tag[2:] if tag.startswith('W/') else tag) == opaque for tag in tags)
+
+
+def conditional_request():
+    """
+    Check whether the request has any of the conditional headers answered by evaluate_preconditions
+    """
+    return any(request.headers.get(name) for name in ('If-Match', 'If-None-Match', 'If-Modified-Since'))
+
+
+def evaluate_preconditions(etag, last_modified=None):
+    """
+    Evaluate the conditional request headers against a response's validators
+    :param etag:
+        ETag of the current representation
+    :param last_modified:
+        Last modification datetime of the current representation, naive UTC, or None
+    :return:
+        None when the request should be answered normally.  PreconditionFailedError is raised when If-Match does not
+        match, NotModifiedError when If-None-Match matches, or when there is no If-None-Match and the representation
+        was not modified since If-Modified-Since.
+    """
+    if_match = request.headers.get('If-Match')
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_match:
+        if not etag_matches(etag, if_match, strong=True):
+            raise PreconditionFailedError
+    elif if_none_match:
+        if etag_matches(etag, if_none_match):
+            raise NotModifiedError
+    elif if_modified_since and last_modified:
+        since = parse_date(if_modified_since)
+        # HTTP dates have a precision of one second
+        if since and last_modified.replace(microsecond=0) <= since.replace(tzinfo=None):
+            raise NotModifiedError
+
+
+def etag(f=None, validator=None):
+    """
+    This decorator adds an ETag header to GET responses and answers conditional requests.
+
+    Used bare (@etag), the view runs and the ETag is the MD5 hash of the response body.
+
+    Used with a validator (@etag(validator=patient_read_validator)), the validator is called with the view's
+    arguments and returns a Validator from a lightweight query, or None when the view should run unconditionally
+    (ex: a missing resource, so the view can answer 404).  When the request has If-Match, If-None-Match or
+    If-Modified-Since, the validator is called before the view, and the request is answered with 412 or 304 without
+    running the view body.  A plain GET runs the view first, and only a 200 response calls the validator to set its
+    ETag and Last-Modified headers, so errors and rejected searches never pay for the validator query.
+    """
+    if f is None:
+        return functools.partial(etag, validator=validator)
 
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
         # only for HEAD and GET requests
         assert request.method in ['HEAD', 'GET'], \
             '@etag is only supported for GET requests'
+        if validator is not None and not conditional_request():
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200:
+                current = validator(*args, **kwargs)
+                if current is not None:
+                    rv.headers['Cache-Control'] = 'max-age=86400'
+                    rv.headers.extend(validator_headers(current))
+            return rv
+
+        if validator is not None:
+            current = validator(*args, **kwargs)
+            if current is not None:
+                try:
+                    evaluate_preconditions(etag=current.etag, last_modified=current.last_modified)
+                except NotModifiedError as e:
+                    e.headers = validator_headers(current)
+                    raise
+                rv = make_response(f(*args, **kwargs))
+                if rv.status_code == 200:
+                    rv.headers['Cache-Control'] = 'max-age=86400'
+                    rv.headers.extend(validator_headers(current))
+                return rv
+
         rv = f(*args, **kwargs)
         rv = make_response(rv)
         etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
         rv.headers['Cache-Control'] = 'max-age=86400'
         rv.headers['ETag'] = etag
-        if_match = request.headers.get('If-Match')
-        if_none_match = request.headers.get('If-None-Match')
-        if if_match:
-            etag_list = [tag.strip() for tag in if_match.split(',')]
-            if etag not in etag_list and '*' not in etag_list:
-                raise PreconditionFailedError
-        elif if_none_match:
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
-            if etag in etag_list or '*' in etag_list:
-                raise NotModifiedError
+        evaluate_preconditions(etag=etag)
         return rv
 
     return wrapped
+
+
+def validator_headers(current):
+    headers = {'ETag': current.etag}
+    if current.last_modified:
+        headers['Last-Modified'] = http_date(current.last_modified)
+    return headers
+
+
+def search_validator(query, model, related=(), extra=None):
+    """
+    Build the Validator of a search from one aggregate query over the matched rows, instead of running the search
+    :param query:
+        Un-executed SQLAlchemy search query whose first entity is model
+    :param model:
+        The searched SQLAlchemy ORM model
+    :param related:
+        Tuples of (model, foreign key column) of child rows rendered into the resources,
+        ex: [(Address, Address.patient_id)]
+    :param extra:
+        Additional JSON serializable values the response depends on, ex: the request args
+    :return:
+        Validator whose ETag hashes the count and max updated_at of the matched rows and of their child rows,
+        and whose Last-Modified is the latest of those updated_at values
+    """
+    matched = query.with_entities(model.id).order_by(None).subquery()
+    columns = [func.count(model.id), func.max(model.updated_at)]
+    for child, foreign_key in related:
+        in_matched = foreign_key.in_(select([matched.c.id]))
+        columns.append(select([func.count(child.id)]).where(in_matched).as_scalar())
+        columns.append(select([func.max(child.updated_at)]).where(in_matched).as_scalar())
+    row = db.session.query(*columns).filter(model.id.in_(select([matched.c.id]))).one()
+
+    latest = [value for value in row[1::2] if value is not None]
+    digest = hashlib.md5(json.dumps([extra, [str(value) for value in row]], sort_keys=True).encode('utf-8'))
+    return Validator(etag=weak_etag(digest.hexdigest()), last_modified=max(latest) if latest else None)
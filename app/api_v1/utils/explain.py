@@ -0,0 +1,56 @@
+import json
+from app import db
+
+
+def compile_query(query):
+    """
+    Compile an un-executed SQLAlchemy query for the database dialect in use
+    :param query:
+        Un-executed SQLAlchemy query
+    :return:
+        Tuple of (sql, params) where sql is the DBAPI statement string and params the dict of bound values
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    return str(compiled), compiled.params
+
+
+def explain_query(query, analyze=False):
+    """
+    Run EXPLAIN (FORMAT JSON) for a query on the current session's connection
+    :param query:
+        Un-executed SQLAlchemy query
+    :param analyze:
+        When True, the query is executed with EXPLAIN ANALYZE and actual row counts and timings are reported
+    :return:
+        The top level plan dict returned by PostgreSQL, ex: {'Plan': {'Node Type': ..., 'Plan Rows': ...}, ...}
+    """
+    sql, params = compile_query(query)
+    options = 'FORMAT JSON, ANALYZE, BUFFERS' if analyze else 'FORMAT JSON'
+    result = db.session.connection().execute('EXPLAIN ({}) {}'.format(options, sql), params).scalar()
+    # psycopg2 decodes json columns, but fall back to parsing the raw string
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]
+
+
+def estimate_query_rows(query):
+    """
+    Estimate the number of rows a query will return without executing it.
+    Unfiltered queries on a single table use the table statistics in pg_class.reltuples.  Everything else uses the
+    row estimate of the PostgreSQL planner.
+    :param query:
+        Un-executed SQLAlchemy query
+    :return:
+        Estimated number of rows as an int
+    """
+    base = query.column_descriptions[0]['entity']
+    table = getattr(base, '__table__', None)
+    froms = query.statement.froms
+    if table is not None and query.whereclause is None and len(froms) == 1 and froms[0] is table:
+        reltuples = db.session.connection().execute('SELECT reltuples FROM pg_class WHERE oid = %(t)s::regclass',
+                                                    {'t': table.name}).scalar()
+        # reltuples is -1 (or 0 on older releases) for tables that have never been vacuumed or analyzed
+        if reltuples and reltuples > 0:
+            return int(reltuples)
+    plan = explain_query(query)
+    return int(plan['Plan']['Plan Rows'])
@@ -1,4 +1,5 @@
-from flask import request, jsonify, url_for
+from flask import request, url_for
+from app.utils.json_backend import jsonify
 from app.api_v1.errors.exceptions import *
 
 filter_ops = {'eq': '__eq__',  # equal
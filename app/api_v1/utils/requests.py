@@ -1,5 +1,6 @@
 import functools
-from flask import request, jsonify, current_app
+from flask import request, current_app
+from app.utils.json_backend import jsonify
 from app.api_v1.utils.operation_outcome import create_operation_outcome
 
 
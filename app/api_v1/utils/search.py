@@ -1,8 +1,12 @@
-from flask import request
+from collections import OrderedDict
+from datetime import time, timedelta
+from werkzeug.datastructures import MultiDict
 import unidecode
 from app.api_v1.errors.exceptions import *
 from app.utils.type_validation import *
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, func, inspect, select
+from app.utils.general import LRUCache, fold_search_key
+from app.models.fhir.codesets import subsumption_codes
 
 # Dict of valid FHIR STU 3 ordered search value prefixes and their SQLAlchemy column operator equivalent
 fhir_prefixes = {'eq': '__eq__',  # equal
@@ -20,7 +24,38 @@ fhir_modifiers = {'contains': 'ilike',
                   'not-in': 'notin_',
                   'exact': '__eq__',
                   'not': '__ne__',
-                  'missing': None}  # TODO: Handle :text
+                  'missing': None,
+                  'text': None}
+
+# Request parameters that are handled by the bundle and pagination helpers rather than the search itself
+non_search_params = frozenset(['page', '_count', '_cursor', '_total', '_format', '_summary', '_elements',
+                               '_explain'])
+
+# Parameters that add related resources to a searchset bundle
+include_params = frozenset(['_include', '_revinclude'])
+
+# Kinds of chained search declared in a chain support dict:  forward chains (reference.parameter) and reverse
+# chains (_has:Type:reference:parameter)
+chain_kinds = frozenset(['chain', '_has'])
+
+# Token modifiers compiled into IN predicates on the concept closure of the parameter's code system
+subsumption_modifiers = frozenset(['below', 'above'])
+
+# Search parameter types whose values may start with one of the fhir_prefixes
+ordered_types = frozenset(['date', 'datetime', 'timestamp', 'numeric'])
+
+# Search parameter types whose values are matched as ranges of time
+date_types = frozenset(['date', 'datetime', 'timestamp'])
+
+# The bounds each date prefix places on a column, given the search value's range [start, end):  lower <= col < upper
+date_prefix_bounds = {'eq': ('start', 'end'),
+                      'ge': ('start', None),
+                      'gt': ('end', None),
+                      'le': (None, 'end'),
+                      'lt': (None, 'start')}
+
+# Maximum number of compiled search plans kept per resource
+SEARCH_PLAN_CACHE_SIZE = 256
 
 
 def search_support_is_valid(support):
@@ -73,6 +108,824 @@ def search_support_is_valid(support):
     return True
 
 
+def escape_like(value, escape='\\'):
+    """
+    Escape the LIKE wildcard characters in a search value so they are matched literally.  Backslash is the default
+    LIKE escape character in PostgreSQL.
+    """
+    return value.replace(escape, escape + escape).replace('%', escape + '%').replace('_', escape + '_')
+
+
+def find_relationship(base, model):
+    """
+    Find the relationship attribute on a base model that links it to a related model
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param model:
+        A related SQLAlchemy ORM model, ex: Address for Patient
+    :return:
+        The relationship attribute, ex: Patient.addresses.  ValueError is raised if there is none.
+    """
+    for relationship in inspect(base).relationships:
+        if relationship.mapper.class_ is model:
+            return getattr(base, relationship.key)
+    raise ValueError('Invalid model search support: {} has no relationship to {}'.format(base.__name__,
+                                                                                        model.__name__))
+
+
+def semijoin(relationship, criteria):
+    """
+    Filter a base model on criteria that apply to a related model, as a correlated EXISTS subquery.  Unlike a join,
+    the base rows are not duplicated when more than one related row matches.
+    :param relationship:
+        Relationship attribute on the base model, ex: Patient.phone_numbers
+    :param criteria:
+        List of filter criteria on the related model.  All must hold for the same related row.
+    :return:
+        SQLAlchemy filter criterion
+    """
+    if relationship.property.uselist:
+        return relationship.any(and_(*criteria))
+    return relationship.has(and_(*criteria))
+
+
+def sort_expression(base, sort):
+    """
+    The SQL expression a search is sorted on.  A column of a related model is sorted on the lowest (ascending) or
+    highest (descending) value among the base row's related rows, with a correlated scalar subquery.  Unlike a join,
+    each base row is returned once, and base rows without related rows are kept, with a NULL sort key.
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :param sort:
+        The _sort entry of a fhir_search_spec, ex: {'op': 'asc', 'model': Address, 'column': ['city']}
+    :return:
+        SQLAlchemy column expression
+    """
+    model = sort.get('model')
+    column = getattr(model, sort.get('column')[0])
+    if model is base:
+        return column
+    relationship = find_relationship(base=base, model=model)
+    aggregate = func.max(column) if sort.get('op') == 'desc' else func.min(column)
+    correlation = [remote == local for local, remote in relationship.property.local_remote_pairs]
+    return select([aggregate]).where(and_(*correlation)).correlate(base).as_scalar()
+
+
+def sort_order(expression, direction):
+    """
+    Order by a sort expression with PostgreSQL's NULL placement made explicit:  NULL sort keys are last in ascending
+    order and first in descending order, as keyset pagination expects
+    """
+    if direction == 'desc':
+        return expression.desc().nullsfirst()
+    return expression.asc().nullslast()
+
+
+def default_search_support(base):
+    """
+    Search parameters that are supported by every FHIR resource endpoint
+    :param base:
+        The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+    :return:
+        Search support dict in the format validated by search_support_is_valid
+    """
+    return {'_id': {'modifier': ['exact', 'not'],
+                    'prefix': [],
+                    'model': base,
+                    'column': ['id'],
+                    'type': 'int'},
+            '_lastUpdated': {'modifier': [],
+                             'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
+                             'model': base,
+                             'column': ['updated_at'],
+                             'type': 'datetime'}
+            }
+
+
+class SearchParameter(object):
+    """
+    One entry of a search support dict, with its columns resolved to SQLAlchemy model attributes
+    """
+
+    def __init__(self, name, support):
+        self.name = name
+        self.model = support.get('model')
+        self.type = support.get('type')
+        self.modifiers = frozenset(support.get('modifier'))
+        self.prefixes = frozenset(support.get('prefix'))
+        column_support = support.get('column')
+        try:
+            # Token parameters may map a code system to each column, ex: {'http://hl7.org/fhir/sid/us-ssn': 'ssn'}
+            if isinstance(column_support, dict):
+                self.column_names = list(column_support.values())
+                self.systems = {system: getattr(self.model, column) for system, column in column_support.items()}
+                self.system_columns = dict(column_support)
+            else:
+                self.column_names = list(column_support)
+                self.systems = {}
+                self.system_columns = {}
+            self.columns = [getattr(self.model, column) for column in self.column_names]
+            # Folded shadow columns declared by the model in its search_keys dict, or None where a column has none
+            search_keys = getattr(self.model, 'search_keys', {})
+            self.key_columns = [getattr(self.model, search_keys[column]) if column in search_keys else None
+                                for column in self.column_names]
+        except AttributeError:
+            raise ValueError('Invalid model search support: unknown column for parameter {}'.format(name))
+
+
+class SearchPlanStep(object):
+    """
+    A compiled filter for one search parameter.  The column attributes, operator, modifier and prefix are fixed at
+    compile time, so only the value of the parameter needs to be parsed when the step is bound to a request.
+    """
+
+    def __init__(self, param, arg, op, modifier=None, prefix=None, system=None, index=0):
+        self.param = param
+        self.name = param.name
+        self.model = param.model
+        self.arg = arg
+        self.index = index
+        self.op = op
+        self.modifier = modifier
+        self.prefix = prefix
+        self.system = system
+        if system:
+            self.columns = [param.systems[system]]
+            self.column_names = [param.system_columns[system]]
+            self.key_columns = [None]
+        else:
+            self.columns = param.columns
+            self.column_names = param.column_names
+            self.key_columns = param.key_columns
+
+    def bind(self, args):
+        """
+        Parse the raw request value for the parameter
+        :param args:
+            The request.args associated with the FHIR API request.  Repeated parameters are bound by position.
+        :return:
+            Tuple of (op, value) where op is the SQLAlchemy column operator to apply with the value
+        """
+        name = self.param.name
+        values = args.getlist(self.arg)
+        input_value = values[self.index] if len(values) > self.index else None
+        if not input_value:
+            raise ValidationError('No value was supplied with parameter {}'.format(name))
+
+        # Handle special syntax for :missing param which checks for Null / Not Null
+        if self.modifier == 'missing':
+            try:
+                missing = validate_bool(value=input_value, error=True)
+            except ValueError:
+                raise ValidationError(
+                    'The value for parameter ({}) with modifier (missing) was ({}) and could not be validated as a '
+                    'boolean input for the search'.format(name, input_value))
+            return ('is_' if missing else 'isnot'), None
+
+        if self.prefix:
+            input_value = input_value[2:]
+
+        param_type = self.param.type
+        if param_type == 'bool':
+            try:
+                value = validate_bool(value=input_value, error=True)
+            except ValueError:
+                raise ValidationError(
+                    'The value for parameter ({}) was ({}) and could not be validated as a boolean input for the '
+                    'search'.format(name, input_value))
+
+        elif param_type == 'string':
+            value = unidecode.unidecode(input_value)  # Handle accents per FHIR
+            # ILIKE patterns with a leading wildcard are served by the pg_trgm GIN indexes
+            if self.op == 'key_prefix':  # Starts with comparison on the folded search key columns
+                key = fold_search_key(value)
+                if not key:
+                    raise ValidationError('The value for parameter ({}) was ({}) and has no letters or digits to '
+                                          'search for'.format(name, input_value))
+                # Columns without a folded key column are matched with the unfolded value
+                value = (escape_like(key) + '%', escape_like(value) + '%')
+            elif self.modifier == 'contains':
+                value = '%' + escape_like(value) + '%'
+            elif self.op == 'ilike':  # Strings without a modifier are a case-insensitive starts with comparison
+                value = escape_like(value) + '%'
+
+        elif param_type == 'token':
+            # The system, if any, was resolved to a column when the plan was compiled
+            if self.system is not None:
+                value = input_value.split('|', 1)[-1].strip() or None
+            else:
+                value = input_value.lstrip('|')
+
+        else:
+            value = input_value
+
+        if self.op in ('in_', 'notin_') and isinstance(value, str):
+            value = [v.strip() for v in value.split(',')]
+        return self.op, value
+
+    def criterion(self, op, value):
+        """
+        Build the SQLAlchemy filter criterion for a bound value.  Parameters that map to more than one column apply
+        the operator to each column with OR logic between them.
+        """
+        if op == 'key_prefix':
+            # Case-sensitive LIKE on a folded key column is an index range scan with text_pattern_ops.  The value is
+            # a (folded pattern, unfolded pattern) pair, see bind.
+            key_value, raw_value = value
+            filters = [key_column.like(key_value) if key_column is not None else column.ilike(raw_value)
+                       for column, key_column in zip(self.columns, self.key_columns)]
+        elif op == 'text':
+            # pg_trgm similarity operator, escaped for the psycopg2 paramstyle.  Served by the trigram indexes.
+            filters = [column.op('%%')(value) for column in self.columns]
+        elif op in subsumption_modifiers:
+            # IN the codes of the concept closure of the system, a range scan of one of its indexes
+            filters = [column.in_(subsumption_codes(system=self.system, code=value, modifier=op))
+                       for column in self.columns]
+        else:
+            filters = [getattr(column, op)(value) for column in self.columns]
+        if len(filters) == 1:
+            return filters[0]
+        return or_(*filters)
+
+    def score(self, value):
+        """
+        Relevance of a row to a :text search value, from 0 to 1, using pg_trgm similarity of the best matching column
+        """
+        scores = [func.similarity(column, value) for column in self.columns]
+        if len(scores) == 1:
+            return scores[0]
+        return func.greatest(*scores)
+
+
+class DateSearchStep(object):
+    """
+    A compiled filter for every value of a date, datetime or timestamp search parameter.  Each value is expanded to
+    the half-open range of time covered by its precision, and repeated parameters are intersected, so
+    birthdate=ge1980&birthdate=lt1990 becomes the single range predicate dob >= 1980-01-01 AND dob < 1990-01-01
+    that can be answered from an index on the column.
+    """
+
+    def __init__(self, param, arg, prefixes):
+        self.param = param
+        self.name = param.name
+        self.model = param.model
+        self.arg = arg
+        self.op = 'range'
+        self.modifier = None
+        self.prefixes = prefixes
+        self.columns = param.columns
+        self.column_names = param.column_names
+
+    def bind(self, args):
+        """
+        Parse every value of the parameter and intersect their ranges
+        :param args:
+            The request.args associated with the FHIR API request
+        :return:
+            Tuple of (op, value) where value is a dict of {'lower': ..., 'upper': ..., 'excluded': [(start, end)]}
+        """
+        name = self.param.name
+        lower = None
+        upper = None
+        excluded = []
+        for prefix, input_value in zip(self.prefixes, args.getlist(self.arg)):
+            if prefix:
+                input_value = input_value[2:]
+            if not input_value:
+                raise ValidationError('No value was supplied with parameter {}'.format(name))
+            try:
+                start, end = parse_fhir_date_range(input_value)
+            except DatetimeParseError:
+                raise ValidationError(
+                    'The value for parameter ({}) was ({}) and could not be validated as a datetime input for the '
+                    'search'.format(name, input_value))
+            # Date columns hold whole days, so widen the range to the days it touches
+            if self.param.type == 'date':
+                start = start.date()
+                end = end.date() if end.time() == time() else end.date() + timedelta(days=1)
+
+            if prefix == 'ne':
+                excluded.append((start, end))
+                continue
+            bounds = {'start': start, 'end': end}
+            low, high = date_prefix_bounds[prefix or 'eq']
+            if low:
+                lower = bounds[low] if lower is None else max(lower, bounds[low])
+            if high:
+                upper = bounds[high] if upper is None else min(upper, bounds[high])
+        return self.op, {'lower': lower, 'upper': upper, 'excluded': excluded}
+
+    def criterion(self, op, value):
+        filters = []
+        for column in self.columns:
+            clauses = []
+            if value['lower'] is not None:
+                clauses.append(column >= value['lower'])
+            if value['upper'] is not None:
+                clauses.append(column < value['upper'])
+            for start, end in value['excluded']:
+                clauses.append(or_(column < start, column >= end))
+            filters.append(and_(*clauses))
+        if len(filters) == 1:
+            return filters[0]
+        return or_(*filters)
+
+
+class ChainedSearchStep(object):
+    """
+    A compiled filter on a parameter of another resource, reached through a declared chain.  The target resource's
+    compiled steps are applied inside one correlated EXISTS subquery on the chain's relationship, so the search
+    stays a single SQL statement.
+    """
+
+    def __init__(self, chain, arg, target_arg, plan):
+        """
+        :param chain:
+            The SearchChain the parameter was declared with
+        :param arg:
+            The request arg, ex: 'partof.name:contains' or '_has:Organization:partof:name'
+        :param target_arg:
+            The arg in terms of the target resource, ex: 'name:contains'
+        :param plan:
+            SearchPlan compiled by the target resource's SearchSupport for target_arg
+        """
+        self.chain = chain
+        self.name = arg
+        self.model = chain.base
+        self.arg = arg
+        self.target_arg = target_arg
+        self.plan = plan
+        self.op = 'chain'
+        self.modifier = None
+        self.column_names = [name for step in plan.steps for name in step.column_names]
+
+    def bind(self, args):
+        """
+        Bind the values of the request arg to the target resource's steps
+        :return:
+            Tuple of (op, value) where value is the list of (step, op, value) tuples of the target plan
+        """
+        target_args = MultiDict([(self.target_arg, value) for value in args.getlist(self.arg)])
+        return self.op, self.plan.bind(target_args)
+
+    def criterion(self, op, value):
+        criteria = self.plan.filters(value)[0]
+        return semijoin(self.chain.relationship, criteria)
+
+
+class SearchChain(object):
+    """
+    A chained search declared by a resource:  a relationship from the base model to a target model, and the search
+    support of the target.  Only declared chains may be searched, and chains are one level deep, so every chained
+    search is a single correlated subquery on an indexed foreign key.
+    """
+
+    def __init__(self, base, name, relationship, support):
+        """
+        :param base:
+            The SQLAlchemy ORM model of the resource the chain starts from
+        :param name:
+            The chain as it appears in request args, ex: 'partof' or 'Organization:partof'
+        :param relationship:
+            Relationship attribute on the base model that links it to the target, ex: Organization.parent
+        :param support:
+            A model support dict or SearchSupport for the target model
+        """
+        if getattr(relationship, 'class_', None) is not base or \
+                not hasattr(getattr(relationship, 'property', None), 'mapper'):
+            raise ValueError('Invalid chain support: {} is not a relationship of {}'.format(name, base.__name__))
+        self.base = base
+        self.name = name
+        self.relationship = relationship
+        self.target = relationship.property.mapper.class_
+        if not isinstance(support, SearchSupport):
+            support = SearchSupport(base=self.target, model_support=support)
+        if support.base is not self.target:
+            raise ValueError('Invalid chain support: the search support for {} is not for {}'
+                             .format(name, self.target.__name__))
+        self.support = support
+
+
+class SearchPlan(object):
+    """
+    A compiled search for one shape of query string.  Holds the bound column operators, related model semijoins and
+    sort needed to turn request args of that shape into an un-executed SQLAlchemy query.
+    """
+
+    def __init__(self, base, steps, sort=None, relationships=None, includes=None, warnings=None):
+        self.base = base
+        self.steps = steps
+        # Relationship attributes whose related objects are added to the bundle by _include and _revinclude
+        self.includes = includes or []
+        # Messages about the search returned in an OperationOutcome entry, ex: _revinclude values of data types
+        self.warnings = warnings or []
+        # Relationship attributes used to filter on related models, keyed by model
+        self.relationships = relationships or {}
+        # The _sort entry in the fhir_search_spec format, as used by create_bundle
+        self.sort = sort
+        self.order_by = None
+        if sort:
+            self.order_by = sort_order(sort_expression(base=base, sort=sort), sort.get('op'))
+        # Plans with :text parameters rank their results by similarity
+        self.ranked = any(step.op == 'text' for step in steps)
+
+    def bind(self, args):
+        """
+        Bind the values of the request args to the compiled steps
+        :return:
+            List of (step, op, value) tuples
+        """
+        bound = []
+        for step in self.steps:
+            op, value = step.bind(args)
+            bound.append((step, op, value))
+        return bound
+
+    def filters(self, bound):
+        """
+        Build the filter criteria of bound steps.  Criteria on related models are merged into one EXISTS subquery
+        per model.
+        :param bound:
+            List of (step, op, value) tuples returned by bind
+        :return:
+            Tuple of (criteria, scores):  the list of criteria to AND together on the base model and the
+            similarity scores of :text steps
+        """
+        criteria = []
+        scores = []
+        related_criteria = OrderedDict()
+        for step, op, value in bound:
+            criterion = step.criterion(op, value)
+            if step.model is self.base:
+                criteria.append(criterion)
+            else:
+                related_criteria.setdefault(step.model, []).append(criterion)
+            if op == 'text':
+                scores.append(step.score(value))
+        for model, related in related_criteria.items():
+            criteria.append(semijoin(self.relationships[model], related))
+        return criteria, scores
+
+    def apply(self, args, query=None):
+        """
+        Apply the plan to a query
+        :param args:
+            The request.args associated with the FHIR API request.  Must have the shape the plan was compiled for.
+        :param query:
+            Un-executed SQLAlchemy query object.  Will be initialized to base.query if missing
+        :return:
+            Un-executed SQLAlchemy query with filtering and sorting applied.  Ranked plans add a 'search_score'
+            column to the query and, unless _sort was supplied, order the results by it.
+        """
+        if query is None:
+            query = self.base.query
+        criteria, scores = self.filters(self.bind(args))
+        for criterion in criteria:
+            query = query.filter(criterion)
+        if scores:
+            score = scores[0] if len(scores) == 1 else func.greatest(*scores)
+            query = query.add_columns(score.label('search_score'))
+            if self.order_by is None:
+                query = query.order_by(score.desc(), self.base.id)
+        if self.order_by is not None:
+            query = query.order_by(self.order_by)
+        return query
+
+    def spec(self, args):
+        """
+        Return the bound plan in the fhir_search_spec dict format produced by parse_fhir_search.  Each entry also
+        holds the filter 'criterion' built by the plan.  Criteria of repeated parameters are combined with AND.
+        """
+        fhir_search_spec = {}
+        for step, op, value in self.bind(args):
+            criterion = step.criterion(op, value)
+            previous = fhir_search_spec.get(step.name)
+            if previous:
+                criterion = and_(previous['criterion'], criterion)
+            fhir_search_spec[step.name] = {'op': op,
+                                           'value': value,
+                                           'model': step.model,
+                                           'column': step.column_names,
+                                           'criterion': criterion}
+        if self.sort:
+            fhir_search_spec['_sort'] = self.sort
+        return fhir_search_spec
+
+
+class SearchSupport(object):
+    """
+    The search parameters supported by a FHIR resource endpoint.  The support dict is validated and merged with the
+    default parameters once, when the resource module is imported.  Search plans are compiled per query string shape
+    (parameter names, modifiers, prefixes and token systems, but not values) and kept in a bounded LRU cache, so a
+    repeated search only has to bind its values.
+    """
+
+    def __init__(self, base, model_support=None, include_support=None, chain_support=None,
+                 cache_size=SEARCH_PLAN_CACHE_SIZE):
+        """
+        :param base:
+            The SQLAlchemy ORM model to which the FHIR Resource endpoint relates
+        :param model_support:
+            A dictionary that expresses which attributes related to the FHIR Resource may be used in search
+            parameters.  See parse_fhir_search for the format.
+        :param include_support:
+            A dictionary of the _include and _revinclude values supported by the endpoint, mapping each value to
+            the relationship attribute(s) on the base model that load the related objects.  Only FHIR resources can
+            be bundle entries, so a value of a data type maps to the name of the element of the base resource that
+            holds its data instead, and adds an OperationOutcome warning to the bundle.
+            Ex: {'_include': {}, '_revinclude': {'Address:patient': 'address'}}
+        :param chain_support:
+            A dictionary of the chained ('chain') and reverse chained ('_has') searches supported by the endpoint,
+            mapping each reference to the relationship attribute on the base model and the search support of the
+            target model.
+            Ex: {'chain': {'partof': (Organization.parent, organization_model_support)},
+                 '_has': {'Organization:partof': (Organization.children, organization_model_support)}}
+        :param cache_size:
+            Maximum number of compiled plans to keep
+        """
+        if model_support and not search_support_is_valid(support=model_support):
+            raise ValueError('Invalid model search support')
+        support = default_search_support(base)
+        support.update(model_support or {})
+        self.base = base
+        self.params = {name: SearchParameter(name=name, support=support[name]) for name in support}
+        self.relationships = {}
+        for param in self.params.values():
+            if param.model is not base and param.model not in self.relationships:
+                self.relationships[param.model] = find_relationship(base=base, model=param.model)
+        self.includes = {}
+        for name, values in (include_support or {}).items():
+            if name not in include_params:
+                raise ValueError('Invalid include support: unknown parameter {}'.format(name))
+            self.includes[name] = {}
+            for value, relationships in values.items():
+                if isinstance(relationships, str):
+                    self.includes[name][value] = relationships
+                    continue
+                if not isinstance(relationships, (list, tuple)):
+                    relationships = [relationships]
+                for relationship in relationships:
+                    if getattr(relationship, 'class_', None) is not base or \
+                            not hasattr(getattr(relationship, 'property', None), 'mapper'):
+                        raise ValueError('Invalid include support: {} is not a relationship of {}'
+                                         .format(value, base.__name__))
+                self.includes[name][value] = list(relationships)
+        self.chains = {kind: {} for kind in chain_kinds}
+        for kind, chains in (chain_support or {}).items():
+            if kind not in chain_kinds:
+                raise ValueError('Invalid chain support: unknown kind {}'.format(kind))
+            for name, (relationship, support) in chains.items():
+                self.chains[kind][name] = SearchChain(base=base, name=name, relationship=relationship,
+                                                      support=support)
+        self.plans = LRUCache(maxsize=cache_size)
+
+    def parse_chain(self, arg):
+        """
+        Split a chained (reference.parameter) or reverse chained (_has:Type:reference:parameter) request arg
+        :param arg:
+            A request arg, ex: 'partof.name:contains', 'partof:Organization.name' or '_has:Organization:partof:name'
+        :return:
+            Tuple of (SearchChain, target_arg), or (None, None) when the arg is not chained.  ValidationError is raised
+            for chains that are not supported by the resource.
+        """
+        if arg.startswith('_has:'):
+            parts = arg.split(':')
+            if len(parts) < 4 or not all(parts[1:4]):
+                raise ValidationError('The _has parameter must have the form _has:Type:reference:parameter')
+            chain = self.chains['_has'].get(':'.join(parts[1:3]))
+            target_arg = ':'.join(parts[3:])
+        elif '.' in arg:
+            reference, target_arg = arg.split('.', 1)
+            # A reference may name its target type, ex: partof:Organization.name
+            reference, _, target_type = reference.partition(':')
+            chain = self.chains['chain'].get(reference)
+            if chain is not None and target_type and target_type != chain.target.__name__:
+                chain = None
+        else:
+            return None, None
+        if chain is None:
+            raise ValidationError('The chained parameter ({}) is not supported for this resource'.format(arg))
+        if target_arg.startswith('_has') or '.' in target_arg:
+            raise ValidationError('Chained parameters may only be one level deep ({})'.format(arg))
+        if target_arg.split(':', 1)[0] not in chain.support.params:
+            raise ValidationError('An unknown parameter ({}) was passed to the search query'.format(arg))
+        return chain, target_arg
+
+    def search_shape(self, args):
+        """
+        Normalize request args to the hashable shape that a search plan is compiled for
+        :param args:
+            The request.args associated with the FHIR API request
+        :return:
+            Sorted tuple of (arg, hints) pairs, with one hint for each value of a repeated parameter.  The hint is
+            the value prefix for ordered types, the system for token types, the full value for _sort and ''
+            otherwise.
+        """
+        shape = []
+        for arg in args:
+            name = arg.split(':', 1)[0]
+            if name in non_search_params:
+                continue
+            if name == '_sort':
+                shape.append((arg, (args.get(arg) or '',)))
+                continue
+            if name in include_params:
+                shape.append((arg, tuple(sorted(set(args.getlist(arg))))))
+                continue
+            chain, target_arg = self.parse_chain(arg)
+            if chain is not None:
+                name = target_arg.split(':', 1)[0]
+                param = chain.support.params.get(name)
+            else:
+                param = self.params.get(name)
+            hints = []
+            for value in args.getlist(arg):
+                hint = ''
+                if param is not None and value:
+                    if param.type in ordered_types and value[0:2].lower() in fhir_prefixes:
+                        hint = value[0:2].lower()
+                    elif param.type == 'token' and '|' in value:
+                        if value.count('|') > 1:
+                            raise ValidationError(
+                                'The value for the token parameter {} included >1 (|) character'.format(name))
+                        hint = value.split('|', 1)[0].strip() + '|'
+                hints.append(hint)
+            shape.append((arg, tuple(hints)))
+        return tuple(sorted(shape))
+
+    def plan(self, args):
+        """
+        Return the compiled search plan for the shape of the request args, compiling it on a cache miss
+        """
+        shape = self.search_shape(args)
+        plan = self.plans.get(shape)
+        if plan is None:
+            plan = self.compile(shape)
+            self.plans.set(shape, plan)
+        return plan
+
+    def compile(self, shape):
+        """
+        Compile a search shape to a SearchPlan.  ValidationError is raised for unsupported parameters, modifiers,
+        prefixes and token systems.
+        """
+        steps = []
+        sort = None
+        includes = []
+        warnings = []
+        for arg, hints in shape:
+            ##############################################################
+            # FHIR Chained Parameters & Reverse Chaining (_has)
+            ##############################################################
+            chain, target_arg = self.parse_chain(arg)
+            if chain is not None:
+                plan = chain.support.compile(((target_arg, hints),))
+                if plan.ranked:
+                    raise ValidationError('The :text modifier is not supported on chained parameters ({})'
+                                          .format(arg))
+                steps.append(ChainedSearchStep(chain=chain, arg=arg, target_arg=target_arg, plan=plan))
+                continue
+
+            arg_split = arg.split(':', 1)
+            name = arg_split[0]
+            modifier = arg_split[1].lower().strip() if len(arg_split) > 1 else None
+
+            ##############################################################
+            # FHIR _include & _revinclude
+            ##############################################################
+            if name in include_params:
+                if modifier:
+                    raise ValidationError('The parameter ({}) does not support the modifier ({})'
+                                          .format(name, modifier))
+                for value in hints:
+                    relationships = self.includes.get(name, {}).get(value)
+                    if not relationships:
+                        raise ValidationError('The {} value ({}) is not supported for this resource'
+                                              .format(name, value))
+                    if isinstance(relationships, str):
+                        warnings.append('The {} value ({}) names a data type, not a resource.  Its data is in the '
+                                        '{} element of each {} entry.'.format(name, value, relationships,
+                                                                             self.base.__name__))
+                        continue
+                    # Compare by identity, == on a relationship attribute builds a SQL expression
+                    includes.extend(r for r in relationships if not any(r is i for i in includes))
+                continue
+
+            ##############################################################
+            # FHIR Sorting
+            ##############################################################
+            if name == '_sort':
+                if not hints[0]:
+                    raise ValidationError('No value was supplied with parameter {}'.format(name))
+                # Sort values prefaced with '-' indicate descending sort is requested
+                sort_type = 'asc'
+                sort_key = hints[0]
+                if sort_key[0:1] == '-':
+                    sort_type = 'desc'
+                    sort_key = sort_key[1:]
+                param = self.params.get(sort_key)
+                if param is None:
+                    raise ValidationError('The sort key ({}) is not supported for this resource'.format(sort_key))
+                sort = {'op': sort_type, 'model': param.model, 'column': param.column_names}
+                continue
+
+            param = self.params.get(name)
+            if param is None:
+                raise ValidationError('An unknown parameter ({}) was passed to the search query'.format(name))
+
+            ##############################################################
+            # FHIR Search Modifiers
+            ##############################################################
+            op = None
+            if modifier:
+                if modifier not in param.modifiers:
+                    raise ValidationError('The search parameter ({}) does not support the modifier ({})'
+                                          .format(name, modifier))
+                # Use the isnot SQLAlchemy operator for boolean value comparisons with :not modifier
+                if modifier == 'not' and param.type == 'bool':
+                    op = 'isnot'
+                # :text is a similarity-ranked (fuzzy) match on string parameters
+                elif modifier == 'text':
+                    if param.type != 'string':
+                        raise ValidationError('The search parameter ({}) does not support the modifier ({})'
+                                              .format(name, modifier))
+                    op = 'text'
+                # :below and :above match the codes a token subsumes, or is subsumed by, in its code system
+                elif modifier in subsumption_modifiers:
+                    if param.type != 'token' or not param.systems:
+                        raise ValidationError('The search parameter ({}) does not support the modifier ({})'
+                                              .format(name, modifier))
+                    op = modifier
+                else:
+                    op = fhir_modifiers.get(modifier)
+
+            ##############################################################
+            # FHIR Date Ranges
+            ##############################################################
+            if param.type in date_types and modifier != 'missing':
+                if modifier:
+                    raise ValidationError('The search parameter ({}) does not support the modifier ({})'
+                                          .format(name, modifier))
+                for hint in hints:
+                    if hint and hint not in param.prefixes:
+                        raise ValidationError('The search parameter ({}) does not support the prefix ({})'
+                                              .format(name, hint))
+                # All values of a repeated date parameter are intersected into one range predicate
+                steps.append(DateSearchStep(param=param, arg=arg, prefixes=tuple(h or None for h in hints)))
+                continue
+
+            ##############################################################
+            # FHIR Prefixes & Token Systems
+            ##############################################################
+            # Repeated parameters each get a step and are combined with AND
+            for index, hint in enumerate(hints):
+                value_op = op
+                prefix = None
+                system = None
+                if modifier != 'missing':
+                    if param.type in ordered_types and hint:
+                        if hint not in param.prefixes:
+                            raise ValidationError('The search parameter ({}) does not support the prefix ({})'
+                                                  .format(name, hint))
+                        prefix = hint
+                        value_op = fhir_prefixes.get(prefix)
+                    elif param.type == 'token' and hint:
+                        system = hint[:-1]
+                        if system not in param.systems:
+                            raise ValidationError('The search parameter ({}) does not support the system ({})'
+                                                  .format(name, system))
+                    elif value_op in subsumption_modifiers:
+                        # Codes without a system are subsumed in the parameter's only code system
+                        if len(param.systems) != 1:
+                            raise ValidationError('The value of the search parameter ({}) with modifier ({}) must '
+                                                  'have a system'.format(name, modifier))
+                        system = list(param.systems)[0]
+                    elif param.type == 'string' and not value_op:
+                        # Default starts with match, on the folded search key columns when the model has them
+                        if any(key_column is not None for key_column in param.key_columns):
+                            value_op = 'key_prefix'
+                        else:
+                            value_op = 'ilike'
+
+                    # Assign the default operator '__eq__'
+                    if not value_op:
+                        value_op = '__eq__'
+
+                steps.append(SearchPlanStep(param=param, arg=arg, op=value_op, modifier=modifier, prefix=prefix,
+                                            system=system, index=index))
+        return SearchPlan(base=self.base, steps=steps, sort=sort, relationships=self.relationships,
+                          includes=includes, warnings=warnings)
+
+    def search(self, args, query=None):
+        """
+        Parse the request args and apply the search to a query
+        :return:
+            Tuple of (query, plan).  The query is un-executed.
+        """
+        plan = self.plan(args)
+        return plan.apply(args=args, query=query), plan
+
+
 def parse_fhir_search(args, base, model_support=None):
     """
     Function parse_fhir_search()
@@ -156,240 +1009,9 @@ def parse_fhir_search(args, base, model_support=None):
 
 
     """
-    ##############################################################
-    # FHIR Search Support Compilation
-    ##############################################################
-    default_support = {'_id': {'modifier': ['exact', 'not'],
-                               'prefix': [],
-                               'model': base,
-                               'column': ['id'],
-                               'type': 'int',
-                               'validation': []},
-                       '_lastUpdated': {'modifier': [],
-                                        'prefix': ['gt', 'ge', 'lt', 'le', 'eq', 'ne'],
-                                        'model': base,
-                                        'column': ['updated_at'],
-                                        'type': 'datetime',
-                                        'validation': []}
-                       }
-    # Build one search support dictionary by combining the default and model support dicts
-    if model_support and not search_support_is_valid(support=model_support):
-        raise ValueError('Invalid model search support')
-    support = {**default_support, **model_support}
-
-    # Initialize the dict that will be generated as output
-    fhir_search_spec = {}
-
-    # Loop through args in request
-    for arg in args:
-        # Initialize parameters that may be assigned
-        op = None
-        value = None
-        column = None
-        value_forced_by_operator = False  # This is to track whether the operator determines the value
-
-        arg_split = arg.split(':')  # Attempt to split args to determine if modifier exists
-        search_key = arg_split[0]  # Get the parameter to which the search applies
-        input_value = request.args.get(arg)  # Get the raw value for the parameter
-
-        # Ignore parameters handled elsewhere with bundle and pagination decorators
-        if search_key in ['page', '_count', '_format', '_summary']:
-            continue
-
-        ##############################################################
-        # FHIR Sorting
-        ##############################################################
-        if search_key == '_sort' and input_value:
-            sort_column = None
-            sort_type = None
-
-            # Sort values prefaced with '-' indicate descending sort is requested
-            if input_value[0:1] == '-':
-                sort_type = 'desc'
-                input_value = input_value[1:]  # Get rid of that pesky '-' from the value
-
-            # Now that we've handled the potential for a '-' in the value, check if the
-            # value for the _sort param is in the support dictionary
-            # If exists, create a fhir search spec with sort data
-            if input_value in support.keys():
-                sort_column = support[input_value].get('column')  # Lookup column by the value for sort
-                if not sort_type:  # If not 'desc' set to 'asc'
-                    sort_type = 'asc'
-
-                # Set the data model for _sort
-                fhir_search_spec[search_key] = {'op': sort_type,
-                                                'model': support[input_value].get('model'),
-                                                'column': sort_column}
-            # Raise an error if attempting to sort by a param that is not supported by the model
-            else:
-                raise ValidationError('The sort key ({}) is not supported for this resource'.format(input_value))
-
-            continue
-
-        ##############################################################
-        # FHIR Search Modifiers
-        ##############################################################
-
-        if search_key in support.keys():
-            if not input_value:
-                raise ValidationError(
-                    'No value was supplied with parameter {}'.format(search_key))
-
-            # Attempt to find and interpret search param modifiers like param:contains=value
-            try:
-                # Get the modifier, and check if that modifier is supported for the given param
-                search_modifier = arg_split[1].lower().strip()
-                if search_modifier in support[search_key].get('modifier'):
-
-                    # Handle special syntax for :missing param which checks for Null / Not Null
-                    if search_modifier == 'missing':
-                        # Indicate the value type is forced by the param modifier
-                        value_forced_by_operator = True
-                        try:
-                            # Make sure values for params with :missing modifier are booleans
-                            value = validate_bool(value=input_value, error=True)
-                            if isinstance(value, bool):
-                                if value:
-                                    op = 'is_'
-                                    value = None
-                                else:
-                                    op = 'isnot'
-                                    value = None
-                        # Gotta use a boolean value for the missing modifier
-                        except ValueError:
-                            raise ValidationError(
-                                'The value for parameter ({}) with modifier (missing) was ({}) and could not be validated as a boolean input for the search' \
-                                    .format(search_key, input_value))
-
-                    # Use the isnot SQLAlchemy operator for boolean value comparisons with :not modifier
-                    elif search_modifier == 'not' and support[search_key].get('type') == 'bool':
-                        op = 'isnot'
-
-                    # Otherwise use the operators in the lookup dictionary and the value as-is
-                    else:
-                        op = fhir_modifiers.get(search_modifier)
-
-                # Give a helpful error if the modifier is not supported by the model
-                else:
-                    raise ValidationError('The search parameter ({}) does not support the modifier ({})' \
-                                          .format(search_key, search_modifier))
-
-            # No search parameter modifier exists - carry on
-            except IndexError:
-                pass
-
-            ##############################################################
-            # FHIR Search Values & Prefixes by Type
-            ##############################################################
-            if not value_forced_by_operator:
-                param_type = support[search_key].get('type')
-
-                ##############################################################
-                # FHIR Ordered Types - Check for Prefix
-                ##############################################################
-                if param_type in {'date', 'datetime', 'timestamp', 'numeric'}:
-                    # Attempt to get first 2 characters as prefixes like 'gt'
-                    try:
-                        value_prefix = input_value[0:2].lower().strip()
-                        if value_prefix in fhir_prefixes.keys():
-                            input_value = input_value[2:]
-                            op = fhir_prefixes.get(value_prefix)
-
-                    # First 2 characters are not a known prefix - ignore
-                    except IndexError:
-                        pass
-
-                ##############################################################
-                # FHIR Boolean Value Handling
-                ##############################################################
-                if param_type == 'bool':
-                    try:
-                        value = validate_bool(value=input_value, error=True)
-                    except ValueError:
-                        raise ValidationError(
-                            'The value for parameter ({}) was ({}) and could not be validated as a boolean input for the search' \
-                                .format(search_key, input_value))
-
-                ##############################################################
-                # FHIR Datetime Value Handling
-                ##############################################################
-                elif param_type in ['datetime', 'date', 'timestamp']:
-                    to_date = False
-                    if param_type == 'date':
-                        to_date = True
-                    try:
-                        value = validate_datetime(value=input_value, error_out=True, to_date=to_date)
-                    except DatetimeParseError:
-                        raise ValidationError(
-                            'The value for parameter ({}) was ({}) and could not be validated as a datetime input for the search' \
-                                .format(search_key, input_value))
-
-                ##############################################################
-                # FHIR String Value Handling
-                ##############################################################
-                elif param_type == 'string':  # Deal with case comparison
-                    input_value = unidecode.unidecode(input_value)  # Handle accents per FHIR
-                    if op == 'ilike':  # Handles the :contains modifier for string parameters
-                        value = '%' + str(input_value) + '%'
-                    if not op:  # If no modifier is defined for string parameters a case-insensitive starts_with comp
-                        op = 'ilike'
-                        value = str(input_value) + '%'
-
-                ##############################################################
-                # FHIR Token / Code Value Handling
-                ##############################################################
-                elif param_type == 'token' and input_value:
-                    # Tokens may be in the following formats
-                    # [parameter]=[code]
-                    # [parameter]=[system]|[code]
-                    # [parameter]=|[code]
-                    # [parameter]=[system]|
-                    input_value_split = input_value.split('|')
-
-                    # [parameter]=[code]
-                    if len(input_value_split) == 1:
-                        value = input_value_split[0]
-
-                    # Handle system being present
-                    elif len(input_value_split) == 2:
-                        column_support = support[search_key].get('column')
-                        value_system = input_value_split[0].strip()
-                        # If system is present, system must be designated as key in k/v pairs of column list in
-                        # the support dictionary
-                        if not isinstance(column_support, dict) or value_system not in column_support.keys():
-                            raise ValidationError(
-                                'The search parameter ({}) does not support the system ({})'.format(search_key,
-                                                                                                    value_system))
-                        # Set column output to the column name, not the system name
-                        column = [column_support.get(value_system)]
-                        if input_value_split[1]:
-                            value = input_value_split[1].strip()
-                        else:
-                            input_value = None  # So that None will be assigned with the if not Value catch-all
-                    else:
-                        raise ValidationError(
-                            'The value for the token parameter {} included >1 (|) character'.format(search_key))
-
-                # Take the raw value from the input if it hasn't been set yet
-                if not value:
-                    value = input_value
-
-                # Assign the column if it hasn't been set yet
-                if not column:
-                    column = support[search_key].get('column')
-
-            # Assign the default operator '__eq__'
-            if not op:
-                op = '__eq__'
-
-            # Add to the output dictionary
-            fhir_search_spec[search_key] = {'op': op,
-                                            'value': value,
-                                            'model': support[search_key].get('model'),
-                                            'column': column}
-        else:
-            raise ValidationError('An unknown parameter ({}) was passed to the search query'.format(search_key))
-    return fhir_search_spec
+    # Endpoints should build a SearchSupport once at import and reuse its cached plans.  This compiles a one-off plan.
+    support = SearchSupport(base=base, model_support=model_support, cache_size=0)
+    return support.compile(support.search_shape(args)).spec(args)
 
 
 def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
@@ -424,29 +1046,27 @@ def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
     ##############################################################
     # Loop through query search specification dicts
     ##############################################################
-    executed_joins = []  # Keep track of models that have been joined already so you don't join twice
+    related_criteria = OrderedDict()  # Criteria on related models, merged into one EXISTS subquery per model
     for key in fhir_search_spec.keys():
         column_spec = fhir_search_spec[key]['column']
         model = fhir_search_spec[key]['model']
 
-        # Execute a join if model does not match base model
-        if model != base and model not in executed_joins:
-            query = query.join(model)
-            executed_joins.append(model)
-
-        # Handle sort operations
+        # Handle sort operations.  A related model's column is sorted on with a correlated subquery, see sort_expression
         if key == '_sort':
-            column = getattr(model, column_spec[0])
-            op = fhir_search_spec[key]['op']
-            query = query.order_by(getattr(column, op)())
+            query = query.order_by(sort_order(sort_expression(base=base, sort=fhir_search_spec[key]),
+                                              fhir_search_spec[key]['op']))
             continue
 
+        # Use the criterion built by a search plan when one is supplied
+        if fhir_search_spec[key].get('criterion') is not None:
+            criterion = fhir_search_spec[key]['criterion']
+
         # Handle most common situation where only one model attribute must be considered for filtering
-        if len(column_spec) == 1:
+        elif len(column_spec) == 1:
             column = getattr(model, column_spec[0])  # Get the column on the model
             op = fhir_search_spec[key]['op']  # Get the operator for the column
             value = fhir_search_spec[key]['value']  # Get the value from the dict
-            query = query.filter(getattr(column, op)(value)) # Dynamically construct the query
+            criterion = getattr(column, op)(value)  # Dynamically construct the filter
 
         # Handle situations where >1 attribute must be considered in the operation
         # In this case, the operator and value will be applied to each attribute with OR logic
@@ -459,7 +1079,15 @@ def fhir_apply_search_to_query(fhir_search_spec, base, query=None):
                 column = getattr(model, col)
                 filt = getattr(column, op)(value)
                 filter_list.append(filt)
-            query = query.filter(or_(*filter_list))
+            criterion = or_(*filter_list)
+
+        if model != base:
+            related_criteria.setdefault(model, []).append(criterion)
+        else:
+            query = query.filter(criterion)
+
+    for model, criteria in related_criteria.items():
+        query = query.filter(semijoin(find_relationship(base=base, model=model), criteria))
 
     return query
 
@@ -536,5 +1164,7 @@ def fhir_search(args, model_support, base, query):
     :return:
         Un-executed SQLAlchemy query with filtering and sorting applied according to the input specification
     """
-    fhir_search_spec = parse_fhir_search(args=args, model_support=model_support, base=base)
-    return fhir_apply_search_to_query(fhir_search_spec=fhir_search_spec, query=query, base=base)
+    if not isinstance(model_support, SearchSupport):
+        model_support = SearchSupport(base=base, model_support=model_support, cache_size=0)
+    query, plan = model_support.search(args=args, query=query)
+    return query
@@ -0,0 +1,199 @@
+import functools
+import hashlib
+import json
+from flask import request, current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.http import parse_date
+from app import redis
+from app.api_v1.errors.exceptions import NotModifiedError
+from app.api_v1.utils.etag import conditional_request, evaluate_preconditions
+
+# Response headers stored with a cached bundle:  the validators set by the @etag decorator
+CACHED_HEADERS = ['ETag', 'Last-Modified', 'Cache-Control']
+
+# Seconds a cached searchset bundle is kept, when not set with the SEARCH_CACHE_TIMEOUT config value
+DEFAULT_SEARCH_CACHE_TIMEOUT = 60
+
+
+class SearchResultCache(object):
+    """
+    Redis cache of searchset bundle responses for one FHIR resource type.
+
+    Cache keys are built from the resource, a generation counter, and the normalized search parameters (including
+    the page, _count and _cursor values).  Any committed change to one of the models the resource is built from bumps
+    the generation counter, so every entry cached for an older generation becomes unreachable and expires on its own.
+    Each entry is a Redis hash of the response body and its validator headers, so a hit answers conditional requests
+    without running the search or its validator query.
+
+    Hit, miss and invalidation counts are kept in a Redis hash and are returned by stats().
+    """
+    key_prefix = 'search-cache'
+
+    # SearchResultCache objects by resource name, used to find the caches a committed change invalidates
+    registry = {}
+
+    def __init__(self, resource, models):
+        """
+        :param resource:
+            Name of the FHIR resource, ex: 'Patient'
+        :param models:
+            The SQLAlchemy ORM models whose changes invalidate cached searches of the resource,
+            ex: [Patient, Address, EmailAddress, PhoneNumber]
+        """
+        self.resource = resource
+        self.models = tuple(models)
+        SearchResultCache.registry[resource] = self
+
+    @property
+    def generation_key(self):
+        return '{}:{}:generation'.format(self.key_prefix, self.resource)
+
+    @property
+    def stats_key(self):
+        return '{}:{}:stats'.format(self.key_prefix, self.resource)
+
+    @staticmethod
+    def enabled():
+        return current_app.config.get('USE_SEARCH_CACHE', False)
+
+    @staticmethod
+    def timeout():
+        return current_app.config.get('SEARCH_CACHE_TIMEOUT', DEFAULT_SEARCH_CACHE_TIMEOUT)
+
+    def generation(self):
+        value = redis.get(self.generation_key)
+        return int(value) if value else 0
+
+    def make_key(self, args, generation):
+        """
+        Build the cache key of a search request
+        :param args:
+            werkzeug MultiDict of request args.  Parameter order, and the order of repeated values of a parameter,
+            do not change the key.
+        :param generation:
+            The current generation counter of the resource
+        :return:
+            Redis key string
+        """
+        normalized = sorted((name, sorted(args.getlist(name))) for name in args)
+        # Bundle links are absolute URLs, so the host is part of the key
+        digest = hashlib.sha1(json.dumps([request.host_url, request.path, normalized]).encode('utf-8')).hexdigest()
+        return '{}:{}:{}:{}'.format(self.key_prefix, self.resource, generation, digest)
+
+    def invalidate(self):
+        """
+        Make every cached search of the resource unreachable by bumping its generation counter
+        """
+        p = redis.pipeline()
+        p.incr(self.generation_key)
+        p.hincrby(self.stats_key, 'invalidations', 1)
+        p.execute()
+
+    def stats(self):
+        """
+        Monitoring counters of the cache
+        :return:
+            dict of hits, misses, invalidations, the current generation and the number of keys Redis has evicted
+            to stay within its memory limit (server wide)
+        """
+        counters = redis.hgetall(self.stats_key)
+        stats = {name: int(counters.get(name.encode('utf-8'), 0)) for name in ['hits', 'misses', 'invalidations']}
+        stats['generation'] = self.generation()
+        stats['evictions'] = int(redis.info('stats').get('evicted_keys', 0))
+        return stats
+
+    def cached(self, f):
+        """
+        Decorator for a search view function.  Responses with status 200 are stored in Redis and returned for
+        identical searches until the resource's data changes or the entry times out.  Searches run uncached when the
+        cache is disabled with the USE_SEARCH_CACHE config value, or when Redis can not be reached.  Streamed
+        responses are not stored, since storing them would read the whole body into memory.
+
+        Apply it outside of the @etag decorator:  the ETag and Last-Modified headers are computed once, when the
+        search misses, and stored with the body.  Conditional requests that hit are answered from the stored
+        headers, with 412 or 304.
+        """
+
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            # _explain debug responses describe a live execution, so they are never cached
+            if not self.enabled() or '_explain' in request.args:
+                return f(*args, **kwargs)
+            try:
+                key = self.make_key(args=request.args, generation=self.generation())
+                data = redis.hgetall(key)
+                redis.hincrby(self.stats_key, 'hits' if data else 'misses', 1)
+            except RedisError:
+                return f(*args, **kwargs)
+
+            if data:
+                headers = {name: data[name.encode('utf-8')].decode('utf-8') for name in CACHED_HEADERS
+                           if name.encode('utf-8') in data}
+                if 'ETag' in headers and conditional_request():
+                    last_modified = parse_date(headers.get('Last-Modified', ''))
+                    if last_modified is not None:
+                        last_modified = last_modified.replace(tzinfo=None)
+                    try:
+                        evaluate_preconditions(etag=headers['ETag'], last_modified=last_modified)
+                    except NotModifiedError as e:
+                        e.headers = {name: headers[name] for name in ['ETag', 'Last-Modified'] if name in headers}
+                        raise
+                response = current_app.response_class(data[b'body'], mimetype='application/json')
+                response.headers.extend(headers)
+                response.headers['X-Search-Cache'] = 'HIT'
+                return response
+
+            response = f(*args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                entry = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+                entry['body'] = response.get_data()
+                try:
+                    p = redis.pipeline()
+                    p.hmset(key, entry)
+                    p.expire(key, self.timeout())
+                    p.execute()
+                except RedisError:
+                    pass
+            response.headers['X-Search-Cache'] = 'MISS'
+            return response
+
+        return wrapped
+
+
+##############################################################################################
+# Write driven invalidation
+##############################################################################################
+@event.listens_for(Session, 'after_flush')
+def record_changed_models(session, flush_context):
+    """
+    Remember the model classes written by each flush until the transaction ends
+    """
+    changed = session.info.setdefault('search_cache_changed', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed.add(type(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_searches(session):
+    """
+    Invalidate the search caches of every resource built from a model changed in the committed transaction
+    """
+    changed = session.info.pop('search_cache_changed', None)
+    if not changed:
+        return
+    if has_app_context() and not current_app.config.get('USE_SEARCH_CACHE', False):
+        return
+    for cache in SearchResultCache.registry.values():
+        if any(issubclass(model, cache.models) for model in changed):
+            try:
+                cache.invalidate()
+            except RedisError:
+                if has_app_context():
+                    current_app.logger.exception('Search cache invalidation failed for {}'.format(cache.resource))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_models(session):
+    session.info.pop('search_cache_changed', None)
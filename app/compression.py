@@ -0,0 +1,145 @@
+"""
+Compression of HTTP responses, negotiated with the Accept-Encoding request header.
+
+gzip is always available.  Brotli (br) and Zstandard (zstd) are offered when the brotli and zstandard packages are
+installed.  Responses are compressed when they are at least COMPRESS_MIN_SIZE bytes long, have one of the
+COMPRESS_MIMETYPES, and are not streamed or already encoded.
+
+Responses with an ETag, such as those of views decorated with @etag, keep their compressed bytes in an in-process
+LRU cache keyed by URL, ETag and encoding, so repeated responses of the same representation are only compressed once.
+A compressed response is a different representation than the uncompressed one, so its ETag is made weak.  Weak
+ETags still match in If-None-Match, but not in the strong comparison of If-Match, see
+app.api_v1.utils.etag.etag_matches.
+"""
+import gzip
+from io import BytesIO
+from flask import request, current_app
+from app.utils.general import LRUCache
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Default compression level by encoding
+DEFAULT_COMPRESS_LEVEL = {'br': 4, 'zstd': 3, 'gzip': 6}
+
+DEFAULT_COMPRESS_MIMETYPES = ['application/json', 'application/fhir+json', 'text/html', 'text/css', 'text/plain',
+                              'text/xml', 'application/javascript']
+
+
+def gzip_compress(data, level):
+    buffer = BytesIO()
+    # mtime is fixed so that the same data always compresses to the same bytes
+    with gzip.GzipFile(mode='wb', compresslevel=level, fileobj=buffer, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def available_encodings():
+    """
+    The installed encodings, in order of preference when the client accepts several with the same quality
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append(('br', brotli_compress))
+    if zstandard is not None:
+        encodings.append(('zstd', zstd_compress))
+    encodings.append(('gzip', gzip_compress))
+    return encodings
+
+
+class Compress(object):
+    """
+    Flask extension that compresses responses in an after_request handler.  Configured with:
+        COMPRESS_ENABLED:  Set to False to turn compression off
+        COMPRESS_MIN_SIZE:  Smallest response body, in bytes, that is compressed
+        COMPRESS_LEVEL:  dict of compression level by encoding, ex: {'gzip': 6, 'br': 4, 'zstd': 3}
+        COMPRESS_MIMETYPES:  Mimetypes of the responses that are compressed
+        COMPRESS_CACHE_SIZE:  Number of compressed responses with an ETag kept in the LRU cache.  0 turns it off.
+    """
+
+    def __init__(self, app=None):
+        self.cache = LRUCache(maxsize=0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', DEFAULT_COMPRESS_LEVEL)
+        app.config.setdefault('COMPRESS_MIMETYPES', DEFAULT_COMPRESS_MIMETYPES)
+        app.config.setdefault('COMPRESS_CACHE_SIZE', 256)
+        self.cache = LRUCache(maxsize=app.config['COMPRESS_CACHE_SIZE'])
+        app.extensions['compress'] = self
+        if app.config['COMPRESS_ENABLED']:
+            app.after_request(self.after_request)
+
+    @staticmethod
+    def negotiate_encoding():
+        """
+        Choose the encoding of the response from the Accept-Encoding request header
+        :return:
+            Tuple of (encoding name, compress function), or (None, None) when no installed encoding is accepted
+        """
+        encodings = available_encodings()
+        accepted = request.accept_encodings
+        best_quality = 0
+        chosen = (None, None)
+        for name, compress in encodings:
+            quality = accepted[name]
+            if quality > best_quality:
+                best_quality = quality
+                chosen = (name, compress)
+        return chosen
+
+    def should_compress(self, response, app_config):
+        if response.direct_passthrough or response.is_streamed:
+            return False
+        if response.status_code < 200 or response.status_code >= 300 or response.status_code == 204:
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        if response.mimetype not in app_config['COMPRESS_MIMETYPES']:
+            return False
+        return response.content_length is None or response.content_length >= app_config['COMPRESS_MIN_SIZE']
+
+    def after_request(self, response):
+        config = current_app.config
+        if not self.should_compress(response, config):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding, compress = self.negotiate_encoding()
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        level = config['COMPRESS_LEVEL'].get(encoding, DEFAULT_COMPRESS_LEVEL[encoding])
+        etag = response.headers.get('ETag')
+        key = (request.url, etag, encoding, level) if etag else None
+        compressed = self.cache.get(key) if key else None
+        if compressed is None:
+            compressed = compress(data, level)
+            if key:
+                self.cache.set(key, compressed)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
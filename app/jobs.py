@@ -0,0 +1,64 @@
+# Background jobs run by rq workers
+# Start a worker with:  rq worker unkani --url $REDIS_URL
+# Workers build their app from the FLASK_CONFIG environment variable, like unkani.py does
+import os
+from contextlib import contextmanager
+from flask import has_app_context, has_request_context, current_app
+from rq import Queue
+from app import redis
+
+QUEUE_NAME = 'unkani'
+
+
+def get_queue():
+    return Queue(QUEUE_NAME, connection=redis)
+
+
+@contextmanager
+def job_context(base_url=None):
+    """
+    Run a job inside an app and request context.  Jobs called from the app (or a CLI command) reuse its app;
+    jobs run by an rq worker create one.  A request context is pushed so that url_for(_external=True) and
+    render_template work outside of a request.
+    :param base_url:
+        Root URL of the request context pushed for the job, ex: the host_url of the request that queued it, so that
+        absolute URLs in the job's output point to the same host.  Ignored when a request context is active.
+    """
+    if has_app_context():
+        app = current_app._get_current_object()
+    else:
+        from app import create_app
+        app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+    if has_request_context():
+        yield app
+    else:
+        with app.test_request_context(base_url=base_url):
+            yield app
+
+
+def rebuild_patient_resources(patient_ids):
+    """
+    Re-render the stored FHIR JSON of patients whose source rows changed
+    :param patient_ids:
+        List of Patient ids
+    :return:
+        The number of stored resources written
+    """
+    from app.models.fhir.patient_resource import PatientResource
+    with job_context():
+        return PatientResource.rebuild(patient_ids=patient_ids)
+
+
+def run_bulk_export(export_id, base_url=None):
+    """
+    Run a FHIR Bulk Data $export, see BulkExport
+    :param export_id:
+        Id of the BulkExport recorded by the kick-off request
+    :param base_url:
+        Root URL of the kick-off request.  Resource ids in the exported files are absolute URLs on this host.
+    """
+    from app.api_v1.utils.bulk_export import BulkExport
+    with job_context(base_url=base_url):
+        export = BulkExport.load(export_id)
+        if export is not None:
+            export.run()
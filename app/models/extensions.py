@@ -1,5 +1,33 @@
 from app import db
 from datetime import datetime
+from sqlalchemy import event, DDL
+
+# Trigram indexes used by FHIR string search require the pg_trgm extension.  Make sure it exists before
+# db.create_all() builds them.  Migrations enable it explicitly.
+event.listen(db.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+
+def trigram_index(name, column):
+    """
+    A GIN index with the pg_trgm operator class.  Serves ILIKE '%value%' and similarity (%) predicates on the column.
+    :param name:
+        Name of the index
+    :param column:
+        Name of the column to index
+    """
+    return db.Index(name, column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def search_key_index(name, column):
+    """
+    A btree index with the text_pattern_ops operator class.  Serves equality and LIKE 'value%' prefix predicates on
+    a folded search key column as an index range scan.
+    :param name:
+        Name of the index
+    :param column:
+        Name of the column to index
+    """
+    return db.Index(name, column, postgresql_ops={column: 'text_pattern_ops'})
 
 
 class BaseExtension(db.MapperExtension):
@@ -4,3 +4,4 @@ from .patient import *
 from .email_address import *
 from .phone_number import *
 from .address import *
+from .patient_resource import *
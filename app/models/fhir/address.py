@@ -1,11 +1,13 @@
 from app import db, ma
 from marshmallow import fields, post_load
 from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
-import hashlib, json
+import json
 
 from app.utils.demographics import *
-from app.utils.general import json_serial
-from app.models.extensions import BaseExtension
+from app.utils.general import fold_search_key
+from app.utils.json_backend import hash_data
+from app.models.extensions import BaseExtension, trigram_index, search_key_index
+from app.utils.fhir_utils import fhir_date_json
 from fhirclient.models import address as fhir_address
 from fhirclient.models import period, fhirdate
 from fhirclient.models.fhirabstractbase import FHIRValidationError
@@ -24,8 +26,27 @@ class Address(db.Model):
     """
     # TODO: Add county and country to model, api and FHIR output
     _tablename__ = 'address'
-    __versioned__ = {}
+    # Folded shadow columns used by FHIR string search, keyed by the column they are generated from
+    search_keys = {'address1': 'address1_key',
+                   'address2': 'address2_key',
+                   'city': 'city_key',
+                   'state': 'state_key',
+                   'zipcode': 'zipcode_key',
+                   'country': 'country_key'}
+    # Columns the row_hash is computed from
+    row_hash_columns = ('address1', 'address2', 'city', 'state', 'zipcode', 'patient_id', 'user_id', 'is_postal',
+                        'is_physical', 'use', 'start_date', 'end_date', 'district', 'country')
+    __versioned__ = {'exclude': list(search_keys.values())}
     __mapper_args__ = {'extension': BaseExtension()}
+    __table_args__ = (trigram_index('ix_address_address1_trgm', 'address1'),
+                      trigram_index('ix_address_address2_trgm', 'address2'),
+                      trigram_index('ix_address_city_trgm', 'city'),
+                      search_key_index('ix_address_address1_key', 'address1_key'),
+                      search_key_index('ix_address_address2_key', 'address2_key'),
+                      search_key_index('ix_address_city_key', 'city_key'),
+                      search_key_index('ix_address_state_key', 'state_key'),
+                      search_key_index('ix_address_zipcode_key', 'zipcode_key'),
+                      search_key_index('ix_address_country_key', 'country_key'))
     id = db.Column(db.Integer, primary_key=True)
     address1 = db.Column("address1", db.Text)
     address2 = db.Column("address2", db.Text)
@@ -49,6 +70,12 @@ class Address(db.Model):
     updated_at = db.Column(db.DateTime)
     address_hash = db.Column(db.Text)
     row_hash = db.Column(db.Text)
+    address1_key = db.Column(db.Text)
+    address2_key = db.Column(db.Text)
+    city_key = db.Column(db.Text)
+    state_key = db.Column(db.Text)
+    zipcode_key = db.Column(db.Text)
+    country_key = db.Column(db.Text)
 
     def __init__(self, address1=None, address2=None, city=None, state=None, zipcode=None, active=True, primary=False,
                  user_id=None, patient_id=None, start_date=None, end_date=None, is_postal=True, is_physical=True,
@@ -191,6 +218,60 @@ class Address(db.Model):
 
         self.fhir = fa
 
+    def build_fhir_dict(self):
+        """
+        Build the FHIR Address JSON directly as a dict, without the fhirclient object
+
+        :return:
+            dict equal to the as_json() output of the fhirclient Address
+        """
+        fa = {}
+
+        if self.address1:
+            fa['line'] = [self.address1]
+
+            if self.address2:
+                fa['line'].append(self.address2)
+
+        if self.city:
+            fa['city'] = self.city
+
+        if self.state:
+            fa['state'] = self.state
+
+        if self.zipcode:
+            fa['postalCode'] = self.zipcode
+
+        fa['text'] = self.formatted_address()
+
+        if isinstance(self.start_date, date) or isinstance(self.end_date, date):
+            p = {}
+            if self.start_date:
+                p['start'] = fhir_date_json(self.start_date)
+            if self.end_date:
+                p['end'] = fhir_date_json(self.end_date)
+            fa['period'] = p
+
+        if self.use:
+            fa['use'] = self.use.lower()
+
+        if self.is_postal and self.is_physical:
+            fa['type'] = 'both'
+
+        elif self.is_postal:
+            fa['type'] = 'postal'
+
+        elif self.is_physical:
+            fa['type'] = 'physical'
+
+        if self.district:
+            fa['district'] = self.district
+
+        if self.country:
+            fa['country'] = self.country
+
+        return fa
+
     def dump_fhir_json(self, parent=False):
         """
         Method to dump valid FHIR STU 3.0 JSON representation of the Address ORM object
@@ -212,48 +293,68 @@ class Address(db.Model):
         except FHIRValidationError:
             return None
 
+    @classmethod
+    def hash_row(cls, values):
+        """
+        Method to generate the row_hash of an address row from a dict of its column values.  Used by
+        generate_row_hash, and by bulk loads that write rows without ORM objects.
+        :return:
+            A SHA-1 hash of JSON object containing the values of the row_hash_columns
+        """
+        return hash_data({column: values.get(column) for column in cls.row_hash_columns})
+
     def generate_row_hash(self):
         """
         Method to generate a sha1 hash of the object attributes.  Used for versioning and cache control
         :return:
             A SHA-1 hash of JSON object containing an ordered dictionary of the Address object's attributes
         """
-        data = {"address1": self.address1, "address2": self.address2, "city": self.city,
-                "state": self.state, "zipcode": self.zipcode,
-                "patient_id": self.patient_id, "user_id": self.user_id, "is_postal": self.is_postal,
-                "is_physical": self.is_physical, "use": self.use, "start_date": self.start_date,
-                "end_date": self.end_date, "district": self.district, "country": self.country}
-        data_str = json.dumps(data, sort_keys=True, default=json_serial)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+        return self.hash_row({column: getattr(self, column) for column in self.row_hash_columns})
 
-    def generate_address_hash(self):
+    @staticmethod
+    def hash_address(values):
         """
-        Method to generate a sha1 hash of the object attributes that uniquely identify an address (less the additional
-        address meta data).  Used to check for matching addresses.
+        Method to generate the address_hash of an address from a dict of its column values, see generate_address_hash
         :return:
-            A SHA-1 hash of a normalized Address object's attributes that uniquely define the address. These include
-            the address lines, city, state and zipcodes.  The data are normalized into an ordered dict that takes care
-            to remove whitespaces and other noise from the attribute values.  The ordered dict of values is serialized
-            as a JSON string and a SHA-1 hash is created from the JSON serialization.
-
+            A SHA-1 hash of the normalized address lines, city, state, zipcode and country
         """
-        address1 = self.address1
+        address1 = values.get('address1')
         if not address1:
             address1 = ''
-        address2 = self.address2
+        address2 = values.get('address2')
         if not address2:
             address2 = ''
         address_lines = str(address1 + address2)
-        data = {"address_lines": address_lines, "city": self.city,
-                "state": self.state, "zipcode": self.zipcode, "country": self.country}
+        data = {"address_lines": address_lines, "city": values.get('city'),
+                "state": values.get('state'), "zipcode": values.get('zipcode'), "country": values.get('country')}
         for key in data:
             if isinstance(data[key], str):
                 # Remove punctuation and whitespace from strings in address to hash
                 data[key] = re.sub(r'[^a-zA-Z0-9]', '', data[key])
-        data_str = json.dumps(data, sort_keys=True, default=json_serial)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+        return hash_data(data)
+
+    def generate_address_hash(self):
+        """
+        Method to generate a sha1 hash of the object attributes that uniquely identify an address (less the additional
+        address meta data).  Used to check for matching addresses.
+        :return:
+            A SHA-1 hash of a normalized Address object's attributes that uniquely define the address. These include
+            the address lines, city, state and zipcodes.  The data are normalized into an ordered dict that takes care
+            to remove whitespaces and other noise from the attribute values.  The ordered dict of values is serialized
+            as a JSON string and a SHA-1 hash is created from the JSON serialization.
+
+        """
+        return self.hash_address({column: getattr(self, column) for column in
+                                  ['address1', 'address2', 'city', 'state', 'zipcode', 'country']})
+
+    def generate_search_keys(self):
+        """
+        Method to set the folded search key columns from the columns they are generated from
+        :return:
+            No return
+        """
+        for column, key_column in self.search_keys.items():
+            setattr(self, key_column, fold_search_key(getattr(self, column)))
 
     def before_insert(self):
         """
@@ -263,6 +364,7 @@ class Address(db.Model):
         """
         self.row_hash = self.generate_row_hash()
         self.address_hash = self.generate_address_hash()
+        self.generate_search_keys()
 
     def before_update(self):
         """
@@ -272,6 +374,7 @@ class Address(db.Model):
         """
         self.row_hash = self.generate_row_hash()
         self.address_hash = self.generate_address_hash()
+        self.generate_search_keys()
 
 
 class AddressSchema(ma.Schema):
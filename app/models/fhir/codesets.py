@@ -1,16 +1,25 @@
+import json
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime
-import json, hashlib
-from app.utils.general import json_serial
+from flask import current_app, has_app_context
+from app.utils.json_backend import hash_data
 from requests import request
 from requests.exceptions import RequestException
 from app import db
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, trigram_index
 from app.models.source_data import SourceData
+from sqlalchemy import and_, event, func, literal_column, select
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Session
 from app.main.errors import ValidationError
 from fhirclient.models import valueset, codesystem
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 
+# Seconds between checks that the terminology cache matches the codesystem and valueset tables
+DEFAULT_TERMINOLOGY_CHECK_INTERVAL = 30
+
 ##################################################################################################
 # SOURCE_DATA -> CODESYSTEM ASSOCIATION TABLE
 ##################################################################################################
@@ -76,6 +85,7 @@ class CodeSystem(db.Model):
         :return:
             None - sets object attributes only
         """
+        self.data = data
         self._fhir = self.get_fhir_obj(data=data)
         self.set_attributes_from_fhir()
 
@@ -153,49 +163,160 @@ class CodeSystem(db.Model):
 
     @property
     def code_set(self):
-        codes = set()
-        concepts = self.fhir.concept
-
-        while concepts:
-            additional_concepts = []
-            for concept in concepts:
-                code, nested_concepts = self.unpack_concept(concept)
-                codes.add(code)
-                if nested_concepts:
-                    additional_concepts.extend(nested_concepts)
-            concepts = additional_concepts
-
-        return codes
+        """
+        The codes of the flattened concepts of the CodeSystem
+        """
+        query = db.session.query(CodeSystemConcept.code).filter(CodeSystemConcept.codesystem_id == self.id)
+        return set(code for code, in query)
 
     def get_concept(self, code):
-        concepts = self.fhir.concept
-        found_concept = None
-
-        while not found_concept and concepts:
-            nested_concepts = []
-            for concept in concepts:
-                if concept.code == code:
-                    found_concept = concept
-                else:
-                    try:
-                        if concept.concept:
-                            nested_concepts.extend(concept.concept)
-                    except AttributeError:
-                        pass
-            concepts = nested_concepts
-
-        return found_concept
+        """
+        Look up a concept of the CodeSystem by its primary key in the codesystem_concept table
+        :return:
+            CodeSystemConcept or None
+        """
+        return CodeSystemConcept.query.get((self.id, code))
 
     def dump_fhir_json(self):
         return self.data  # same as self.fhir.as_json()
 
     def before_insert(self):
-        json_data = json.dumps(self.data, default=json_serial, sort_keys=True)
-        self.data_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest()
+        self.data_hash = hash_data(self.data)
 
     def before_update(self):
-        json_data = json.dumps(self.data, default=json_serial, sort_keys=True)
-        self.data_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest()
+        self.data_hash = hash_data(self.data)
+
+
+##################################################################################################
+# CODESYSTEM CONCEPT INDEX
+##################################################################################################
+
+def walk_codesystem(data):
+    """
+    Walk the nested concept tree of a CodeSystem breadth first
+    :param data:
+        A JSON FHIR CodeSystem resource
+    :return:
+        Generator of (concept, ancestors) tuples:  the JSON concept and the tuple of the codes of the concepts it is
+        nested in, outermost first.  Concepts without a code are yielded, but are left out of their children's
+        ancestors.
+    """
+    pending = [(concept, ()) for concept in data.get('concept') or []]
+    while pending:
+        nested = []
+        for concept, ancestors in pending:
+            yield concept, ancestors
+            path = ancestors + (concept.get('code'),) if concept.get('code') else ancestors
+            nested.extend((child, path) for child in concept.get('concept') or [])
+        pending = nested
+
+
+class CodeSystemConcept(db.Model):
+    """
+    A concept of a CodeSystem, flattened from the nested concept tree by refresh_codesystem_concepts.  parent_code
+    links a concept to the concept it is nested in.
+    """
+    __tablename__ = 'codesystem_concept'
+    __table_args__ = (db.ForeignKeyConstraint(['codesystem_id', 'parent_code'],
+                                              ['codesystem_concept.codesystem_id', 'codesystem_concept.code']),)
+
+    codesystem_id = db.Column(db.Integer, db.ForeignKey('codesystem.id', ondelete='CASCADE'), primary_key=True)
+    code = db.Column(db.Text, primary_key=True)
+    display = db.Column(db.Text)
+    definition = db.Column(db.Text)
+    parent_code = db.Column(db.Text)
+
+    def __repr__(self):  # pragma: no cover
+        return '<CodeSystemConcept {}:{}>'.format(self.codesystem_id, self.code)
+
+
+class ConceptClosure(db.Model):
+    """
+    The transitive closure of the concept hierarchy of a CodeSystem:  one row per (ancestor, descendant) pair,
+    including a row of depth 0 for every concept with itself.  The descendants of a code are a range of the primary
+    key, and its ancestors a range of the descendant index.
+    """
+    __tablename__ = 'concept_closure'
+    __table_args__ = (db.Index('ix_concept_closure_descendant', 'codesystem_id', 'descendant_code', 'ancestor_code'),)
+
+    codesystem_id = db.Column(db.Integer, db.ForeignKey('codesystem.id', ondelete='CASCADE'), primary_key=True)
+    ancestor_code = db.Column(db.Text, primary_key=True)
+    descendant_code = db.Column(db.Text, primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):  # pragma: no cover
+        return '<ConceptClosure {}:{}>{}>'.format(self.codesystem_id, self.ancestor_code, self.descendant_code)
+
+
+def refresh_codesystem_concepts(codesystem):
+    """
+    Rebuild the codesystem_concept and concept_closure rows of a CodeSystem from its nested concept tree.  When a
+    code is nested more than once (a polyhierarchy), its shallowest definition is kept, and the closure is computed
+    over the parent edges of every occurrence, so the concepts nested under any occurrence are descendants of each of
+    its parents.  Concepts without a code are skipped.  The changes are flushed but not committed.
+    :param codesystem:
+        A persistent CodeSystem
+    :return:
+        The number of concepts
+    """
+    concepts = OrderedDict()
+    children = {}
+    for concept, ancestors in walk_codesystem(codesystem.data or {}):
+        code = concept.get('code')
+        if not code:
+            continue
+        parent = ancestors[-1] if ancestors else None
+        if code not in concepts:
+            concepts[code] = {'codesystem_id': codesystem.id, 'code': code, 'display': concept.get('display'),
+                              'definition': concept.get('definition'), 'parent_code': parent}
+        if parent is not None and parent != code:
+            children.setdefault(parent, set()).add(code)
+
+    # The shortest path from each concept to each of its descendants, breadth first over the merged parent edges
+    closure = []
+    for ancestor in concepts:
+        depths = {ancestor: 0}
+        pending = [ancestor]
+        while pending:
+            nested = []
+            for code in pending:
+                for child in children.get(code, ()):
+                    if child not in depths:
+                        depths[child] = depths[code] + 1
+                        nested.append(child)
+            pending = nested
+        closure.extend({'codesystem_id': codesystem.id, 'ancestor_code': ancestor, 'descendant_code': code,
+                        'depth': depth} for code, depth in depths.items())
+
+    ConceptClosure.query.filter(ConceptClosure.codesystem_id == codesystem.id).delete(synchronize_session=False)
+    CodeSystemConcept.query.filter(CodeSystemConcept.codesystem_id == codesystem.id) \
+        .delete(synchronize_session=False)
+    if concepts:
+        # Breadth first order inserts every parent before its children
+        db.session.execute(CodeSystemConcept.__table__.insert(), list(concepts.values()))
+        db.session.execute(ConceptClosure.__table__.insert(), closure)
+    return len(concepts)
+
+
+def subsumption_codes(system, code, modifier):
+    """
+    SQL select of the codes of a CodeSystem that a code subsumes (below) or that subsume the code (above), including
+    the code itself.  Used to compile the :below and :above token search modifiers into IN predicates.
+    :param system:
+        The url of the CodeSystem
+    :param code:
+        A code of the CodeSystem
+    :param modifier:
+        'below' or 'above'
+    :return:
+        SQLAlchemy select of one column of codes
+    """
+    codesystem_ids = select([CodeSystem.id]).where(CodeSystem.url == system)
+    if modifier == 'below':
+        return select([ConceptClosure.descendant_code]).where(
+            and_(ConceptClosure.codesystem_id.in_(codesystem_ids), ConceptClosure.ancestor_code == code))
+    return select([ConceptClosure.ancestor_code]).where(
+        and_(ConceptClosure.codesystem_id.in_(codesystem_ids), ConceptClosure.descendant_code == code))
 
 
 ##################################################################################################
@@ -228,6 +349,8 @@ class ValueSet(db.Model):
     data_hash = db.Column(db.Text, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
+    # Time the valueset_expansion rows of the ValueSet were last rebuilt, see refresh_valueset_expansions
+    expanded_at = db.Column(db.DateTime)
 
     source_data = db.relationship('SourceData', secondary=source_data_valueset)
 
@@ -243,6 +366,7 @@ class ValueSet(db.Model):
         self.url = self.fhir.url
 
     def update_from_fhir(self, data):
+        self.data = data
         self._fhir = self.get_fhir_obj(data=data)
         self.set_attributes_from_fhir()
 
@@ -302,21 +426,22 @@ class ValueSet(db.Model):
 
     @property
     def code_set(self):
-        code_set = set()
-        for inc in self.fhir.compose.include:
-            if hasattr(inc, 'system') and inc.system:
-                if hasattr(inc, 'concept') and inc.concept:
-                    for x in inc.concept:
-                        code_set.add(x.code)
-                else:
-                    cs = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
-                    if cs:
-                        code_set = code_set | cs.code_set
-            if hasattr(inc, 'valueset') and inc.valueset:
-                code_set = code_set | inc.valueset.code_set
-        return code_set
+        """
+        The codes of the materialized expansion of the ValueSet
+        """
+        query = db.session.query(ValueSetExpansion.code).filter(ValueSetExpansion.valueset_id == self.id)
+        return set(code for code, in query)
 
-    def get_concept(self, code):
+    def get_concept(self, code, codesystems=None):
+        """
+        Find the concept for a code in the systems included by the ValueSet
+        :param code:
+            The code to look up
+        :param codesystems:
+            Optional dict used to memoize CodeSystem lookups by url across calls
+        :return:
+            fhirclient concept object or None
+        """
         for inc in self.fhir.compose.include:
             if hasattr(inc, 'system') and inc.system:
                 if hasattr(inc, 'concept') and inc.concept:
@@ -324,7 +449,12 @@ class ValueSet(db.Model):
                         if x.code == code:
                             return x
                 else:
-                    cs = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
+                    if codesystems is None:
+                        cs = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
+                    else:
+                        if inc.system not in codesystems:
+                            codesystems[inc.system] = CodeSystem.query.filter(CodeSystem.url == inc.system).first()
+                        cs = codesystems[inc.system]
                     if cs:
                         x = cs.get_concept(code)
                         if x:
@@ -337,21 +467,288 @@ class ValueSet(db.Model):
 
     @staticmethod
     def get_valueset_concept(url, code):
-        vs = ValueSet.query.filter(ValueSet.url == url).first()
-        if vs:
-            return vs.get_concept(code)
-        return None
+        """
+        The concept of a code in the ValueSet with a url, from the terminology cache
+        :return:
+            Concept namedtuple of code, display and system, or None
+        """
+        return terminology_cache.get(url, code)
 
     def dump_fhir_json(self):
         return self.data  # same as self.fhir.as_json()
 
     def before_insert(self):
-        json_data = json.dumps(self.data, default=json_serial, sort_keys=True)
-        self.data_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest()
+        self.data_hash = hash_data(self.data)
 
     def before_update(self):
-        json_data = json.dumps(self.data, default=json_serial, sort_keys=True)
-        self.data_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest()
+        self.data_hash = hash_data(self.data)
+
+
+##################################################################################################
+# VALUESET EXPANSIONS & TERMINOLOGY CACHE
+##################################################################################################
+
+# A concept of a ValueSet, with the url of the CodeSystem that defines it
+Concept = namedtuple('Concept', ['code', 'display', 'system'])
+
+
+def flatten_codesystem(data):
+    """
+    The concepts of a CodeSystem, including nested concepts
+    :param data:
+        A JSON FHIR CodeSystem resource
+    :return:
+        dict of Concepts by code.  When a code is defined more than once, the shallowest definition is kept.
+    """
+    system = data.get('url')
+    concepts = {}
+    for concept, ancestors in walk_codesystem(data):
+        code = concept.get('code')
+        if code and code not in concepts:
+            concepts[code] = Concept(code=code, display=concept.get('display'), system=system)
+    return concepts
+
+
+def expand_valueset(url, valuesets, codesystems, expanded):
+    """
+    The concepts of a ValueSet:  the concepts its compose.include elements list, every concept of the CodeSystems
+    they include whole, and the concepts of the ValueSets they include by url.  Filters are not supported.
+    :param url:
+        The url of the ValueSet
+    :param valuesets:
+        dict of JSON FHIR ValueSet resources by url
+    :param codesystems:
+        dict of flattened CodeSystems by url, see flatten_codesystem
+    :param expanded:
+        dict of the ValueSets already expanded by url, which also guards against ValueSets including each other
+    :return:
+        dict of Concepts by code.  The first include that defines a code wins.
+    """
+    if url in expanded:
+        return expanded[url]
+    concepts = expanded[url] = {}
+    compose = (valuesets.get(url) or {}).get('compose') or {}
+    for inc in compose.get('include') or []:
+        system = inc.get('system')
+        if system:
+            defined = codesystems.get(system) or {}
+            if inc.get('concept'):
+                for concept in inc['concept']:
+                    code = concept.get('code')
+                    display = concept.get('display') or getattr(defined.get(code), 'display', None)
+                    concepts.setdefault(code, Concept(code=code, display=display, system=system))
+            else:
+                for code, concept in defined.items():
+                    concepts.setdefault(code, concept)
+        for included_url in inc.get('valueSet') or []:
+            for code, concept in expand_valueset(included_url, valuesets, codesystems, expanded).items():
+                concepts.setdefault(code, concept)
+    return concepts
+
+
+def included_valuesets(data):
+    """
+    The urls of the ValueSets a JSON FHIR ValueSet includes by reference
+    """
+    urls = []
+    for inc in ((data or {}).get('compose') or {}).get('include') or []:
+        urls.extend(inc.get('valueSet') or [])
+    return urls
+
+
+def load_codesets():
+    """
+    Load every ValueSet and CodeSystem, with one query each
+    :return:
+        tuple of a dict of JSON FHIR ValueSet resources by url and a dict of flattened CodeSystems by url
+    """
+    codesystems = {}
+    for url, data in db.session.query(CodeSystem.url, CodeSystem.data).order_by(CodeSystem.id):
+        if url not in codesystems:
+            codesystems[url] = flatten_codesystem(data or {})
+    valuesets = {}
+    for url, data in db.session.query(ValueSet.url, ValueSet.data).order_by(ValueSet.id):
+        valuesets.setdefault(url, data)
+    return valuesets, codesystems
+
+
+class ValueSetExpansion(db.Model):
+    """
+    The materialized expansion of a ValueSet, one row per concept, as computed by expand_valueset.  The rows of a
+    ValueSet are rebuilt by refresh_valueset_expansions when the ValueSet or a CodeSystem it includes changes.
+    """
+    __tablename__ = 'valueset_expansion'
+    __table_args__ = (db.Index('ix_valueset_expansion_code', 'valueset_id', 'code',
+                               postgresql_ops={'code': 'text_pattern_ops'}),
+                      trigram_index('ix_valueset_expansion_display_trgm', 'display'))
+
+    valueset_id = db.Column(db.Integer, db.ForeignKey('valueset.id', ondelete='CASCADE'), primary_key=True)
+    system = db.Column(db.Text, primary_key=True)
+    code = db.Column(db.Text, primary_key=True)
+    display = db.Column(db.Text)
+
+    def __repr__(self):  # pragma: no cover
+        return '<ValueSetExpansion {}:{}|{}>'.format(self.valueset_id, self.system, self.code)
+
+    def as_json(self):
+        """
+        The expansion.contains element of the concept
+        """
+        contains = {'system': self.system, 'code': self.code}
+        if self.display:
+            contains['display'] = self.display
+        return contains
+
+
+def refresh_valueset_expansions(valueset_urls=(), codesystem_urls=()):
+    """
+    Rebuild the valueset_expansion rows of the ValueSets with the urls, of every ValueSet that includes one of the
+    CodeSystems, and of every ValueSet that includes one of those ValueSets by reference.  The changes are flushed but
+    not committed.
+    :param valueset_urls:
+        Iterable of the urls of changed ValueSets
+    :param codesystem_urls:
+        Iterable of the urls of changed CodeSystems
+    :return:
+        The number of ValueSets whose expansion was rebuilt
+    """
+    valuesets, codesystems = load_codesets()
+    codesystem_urls = set(codesystem_urls)
+    refreshed = set(valueset_urls)
+    pending = True
+    while pending:
+        pending = False
+        for url, data in valuesets.items():
+            if url in refreshed:
+                continue
+            includes = ((data or {}).get('compose') or {}).get('include') or []
+            if any(inc.get('system') in codesystem_urls for inc in includes) or \
+                    refreshed.intersection(included_valuesets(data)):
+                refreshed.add(url)
+                pending = True
+    if not refreshed:
+        return 0
+
+    ids = db.session.query(ValueSet.id, ValueSet.url).filter(ValueSet.url.in_(refreshed)).all()
+    if not ids:
+        return 0
+    db.session.query(ValueSetExpansion).filter(ValueSetExpansion.valueset_id.in_([vs_id for vs_id, url in ids])) \
+        .delete(synchronize_session=False)
+    expanded = {}
+    rows = []
+    for vs_id, url in ids:
+        for concept in expand_valueset(url, valuesets, codesystems, expanded).values():
+            rows.append({'valueset_id': vs_id, 'system': concept.system, 'code': concept.code,
+                         'display': concept.display})
+    if rows:
+        db.session.execute(ValueSetExpansion.__table__.insert(), rows)
+    db.session.query(ValueSet).filter(ValueSet.id.in_([vs_id for vs_id, url in ids])) \
+        .update({'expanded_at': datetime.utcnow()}, synchronize_session=False)
+    # Bulk writes are not seen by the after_flush listener of the terminology cache
+    db.session.info['terminology_changed'] = True
+    return len(ids)
+
+
+class TerminologyCache(object):
+    """
+    Per-process cache of the concepts of every ValueSet by (ValueSet url, code), so looking up the display of a
+    code does not query or parse any ValueSet or CodeSystem.
+
+    The cache is built from the valueset_expansion table with one query the first time it is used.  It is dropped when
+    the process commits a change to a CodeSystem, a ValueSet or an expansion, and rebuilt when the signature of the
+    data_hash and expanded_at values of the valueset table no longer matches the one it was built from.  The
+    signature is checked at most once every TERMINOLOGY_CACHE_CHECK_INTERVAL seconds, which bounds how long other
+    processes serve concepts that were changed.
+    """
+
+    def __init__(self):
+        self.concepts = None
+        self.signature = None
+        self.checked_at = 0
+
+    @staticmethod
+    def check_interval():
+        if has_app_context():
+            return current_app.config.get('TERMINOLOGY_CACHE_CHECK_INTERVAL', DEFAULT_TERMINOLOGY_CHECK_INTERVAL)
+        return DEFAULT_TERMINOLOGY_CHECK_INTERVAL
+
+    @staticmethod
+    def current_signature():
+        """
+        Digest of the ids, data_hash and expanded_at values of the valueset table, computed by the database.  Every
+        change to the expansion of a ValueSet sets its expanded_at.
+        """
+        row = func.concat(ValueSet.id, ':', ValueSet.data_hash, ':', ValueSet.expanded_at)
+        return db.session.query(func.md5(func.string_agg(row, aggregate_order_by(literal_column("','"),
+                                                                                 ValueSet.id)))).scalar()
+
+    def load(self):
+        """
+        Build the cache from the valueset_expansion table
+        :return:
+            dict of Concepts by (ValueSet url, code)
+        """
+        signature = self.current_signature()
+        query = db.session.query(ValueSet.url, ValueSetExpansion.code, ValueSetExpansion.display,
+                                 ValueSetExpansion.system) \
+            .join(ValueSetExpansion, ValueSetExpansion.valueset_id == ValueSet.id) \
+            .order_by(ValueSet.id, ValueSetExpansion.system)
+        concepts = {}
+        for url, code, display, system in query:
+            if (url, code) not in concepts:
+                concepts[(url, code)] = Concept(code=code, display=display, system=system)
+        self.concepts, self.signature, self.checked_at = concepts, signature, time.time()
+        return concepts
+
+    def refresh(self):
+        """
+        The cached concepts, rebuilt first when they were dropped or the signature check finds them stale
+        """
+        concepts = self.concepts
+        if concepts is None:
+            return self.load()
+        now = time.time()
+        if now - self.checked_at >= self.check_interval():
+            self.checked_at = now
+            if self.current_signature() != self.signature:
+                return self.load()
+        return concepts
+
+    def clear(self):
+        self.concepts = None
+
+    def get(self, url, code):
+        """
+        :param url:
+            The url of a ValueSet
+        :param code:
+            A code of the ValueSet
+        :return:
+            The Concept of the code, or None when the ValueSet or the code is unknown
+        """
+        return self.refresh().get((url, code))
+
+
+terminology_cache = TerminologyCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def record_changed_codesets(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (CodeSystem, ValueSet)):
+            session.info['terminology_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def clear_terminology_cache(session):
+    if session.info.pop('terminology_changed', None):
+        terminology_cache.clear()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_codesets(session):
+    session.info.pop('terminology_changed', None)
 
 
 ###########################################################
@@ -402,7 +799,9 @@ def process_fhir_codeset(source_data):
     """Accepts a source_data row as it's only parameter.  If the source_data row is valid, unpacks
     the source data payload into either a ValueSet or CodeSystem object.  Updates existing objects
     in place if they have been modified.  If ValueSet has a CodeSystem dependency that is not met,
-    recursively calls this function to satisfy requirement and create CodeSystem object."""
+    recursively calls this function to satisfy requirement and create CodeSystem object.  The concept index of a changed
+    CodeSystem, and the materialized expansions of the ValueSets affected by a changed ValueSet or CodeSystem, are
+    refreshed in the same transaction."""
     if source_data and isinstance(source_data, SourceData) and source_data.route in ['/codesystem', '/valueset']:
         # TODO: Error handling in this function
         # TODO: Process any codesets in source_data that do not have association object entries
@@ -413,7 +812,9 @@ def process_fhir_codeset(source_data):
             if not obj:
                 obj = CodeSystem(data=data)
                 source_data.status_code = 201
+                changed = True
             else:
+                changed = obj.data_hash != hash_data(data)
                 obj.update_from_fhir(data)
                 source_data.status_code = 200
 
@@ -421,6 +822,10 @@ def process_fhir_codeset(source_data):
             source_data.response = {}
             db.session.add(source_data)
             db.session.add(obj)
+            if changed:
+                db.session.flush()
+                refresh_codesystem_concepts(obj)
+                refresh_valueset_expansions(codesystem_urls=[obj.url])
             db.session.commit()
 
         elif source_data.route == '/valueset':
@@ -428,7 +833,9 @@ def process_fhir_codeset(source_data):
             if not obj:
                 obj = ValueSet(data=data)
                 source_data.status_code = 201
+                changed = True
             else:
+                changed = obj.data_hash != hash_data(data)
                 obj.update_from_fhir(data)
                 source_data.status_code = 200
 
@@ -436,6 +843,9 @@ def process_fhir_codeset(source_data):
             source_data.response = {}
             db.session.add(source_data)
             db.session.add(obj)
+            if changed:
+                db.session.flush()
+                refresh_valueset_expansions(valueset_urls=[obj.url])
             db.session.commit()
 
             if obj.codesystem_dependencies:
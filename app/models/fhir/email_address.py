@@ -4,8 +4,8 @@ from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
 
 from app.utils import validate_email
 from app.utils.demographics import *
-from app.utils.general import json_serial
-from app.models.extensions import BaseExtension
+from app.utils.json_backend import hash_data
+from app.models.extensions import BaseExtension, trigram_index
 from fhirclient.models import contactpoint
 
 import hashlib, json
@@ -19,6 +19,7 @@ class EmailAddress(db.Model):
     __tablename__ = 'email_address'
     __versioned__ = {}
     __mapper_args__ = {'extension': BaseExtension()}
+    __table_args__ = (trigram_index('ix_email_address_email_trgm', 'email'),)
 
     id = db.Column(db.Integer, primary_key=True, index=True)
     email = db.Column("email", db.Text, index=True)
@@ -43,9 +44,18 @@ class EmailAddress(db.Model):
         __doc__ = """
         Generate an MD5 hash of the user's email.  Stores the result in the user
         'avatar_hash' attribute.  This value is used when constructing the gravatar URL."""
-        if self.email and not re.search(r'(@EXAMPLE)+', self.email):
-            email_lower = self.email.lower()
-            self.avatar_hash = hashlib.md5(email_lower.encode('utf-8')).hexdigest()
+        avatar_hash = self.make_avatar_hash(self.email)
+        if avatar_hash:
+            self.avatar_hash = avatar_hash
+
+    @staticmethod
+    def make_avatar_hash(email):
+        """
+        The MD5 hash of an email used in gravatar URLs, or None for missing and example emails
+        """
+        if email and not re.search(r'(@EXAMPLE)+', email):
+            return hashlib.md5(email.lower().encode('utf-8')).hexdigest()
+        return None
 
     def gravatar_url(self, size=100, default='identicon', rating='g'):
         __doc__ = """
@@ -114,15 +124,39 @@ class EmailAddress(db.Model):
 
         self._fhir = fhir_contact
 
+    def build_fhir_dict(self):
+        """
+        Build the FHIR ContactPoint JSON of the email address directly as a dict, without the fhirclient object
+        :return:
+            dict equal to the as_json() output of the fhirclient ContactPoint
+        """
+        fhir_contact = {'system': 'email'}
+        if self.active:
+            fhir_contact['use'] = 'home'
+            fhir_contact['rank'] = 1 if self.primary else 2
+        else:
+            fhir_contact['use'] = 'old'
+            fhir_contact['rank'] = 3
+
+        if self.email:
+            fhir_contact['value'] = self.email
+
+        return fhir_contact
+
     def dump_fhir_json(self):
         self.create_fhir_object()
         return self.fhir.as_json()
 
+    @staticmethod
+    def hash_row(values):
+        """
+        The row_hash of an email address row from a dict of its column values.  Used by generate_row_hash, and by
+        bulk loads that write rows without ORM objects.
+        """
+        return hash_data({column: values.get(column) for column in ('email', 'patient_id', 'user_id')})
+
     def generate_row_hash(self):
-        data = {"email": self.email, "patient_id": self.patient_id, "user_id": self.user_id}
-        data_str = json.dumps(data, sort_keys=True, default=json_serial)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+        return self.hash_row({"email": self.email, "patient_id": self.patient_id, "user_id": self.user_id})
 
     def before_insert(self):
         self.row_hash = self.generate_row_hash()
@@ -1,6 +1,10 @@
 from datetime import datetime
+from flask import url_for
+from sqlalchemy import inspect
 from app import db
 from app.models.extensions import BaseExtension
+from app.utils.fhir_utils import fhir_gen_datetime
+from fhirclient.models import organization as fhir_organization, meta, codeableconcept, coding, fhirreference
 
 
 class Organization(db.Model):
@@ -26,6 +30,76 @@ class Organization(db.Model):
     def __repr__(self):  # pragma: no cover
         return '<Organization {}:{}>'.format(self.id, self.name)
 
+    def get_url(self):
+        """
+        Helper method to build the api url of the Organization resource
+        :return:
+            Returns the absolute URL of the Organization resource in the Organization api.
+        """
+        return url_for('api_v1.organization_read', id=self.id, _external=True)
+
+    @property
+    def fhir(self):
+        """
+        Returns fhir-client Organization model object associated with SQLAlchemy Instance
+        If no fhir-client object is initialized, one is created and stored in protected attrib _fhir
+        :return:
+            fhir-client Organization object matching SQLAlchemy ORM object instance
+        """
+        if not getattr(self, '_fhir', None):
+            self.create_fhir_object()
+        return self._fhir
+
+    @fhir.setter
+    def fhir(self, fhir_obj):
+        """
+        Allows setting of the protected attribute _fhir
+        Validates object is fhir-client model Organization object
+        :param fhir_obj:
+            A fhir-client Organization model object instance
+        :return:
+            None
+        """
+        if not isinstance(fhir_obj, fhir_organization.Organization):
+            raise TypeError('Object is not a fhirclient.models.organization.Organization object')
+        self._fhir = fhir_obj
+
+    def create_fhir_object(self):
+        """
+        Generate a fhirclient.Organization class object and store in the protected attribute _fhir
+        :return:
+            None
+        """
+        # Organization object must be persistent to generate FHIR attributes
+        if inspect(self).persistent:
+            fhir_org = fhir_organization.Organization()
+            fhir_org.id = self.get_url()
+
+            fhir_meta = meta.Meta()
+            fhir_meta.lastUpdated = fhir_gen_datetime(value=self.updated_at, error_out=False, to_date=False)
+            fhir_org.meta = fhir_meta
+
+            fhir_org.name = self.name
+            fhir_org.active = self.active
+
+            if self.type:
+                type_coding = coding.Coding()
+                type_coding.system = 'http://hl7.org/fhir/organization-type'
+                type_coding.code = self.type
+                type_cc = codeableconcept.CodeableConcept()
+                type_cc.coding = [type_coding]
+                fhir_org.type = [type_cc]
+
+            if self.parent_id:
+                fhir_org.partOf = fhirreference.FHIRReference()
+                fhir_org.partOf.reference = url_for('api_v1.organization_read', id=self.parent_id, _external=True)
+
+            self._fhir = fhir_org
+
+    def dump_fhir_json(self):
+        self.create_fhir_object()
+        return self.fhir.as_json()
+
     def before_insert(self):
         pass
 
@@ -1,25 +1,45 @@
 from app import db, ma
 from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
-from sqlalchemy import inspect
+from sqlalchemy import inspect, func
+from sqlalchemy_continuum import version_class
 from marshmallow import fields, post_load
 from app.utils.demographics import *
 from flask import url_for, render_template
-from app.utils.general import json_serial
+from app.utils.general import fold_search_key
+from app.utils.json_backend import hash_data
 from app.models.fhir.address import Address, AddressSchema
 from app.models.fhir.email_address import EmailAddress, EmailAddressSchema
 from app.models.fhir.phone_number import PhoneNumber, PhoneNumberSchema
 from app.models.fhir.codesets import ValueSet, CodeSystem
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, trigram_index, search_key_index
 from fhirclient.models import patient as fhir_patient, meta, codeableconcept, coding, extension, identifier, narrative
-from app.utils.fhir_utils import fhir_gen_humanname, fhir_gen_datetime
+from app.utils.fhir_utils import fhir_gen_humanname, fhir_gen_datetime, fhir_humanname_json, fhir_datetime_json, \
+    codeable_concept_json, use_fhirclient_serializer
 from app.utils.demographics import race_dict, ethnicity_dict
-import hashlib, json, uuid
+import uuid
+from collections import OrderedDict
 
 
 class Patient(db.Model):
     __tablename__ = 'patient'
-    __versioned__ = {}
+    # Folded shadow columns used by FHIR string search, keyed by the column they are generated from
+    search_keys = {'first_name': 'first_name_key',
+                   'middle_name': 'middle_name_key',
+                   'last_name': 'last_name_key'}
+    __versioned__ = {'exclude': list(search_keys.values())}
     __mapper_args__ = {'extension': BaseExtension()}
+    # Composite (sort key, id) indexes back keyset pagination of searchset bundles
+    # Trigram indexes back the :contains and :text name searches
+    __table_args__ = (db.Index('ix_patient_last_name_id', 'last_name', 'id'),
+                      db.Index('ix_patient_first_name_id', 'first_name', 'id'),
+                      db.Index('ix_patient_dob_id', 'dob', 'id'),
+                      db.Index('ix_patient_updated_at_id', 'updated_at', 'id'),
+                      trigram_index('ix_patient_first_name_trgm', 'first_name'),
+                      trigram_index('ix_patient_middle_name_trgm', 'middle_name'),
+                      trigram_index('ix_patient_last_name_trgm', 'last_name'),
+                      search_key_index('ix_patient_first_name_key', 'first_name_key'),
+                      search_key_index('ix_patient_middle_name_key', 'middle_name_key'),
+                      search_key_index('ix_patient_last_name_key', 'last_name_key'))
 
     id = db.Column(db.Integer, primary_key=True, index=True)
     uuid = db.Column(postgresql_uuid(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
@@ -42,6 +62,9 @@ class Patient(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow())
     updated_at = db.Column(db.DateTime)
     row_hash = db.Column(db.Text, index=True)
+    first_name_key = db.Column(db.Text)
+    middle_name_key = db.Column(db.Text)
+    last_name_key = db.Column(db.Text)
     addresses = db.relationship("Address", order_by=Address.id.desc(), back_populates="patient", lazy="dynamic",
                                 cascade="all, delete, delete-orphan")
     email_addresses = db.relationship("EmailAddress", order_by=EmailAddress.id.desc(), back_populates="patient",
@@ -51,6 +74,38 @@ class Patient(db.Model):
                                     lazy="dynamic",
                                     cascade="all, delete, delete-orphan")
 
+    # The columns and child collections read to render each top level element of the FHIR Patient resource.  Used to
+    # load and serialize only the elements requested with the _elements and _summary search parameters.
+    fhir_elements = OrderedDict([('identifier', {'columns': ['uuid', 'ssn'], 'relationships': []}),
+                                 ('active', {'columns': ['active'], 'relationships': []}),
+                                 ('name', {'columns': ['first_name', 'middle_name', 'last_name', 'prefix', 'suffix'],
+                                           'relationships': []}),
+                                 ('telecom', {'columns': [], 'relationships': ['phone_numbers', 'email_addresses']}),
+                                 ('gender', {'columns': ['sex'], 'relationships': []}),
+                                 ('birthDate', {'columns': ['dob'], 'relationships': []}),
+                                 ('deceased', {'columns': ['deceased', 'deceased_date'], 'relationships': []}),
+                                 ('address', {'columns': [], 'relationships': ['addresses']}),
+                                 ('maritalStatus', {'columns': ['marital_status'], 'relationships': []}),
+                                 ('communication', {'columns': ['preferred_language'], 'relationships': []}),
+                                 ('extension', {'columns': ['race', 'ethnicity', 'sex'], 'relationships': []})])
+
+    # Elements rendered for _summary=true.  The summary is limited to elements stored on the patient table, so
+    # summary searches never query the telecom and address tables.
+    fhir_summary_elements = ['identifier', 'active', 'name', 'gender', 'birthDate', 'deceased']
+
+    # ValueSets used to display coded values, by the element that displays them
+    fhir_valuesets = {'maritalStatus': 'http://hl7.org/fhir/ValueSet/marital-status',
+                      'extension': 'http://hl7.org/fhir/us/core/ValueSet/omb-race-category',
+                      'communication': 'http://hl7.org/fhir/ValueSet/languages'}
+
+    # Columns the row_hash is computed from
+    row_hash_columns = ('first_name', 'last_name', 'middle_name', 'dob', 'sex', 'prefix', 'suffix', 'race', 'ethnicity',
+                        'marital_status', 'deceased', 'deceased_date', 'multiple_birth', 'ssn', 'preferred_language',
+                        'active')
+
+    fhir_sex_codes = {"administrativeGender": {"M": "male", "F": "female", "u": "unknown", "o": "other"},
+                      "usCoreBirthSex": {"M": "M", "F": "F", "U": "UNK", "O": "UNK"}}
+
     def __init__(self, first_name=None, last_name=None, middle_name=None, suffix=None, email=None,
                  home_phone=None, mobile_phone=None, work_phone=None, ssn=None, race=None, ethnicity=None, sex=None,
                  dob=None, deceased=False, deceased_date=None, addresses=None, multiple_birth=None,
@@ -364,6 +419,128 @@ class Patient(db.Model):
         :return:
             None
         """
+        fhir_pt = self.build_fhir_object()
+        if fhir_pt:
+            self._fhir = fhir_pt
+
+    @classmethod
+    def fhir_element_columns(cls, elements):
+        """
+        List the column attribute names needed to render a subset of the FHIR Patient elements
+        :param elements:
+            Iterable of top level element names, keys of fhir_elements
+        :return:
+            List of column attribute names, for use with load_only()
+        """
+        columns = ['id', 'updated_at']
+        for element in elements:
+            for column in cls.fhir_elements[element]['columns']:
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
+    @classmethod
+    def prefetch_fhir(cls, patients, elements=None):
+        """
+        Load everything build_fhir_object reads from other tables for a page of patients, so that the page is
+        serialized with a fixed number of queries:  one IN query per child collection and one grouped count of
+        versions.  Codes are displayed from the terminology cache.  The rows are kept on each patient until it is
+        serialized.
+        :param patients:
+            List of persistent Patient objects
+        :param elements:
+            The elements that will be rendered, as passed to build_fhir_object.  None prefetches for every element.
+        :return:
+            None
+        """
+        if not patients:
+            return
+        ids = [pt.id for pt in patients]
+        prefetched = {pt_id: {} for pt_id in ids}
+        rendered = list(cls.fhir_elements.keys()) if elements is None else elements
+
+        relationships = set(r for element in rendered for r in cls.fhir_elements[element]['relationships'])
+        for key, model in [('phone_numbers', PhoneNumber), ('email_addresses', EmailAddress), ('addresses', Address)]:
+            if key in relationships:
+                for pt_id in ids:
+                    prefetched[pt_id][key] = []
+                # Ordered like the relationships, newest first
+                for child in model.query.filter(model.patient_id.in_(ids)).order_by(model.id.desc()).all():
+                    prefetched[child.patient_id][key].append(child)
+
+        # Meta.versionId is only rendered with every element
+        if elements is None:
+            version = version_class(cls)
+            counts = db.session.query(version.id, func.count(version.id)).filter(version.id.in_(ids)) \
+                .group_by(version.id).all()
+            for pt_id, count in counts:
+                prefetched[pt_id]['version_number'] = count
+
+        for pt in patients:
+            pt._fhir_prefetch = prefetched[pt.id]
+
+    @classmethod
+    def load_stored_fhir(cls, patients):
+        """
+        The FHIR JSON of patients from the materialized resource store, for the patients whose stored resource is
+        current.  See PatientResource.
+        :param patients:
+            List of persistent Patient objects
+        :return:
+            dict of FHIR JSON dicts by patient id
+        """
+        from app.models.fhir.patient_resource import PatientResource
+        return PatientResource.load(patients)
+
+    def _fhir_prefetched(self):
+        return getattr(self, '_fhir_prefetch', None) or {}
+
+    def _fhir_children(self, key):
+        """
+        The rows of a child collection, ex: 'addresses', from prefetch_fhir when it was loaded for the patient
+        """
+        children = self._fhir_prefetched().get(key)
+        if children is None:
+            children = getattr(self, key).all()
+        return children
+
+    def _fhir_version_number(self):
+        return self._fhir_prefetched().get('version_number') or self.version_number
+
+    def _fhir_valueset_concept(self, url, code):
+        """
+        Look up the ValueSet concept of a code in the terminology cache
+        """
+        return ValueSet.get_valueset_concept(url, code)
+
+    def render_fhir_narrative(self, fhir_json):
+        """
+        Render the generated xhtml narrative of the Patient
+        :param fhir_json:
+            dict of the FHIR JSON of every element of the Patient
+        :return:
+            dict of the FHIR Narrative JSON
+        """
+        xhtml = render_template('fhir/patient.html', fhir_patient=fhir_json, patient=self)
+        return {'status': 'generated', 'div': xhtml}
+
+    def build_fhir_object(self, elements=None, include_narrative=True):
+        """
+        Build a fhirclient.Patient class object from the SQLAlchemy ORM object
+        :param elements:
+            Iterable of the top level elements to render, keys of fhir_elements.  None renders every element.
+            Only the columns and child collections behind the requested elements are read, so a Patient loaded
+            with load_only(*Patient.fhir_element_columns(elements)) is rendered without further queries.
+            Meta.versionId is only set when every element is rendered.
+        :param include_narrative:
+            When False, the generated xhtml narrative is skipped
+        :return:
+            fhirclient.Patient object, tagged SUBSETTED when elements or the narrative were left out
+            None if the Patient is not persistent
+        """
+        def wants(element):
+            return elements is None or element in elements
+
         # Patient object must be persistent to generate FHIR attributes
         ins = inspect(self)
         if ins.persistent:
@@ -376,72 +553,81 @@ class Patient(db.Model):
             # Build and assign Meta resource for Patient object
             fhir_meta = meta.Meta()
             fhir_meta.lastUpdated = fhir_gen_datetime(value=self.updated_at, error_out=False, to_date=False)
-            fhir_meta.versionId = str(self.version_number)
+            if elements is None:
+                fhir_meta.versionId = str(self._fhir_version_number())
             fhir_meta.profile = ['http://hl7.org/fhir/us/core/StructureDefinition/us-core-patient']
+            if elements is not None or not include_narrative:
+                subsetted = coding.Coding()
+                subsetted.system = 'http://hl7.org/fhir/v3/ObservationValue'
+                subsetted.code = 'SUBSETTED'
+                subsetted.display = 'subsetted'
+                fhir_meta.tag = [subsetted]
             fhir_pt.meta = fhir_meta
 
             # Patient name represented as HumanName resource
-            fhir_pt.name = []
-            fhir_pt.name.append(fhir_gen_humanname(use='usual', first_name=self.first_name, last_name=self.last_name,
-                                                   middle_name=self.middle_name, suffix=self.suffix,
-                                                   prefix=self.prefix))
-            # Display MRN as identifier codeable concept = Patient.identifier.codeableconcept.coding
-            # Initialize Identifier resource
-            id_mrn = identifier.Identifier()
-            id_mrn.use = 'usual'
-            id_mrn.system = 'http://unkani.com'
-            id_mrn.value = str(self.uuid)
-
-            # Initialize CodeableConcept resource
-            mrn_cc = codeableconcept.CodeableConcept()
-            mrn_cc.text = 'Medical Record Number'
-
-            # Initialize Coding resource
-            mrn_coding = coding.Coding()
-            mrn_coding.system = 'http://hl7.org/fhir/v2/0203'
-            mrn_coding.code = 'MR'
-            mrn_coding.display = 'Medical Record Number'
-
-            # Assign Coding resource to CodeableConcept
-            mrn_cc.coding = [mrn_coding]
-
-            # Assign CodeableConcept to Identifier
-            id_mrn.type = mrn_cc
-
-            # Assign CodeableConcept to Patient
-            fhir_pt.identifier = [id_mrn]
-
-            # Display SSN as identifier codeable concept = Patient.identifier.codeableconcept.coding
-            if self.ssn:
+            if wants('name'):
+                fhir_pt.name = []
+                fhir_pt.name.append(fhir_gen_humanname(use='usual', first_name=self.first_name,
+                                                       last_name=self.last_name, middle_name=self.middle_name,
+                                                       suffix=self.suffix, prefix=self.prefix))
+            if wants('identifier'):
+                # Display MRN as identifier codeable concept = Patient.identifier.codeableconcept.coding
                 # Initialize Identifier resource
-                id_ssn = identifier.Identifier()
-                id_ssn.use = 'usual'
-                id_ssn.system = 'http://hl7.org/fhir/sid/us-ssn'
-                id_ssn.value = self.ssn
+                id_mrn = identifier.Identifier()
+                id_mrn.use = 'usual'
+                id_mrn.system = 'http://unkani.com'
+                id_mrn.value = str(self.uuid)
 
                 # Initialize CodeableConcept resource
-                ssn_cc = codeableconcept.CodeableConcept()
-                ssn_cc.text = 'Social Security Number'
+                mrn_cc = codeableconcept.CodeableConcept()
+                mrn_cc.text = 'Medical Record Number'
 
                 # Initialize Coding resource
-                ssn_coding = coding.Coding()
-                ssn_coding.system = 'http://hl7.org/fhir/v2/0203'
-                ssn_coding.code = 'SS'
-                ssn_coding.display = 'Social Security Number'
+                mrn_coding = coding.Coding()
+                mrn_coding.system = 'http://hl7.org/fhir/v2/0203'
+                mrn_coding.code = 'MR'
+                mrn_coding.display = 'Medical Record Number'
 
                 # Assign Coding resource to CodeableConcept
-                ssn_cc.coding = [ssn_coding]
+                mrn_cc.coding = [mrn_coding]
 
                 # Assign CodeableConcept to Identifier
-                id_ssn.type = ssn_cc
+                id_mrn.type = mrn_cc
 
                 # Assign CodeableConcept to Patient
-                fhir_pt.identifier.append(id_ssn)
+                fhir_pt.identifier = [id_mrn]
 
-            if self.marital_status:
+                # Display SSN as identifier codeable concept = Patient.identifier.codeableconcept.coding
+                if self.ssn:
+                    # Initialize Identifier resource
+                    id_ssn = identifier.Identifier()
+                    id_ssn.use = 'usual'
+                    id_ssn.system = 'http://hl7.org/fhir/sid/us-ssn'
+                    id_ssn.value = self.ssn
+
+                    # Initialize CodeableConcept resource
+                    ssn_cc = codeableconcept.CodeableConcept()
+                    ssn_cc.text = 'Social Security Number'
+
+                    # Initialize Coding resource
+                    ssn_coding = coding.Coding()
+                    ssn_coding.system = 'http://hl7.org/fhir/v2/0203'
+                    ssn_coding.code = 'SS'
+                    ssn_coding.display = 'Social Security Number'
+
+                    # Assign Coding resource to CodeableConcept
+                    ssn_cc.coding = [ssn_coding]
+
+                    # Assign CodeableConcept to Identifier
+                    id_ssn.type = ssn_cc
+
+                    # Assign CodeableConcept to Patient
+                    fhir_pt.identifier.append(id_ssn)
+
+            if wants('maritalStatus') and self.marital_status:
                 marital_status_cc = codeableconcept.CodeableConcept()
-                marital_status_url = 'http://hl7.org/fhir/ValueSet/marital-status'
-                marital_status_concept = ValueSet.get_valueset_concept(marital_status_url, self.marital_status)
+                marital_status_url = self.fhir_valuesets['maritalStatus']
+                marital_status_concept = self._fhir_valueset_concept(marital_status_url, self.marital_status)
                 if marital_status_concept:
                     marital_status_cc.text = getattr(marital_status_concept, 'display')
                 marital_status_coding = coding.Coding()
@@ -452,12 +638,12 @@ class Patient(db.Model):
                 marital_status_cc.coding = [marital_status_coding]
                 fhir_pt.maritalStatus = marital_status_cc
 
-            if self.race:
+            if wants('extension') and self.race:
                 ext_race = extension.Extension()
                 ext_race.url = 'http://hl7.org/fhir/StructureDefinition/us-core-race'
-                race_url = 'http://hl7.org/fhir/us/core/ValueSet/omb-race-category'
+                race_url = self.fhir_valuesets['extension']
                 cc_race = codeableconcept.CodeableConcept()
-                race_concept = ValueSet.get_valueset_concept(race_url, self.race)
+                race_concept = self._fhir_valueset_concept(race_url, self.race)
                 if race_concept:
                     cc_race.text = getattr(race_concept, 'display')
                 coding_race = coding.Coding()
@@ -471,7 +657,7 @@ class Patient(db.Model):
                 except AttributeError:
                     fhir_pt.extension = [ext_race]
 
-            if self.ethnicity:
+            if wants('extension') and self.ethnicity:
                 ext_ethnicity = extension.Extension()
                 ext_ethnicity.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
                 cc_ethnicity = codeableconcept.CodeableConcept()
@@ -488,12 +674,12 @@ class Patient(db.Model):
                 except AttributeError:
                     fhir_pt.extension = [ext_ethnicity]
 
-            if self.sex:
-                sex_dict = {"administrativeGender": {"M": "male", "F": "female", "u": "unknown", "o": "other"},
-                            "usCoreBirthSex": {"M": "M", "F": "F", "U": "UNK", "O": "UNK"}}
+            sex_dict = self.fhir_sex_codes
 
+            if wants('gender') and self.sex:
                 fhir_pt.gender = sex_dict['administrativeGender'][str(self.sex).upper()]
 
+            if wants('extension') and self.sex:
                 ext_birth_sex = extension.Extension()
                 ext_birth_sex.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex'
                 ext_birth_sex.valueCode = sex_dict['usCoreBirthSex'][str(self.sex).upper()]
@@ -503,25 +689,27 @@ class Patient(db.Model):
                 except AttributeError:
                     fhir_pt.extension = [ext_birth_sex]
 
-            if self.dob:
+            if wants('birthDate') and self.dob:
                 fhir_pt.birthDate = fhir_gen_datetime(value=self.dob, to_date=True)
 
-            fhir_pt.active = self.active
+            if wants('active'):
+                fhir_pt.active = self.active
 
-            fhir_pt.deceasedBoolean = self.deceased
+            if wants('deceased'):
+                fhir_pt.deceasedBoolean = self.deceased
 
-            if self.deceased_date:
-                fhir_pt.deceasedDateTime = fhir_gen_datetime(value=self.deceased_date, to_date=False)
+                if self.deceased_date:
+                    fhir_pt.deceasedDateTime = fhir_gen_datetime(value=self.deceased_date, to_date=False)
 
-            if self.preferred_language:
+            if wants('communication') and self.preferred_language:
                 fhir_comm = fhir_patient.PatientCommunication()
                 fhir_comm.preferred = True
                 fhir_lang_cc = codeableconcept.CodeableConcept()
                 fhir_lang_coding = coding.Coding()
                 fhir_lang_coding.code = self.preferred_language
-                fhir_lang_url = 'http://hl7.org/fhir/ValueSet/languages'
+                fhir_lang_url = self.fhir_valuesets['communication']
                 fhir_lang_coding.system = fhir_lang_url
-                fhir_lang_concept = ValueSet.get_valueset_concept(fhir_lang_url, self.preferred_language)
+                fhir_lang_concept = self._fhir_valueset_concept(fhir_lang_url, self.preferred_language)
                 if fhir_lang_concept:
                     fhir_lang_coding.display = fhir_lang_concept.display
                     fhir_lang_cc.text = fhir_lang_coding.display
@@ -529,37 +717,169 @@ class Patient(db.Model):
                 fhir_comm.language = fhir_lang_cc
                 fhir_pt.communication = [fhir_comm]
 
-            contact_point_list = []
+            # Child collections are only queried when their element is requested
+            if wants('telecom'):
+                contact_point_list = []
+
+                phone_list = self._fhir_children('phone_numbers')
+                if phone_list:
+                    for ph in phone_list:
+                        contact_point_list.append(ph.fhir)
+
+                email_list = self._fhir_children('email_addresses')
+                if email_list:
+                    for em in email_list:
+                        contact_point_list.append(em.fhir)
+
+                if contact_point_list:
+                    fhir_pt.telecom = contact_point_list
+
+            if wants('address'):
+                address_list = self._fhir_children('addresses')
+                if address_list:
+                    fhir_pt.address = []
+                    for addr in address_list:
+                        fhir_pt.address.append(addr.fhir)
+
+            if include_narrative:
+                # The narrative always describes the whole resource, even when only some elements are rendered
+                if elements is None:
+                    narrative_source = fhir_pt
+                else:
+                    narrative_source = self.build_fhir_object(include_narrative=False)
+                fhir_pt.text = narrative.Narrative(self.render_fhir_narrative(narrative_source.as_json()))
+
+            return fhir_pt
+
+    def build_fhir_dict(self, elements=None, include_narrative=True):
+        """
+        Build the FHIR JSON of the Patient directly as a dict from the ORM object and its child rows.  The output is
+        equal to build_fhir_object(...).as_json(), without building the fhirclient object graph or running its
+        validation pass.
+        :param elements:
+            Iterable of the top level elements to render, as in build_fhir_object
+        :param include_narrative:
+            When False, the generated xhtml narrative is skipped
+        :return:
+            dict of FHIR Patient JSON
+            None if the Patient is not persistent
+        """
+        def wants(element):
+            return elements is None or element in elements
 
-            phone_list = self.phone_numbers.all()
-            if phone_list:
-                for ph in phone_list:
-                    contact_point_list.append(ph.fhir)
+        if not inspect(self).persistent:
+            return None
 
-            email_list = self.email_addresses.all()
-            if email_list:
-                for em in email_list:
-                    contact_point_list.append(em.fhir)
+        fhir_pt = {'resourceType': 'Patient', 'id': self.get_url()}
 
+        fhir_meta = {'lastUpdated': fhir_datetime_json(value=self.updated_at, to_date=False),
+                     'profile': ['http://hl7.org/fhir/us/core/StructureDefinition/us-core-patient']}
+        if elements is None:
+            fhir_meta['versionId'] = str(self._fhir_version_number())
+        if elements is not None or not include_narrative:
+            fhir_meta['tag'] = [{'system': 'http://hl7.org/fhir/v3/ObservationValue', 'code': 'SUBSETTED',
+                                 'display': 'subsetted'}]
+        fhir_pt['meta'] = fhir_meta
+
+        if wants('name'):
+            fhir_pt['name'] = [fhir_humanname_json(use='usual', first_name=self.first_name, last_name=self.last_name,
+                                                   middle_name=self.middle_name, suffix=self.suffix,
+                                                   prefix=self.prefix)]
+
+        if wants('identifier'):
+            fhir_pt['identifier'] = [{'use': 'usual', 'system': 'http://unkani.com', 'value': str(self.uuid),
+                                      'type': {'text': 'Medical Record Number',
+                                               'coding': [{'system': 'http://hl7.org/fhir/v2/0203', 'code': 'MR',
+                                                           'display': 'Medical Record Number'}]}}]
+            if self.ssn:
+                fhir_pt['identifier'].append(
+                    {'use': 'usual', 'system': 'http://hl7.org/fhir/sid/us-ssn', 'value': self.ssn,
+                     'type': {'text': 'Social Security Number',
+                              'coding': [{'system': 'http://hl7.org/fhir/v2/0203', 'code': 'SS',
+                                          'display': 'Social Security Number'}]}})
+
+        if wants('maritalStatus') and self.marital_status:
+            marital_status_url = self.fhir_valuesets['maritalStatus']
+            marital_status_concept = self._fhir_valueset_concept(marital_status_url, self.marital_status)
+            display = getattr(marital_status_concept, 'display') if marital_status_concept else None
+            fhir_pt['maritalStatus'] = codeable_concept_json(system=marital_status_url, code=self.marital_status,
+                                                             display=display, text=display)
+
+        extensions = []
+        if wants('extension') and self.race:
+            race_url = self.fhir_valuesets['extension']
+            race_concept = self._fhir_valueset_concept(race_url, self.race)
+            display = getattr(race_concept, 'display') if race_concept else None
+            extensions.append({'url': 'http://hl7.org/fhir/StructureDefinition/us-core-race',
+                               'valueCodeableConcept': codeable_concept_json(system=race_url, code=self.race,
+                                                                             display=display, text=display)})
+
+        if wants('extension') and self.ethnicity:
+            display = ethnicity_dict.get(self.ethnicity)[0].capitalize()
+            extensions.append({'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity',
+                               'valueCodeableConcept': codeable_concept_json(
+                                   system='http://hl7.org/fhir/us/core/ValueSet/omb-ethnicity-category',
+                                   code=self.race, display=display, text=display)})
+
+        if wants('gender') and self.sex:
+            fhir_pt['gender'] = self.fhir_sex_codes['administrativeGender'][str(self.sex).upper()]
+
+        if wants('extension') and self.sex:
+            extensions.append({'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex',
+                               'valueCode': self.fhir_sex_codes['usCoreBirthSex'][str(self.sex).upper()]})
+        if extensions:
+            fhir_pt['extension'] = extensions
+
+        if wants('birthDate') and self.dob:
+            fhir_pt['birthDate'] = fhir_datetime_json(value=self.dob, to_date=True)
+
+        if wants('active') and self.active is not None:
+            fhir_pt['active'] = self.active
+
+        if wants('deceased'):
+            if self.deceased is not None:
+                fhir_pt['deceasedBoolean'] = self.deceased
+            if self.deceased_date:
+                fhir_pt['deceasedDateTime'] = fhir_datetime_json(value=self.deceased_date, to_date=False)
+
+        if wants('communication') and self.preferred_language:
+            fhir_lang_url = self.fhir_valuesets['communication']
+            fhir_lang_concept = self._fhir_valueset_concept(fhir_lang_url, self.preferred_language)
+            display = fhir_lang_concept.display if fhir_lang_concept else None
+            fhir_pt['communication'] = [{'preferred': True,
+                                         'language': codeable_concept_json(system=fhir_lang_url,
+                                                                           code=self.preferred_language,
+                                                                           display=display, text=display)}]
+
+        if wants('telecom'):
+            contact_point_list = [ph.build_fhir_dict() for ph in self._fhir_children('phone_numbers')]
+            contact_point_list.extend(em.build_fhir_dict() for em in self._fhir_children('email_addresses'))
             if contact_point_list:
-                fhir_pt.telecom = contact_point_list
+                fhir_pt['telecom'] = contact_point_list
 
-            address_list = self.addresses.all()
+        if wants('address'):
+            address_list = [addr.build_fhir_dict() for addr in self._fhir_children('addresses')]
             if address_list:
-                fhir_pt.address = []
-                for addr in address_list:
-                    fhir_pt.address.append(addr.fhir)
+                fhir_pt['address'] = address_list
 
-            xhtml = render_template('fhir/patient.html', fhir_patient=fhir_pt, patient=self)
-            fhir_pt.text = narrative.Narrative()
-            fhir_pt.text.status = 'generated'
-            fhir_pt.text.div = xhtml
+        if include_narrative:
+            if elements is None:
+                narrative_source = fhir_pt
+            else:
+                narrative_source = self.build_fhir_dict(include_narrative=False)
+            fhir_pt['text'] = self.render_fhir_narrative(narrative_source)
 
-            self._fhir = fhir_pt
+        return fhir_pt
 
     def dump_fhir_json(self):
-        self.create_fhir_object()
-        return self.fhir.as_json()
+        """
+        FHIR JSON of the Patient.  Built as a dict unless the validating fhirclient serializer is configured with
+        FHIR_SERIALIZER = 'fhirclient'.
+        """
+        if use_fhirclient_serializer():
+            self.create_fhir_object()
+            return self.fhir.as_json()
+        return self.build_fhir_dict()
 
     ##############################################################################################
     # Patient RANDOMIZATION UTILITIES
@@ -636,16 +956,24 @@ class Patient(db.Model):
         pt.randomize_patient(demo_dict=demo_dict)
         db.session.add(pt)
 
+    @classmethod
+    def hash_row(cls, values):
+        """
+        The row_hash of a patient row from a dict of its column values.  Used by generate_row_hash, and by bulk
+        loads that write rows without ORM objects.
+        """
+        return hash_data({column: values.get(column) for column in cls.row_hash_columns})
+
     def generate_row_hash(self):
-        data = {"first_name": self.first_name, "last_name": self.last_name, "middle_name": self.middle_name,
-                "dob": self.dob, "sex": self.sex, "prefix": self.prefix, "suffix": self.suffix, "race": self.race,
-                "ethnicity": self.ethnicity, "marital_status": self.marital_status, "deceased": self.deceased,
-                "deceased_date": self.deceased_date, "multiple_birth": self.multiple_birth, "ssn": self.ssn,
-                "preferred_language": self.preferred_language, "active": self.active}
+        return self.hash_row({column: getattr(self, column) for column in self.row_hash_columns})
 
-        data_str = json.dumps(data, sort_keys=True, default=json_serial)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+    def generate_search_keys(self):
+        """
+        Set the folded search key columns from the columns they are generated from
+        :return: None
+        """
+        for column, key_column in self.search_keys.items():
+            setattr(self, key_column, fold_search_key(getattr(self, column)))
 
     def before_insert(self):
         """
@@ -653,6 +981,7 @@ class Patient(db.Model):
         :return: None
         """
         self.row_hash = self.generate_row_hash()
+        self.generate_search_keys()
 
     def before_update(self):
         """
@@ -660,6 +989,7 @@ class Patient(db.Model):
         :return: None
         """
         self.row_hash = self.generate_row_hash()
+        self.generate_search_keys()
 
 
 class PatientSchema(ma.Schema):
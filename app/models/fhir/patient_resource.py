@@ -0,0 +1,198 @@
+from app import db, redis
+from datetime import datetime
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event, func, select, cast, Text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from app.models.fhir.patient import Patient
+from app.models.fhir.address import Address
+from app.models.fhir.email_address import EmailAddress
+from app.models.fhir.phone_number import PhoneNumber
+from app.utils.fhir_utils import use_fhirclient_serializer
+
+# Seconds during which a read does not queue another rebuild of a patient it already queued, when not set with the
+# RESOURCE_STORE_REQUEUE_AFTER config value
+DEFAULT_REQUEUE_AFTER = 60
+
+
+##################################################################################################
+# Materialized Patient FHIR JSON
+##################################################################################################
+
+class PatientResource(db.Model):
+    """
+    The pre-rendered FHIR JSON of a Patient, with its ETag:  the weak ETag of its source hash.
+
+    Each row records the source hash of the rows it was rendered from (see patient_source_hash).  A stored resource
+    is only used while its source hash still matches the patient's current rows, so a stale row is never returned:
+    reads fall back to serializing the patient and queue a rebuild.  Committed changes to a patient or its child rows
+    queue a write-behind rebuild of the patient's row with an rq job.
+    """
+    __tablename__ = 'patient_resource'
+
+    # Models whose rows are rendered into the Patient resource
+    source_models = (Patient, Address, EmailAddress, PhoneNumber)
+
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id', ondelete='CASCADE'), primary_key=True)
+    source_hash = db.Column(db.Text, nullable=False)
+    etag = db.Column(db.Text)
+    resource = db.Column(postgresql.JSONB, nullable=False)
+    rendered_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def enabled():
+        return has_app_context() and current_app.config.get('USE_RESOURCE_STORE', False) and \
+               not use_fhirclient_serializer()
+
+    @classmethod
+    def load(cls, patients):
+        """
+        Look up the stored FHIR JSON of persistent patients with a single query.  Patients without a current stored
+        resource are queued for a rebuild.
+        :param patients:
+            List of Patient objects
+        :return:
+            dict of FHIR JSON dicts by patient id, for the patients with a current stored resource
+        """
+        if not patients or not cls.enabled():
+            return {}
+        ids = [pt.id for pt in patients]
+        rows = db.session.query(cls.patient_id, cls.resource) \
+            .join(Patient, Patient.id == cls.patient_id) \
+            .filter(cls.patient_id.in_(ids), cls.source_hash == patient_source_hash()).all()
+        stored = {patient_id: resource for patient_id, resource in rows}
+
+        for pt in patients:
+            if pt.id in stored:
+                # The resource id is an absolute URL, so it is set for the host of the current request
+                stored[pt.id]['id'] = pt.get_url()
+        missing = [pt_id for pt_id in ids if pt_id not in stored]
+        if missing:
+            cls.enqueue(patient_ids=missing, dedupe=True)
+        return stored
+
+    @classmethod
+    def rebuild(cls, patient_ids):
+        """
+        Render and store the FHIR JSON of the patients whose source hash changed since their resource was stored.
+        Rows of deleted patients are removed by the foreign key.
+        :param patient_ids:
+            Iterable of Patient ids
+        :return:
+            The number of stored resources written
+        """
+        ids = list(set(patient_ids))
+        if not ids:
+            return 0
+        # The hash is read before the rows are rendered.  If a write commits in between, the stored hash is older
+        # than the rendered rows, and the resource is not used until the next rebuild.
+        hashes = dict(db.session.query(Patient.id, patient_source_hash()).filter(Patient.id.in_(ids)).all())
+        existing = dict(db.session.query(cls.patient_id, cls.source_hash).filter(cls.patient_id.in_(ids)).all())
+        changed = [pt_id for pt_id, source_hash in hashes.items() if existing.get(pt_id) != source_hash]
+        if not changed:
+            return 0
+
+        patients = Patient.query.filter(Patient.id.in_(changed)).all()
+        Patient.prefetch_fhir(patients)
+        now = datetime.utcnow()
+        for pt in patients:
+            resource = pt.build_fhir_dict()
+            values = {'source_hash': hashes[pt.id],
+                      'etag': 'W/"{}"'.format(hashes[pt.id]),
+                      'resource': resource,
+                      'rendered_at': now}
+            statement = postgresql.insert(cls.__table__).values(patient_id=pt.id, **values)
+            db.session.execute(statement.on_conflict_do_update(index_elements=[cls.__table__.c.patient_id],
+                                                               set_=values))
+        db.session.commit()
+        return len(patients)
+
+    @staticmethod
+    def queued_key(patient_id):
+        return 'patient-resource:queued:{}'.format(patient_id)
+
+    @classmethod
+    def enqueue(cls, patient_ids, dedupe=False):
+        """
+        Queue a write-behind rebuild of the stored resources of patients.  Rebuilds are skipped, and logged, when
+        Redis can not be reached.
+        :param patient_ids:
+            Iterable of Patient ids
+        :param dedupe:
+            Skip the patients already queued by a read in the last RESOURCE_STORE_REQUEUE_AFTER seconds, so repeated
+            reads of stale patients do not flood the queue while the workers are down or behind.  Rebuilds queued
+            by writes are not deduplicated, since a job already queued may have read the previous rows.
+        """
+        from app.jobs import get_queue, rebuild_patient_resources
+        ids = sorted(set(patient_ids))
+        try:
+            if dedupe:
+                ttl = current_app.config.get('RESOURCE_STORE_REQUEUE_AFTER', DEFAULT_REQUEUE_AFTER)
+                p = redis.pipeline()
+                for pt_id in ids:
+                    p.set(cls.queued_key(pt_id), 1, nx=True, ex=ttl)
+                ids = [pt_id for pt_id, added in zip(ids, p.execute()) if added]
+            if ids:
+                get_queue().enqueue(rebuild_patient_resources, ids)
+        except RedisError:
+            current_app.logger.warning('Could not queue a rebuild of {} patient resources'.format(len(ids)))
+
+
+def patient_source_hash():
+    """
+    SQL expression of the md5 hash of every row rendered into a Patient resource:  the patient row and its addresses,
+    email addresses and phone numbers.  Each row contributes its id, row_hash and updated_at, so a change to any
+    column, and any added or removed child row, changes the hash.  The expression is correlated to the Patient
+    table of the enclosing query.
+    """
+    parts = [Patient.row_hash, cast(Patient.updated_at, Text)]
+    for model in PatientResource.source_models[1:]:
+        row_key = func.concat(model.id, ':', model.row_hash, ':', cast(model.updated_at, Text))
+        parts.append(select([func.string_agg(row_key, postgresql.aggregate_order_by(',', model.id))])
+                     .where(model.patient_id == Patient.id).as_scalar())
+    separated = []
+    for part in parts:
+        separated.extend([part, '|'])
+    return func.md5(func.concat(*separated[:-1]))
+
+
+def patient_last_modified():
+    """
+    SQL expression of the latest updated_at of the rows rendered into a Patient resource.  Deleted child rows leave no
+    timestamp, so removing a child row is only detected by patient_source_hash.  The expression is correlated to the
+    Patient table of the enclosing query.
+    """
+    latest = [Patient.updated_at]
+    for model in PatientResource.source_models[1:]:
+        latest.append(select([func.max(model.updated_at)]).where(model.patient_id == Patient.id).as_scalar())
+    return func.greatest(*latest)
+
+
+##############################################################################################
+# Write-behind rebuilds
+##############################################################################################
+@event.listens_for(Session, 'after_flush')
+def record_changed_patients(session, flush_context):
+    """
+    Remember the ids of patients whose rows were written by each flush until the transaction ends
+    """
+    changed = session.info.setdefault('resource_store_changed', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Patient):
+            changed.add(obj.id)
+        elif isinstance(obj, PatientResource.source_models) and getattr(obj, 'patient_id', None):
+            changed.add(obj.patient_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def rebuild_changed_patients(session):
+    changed = session.info.pop('resource_store_changed', None)
+    changed = set(changed or []) - {None}
+    if changed and PatientResource.enabled():
+        PatientResource.enqueue(patient_ids=changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_patients(session):
+    session.info.pop('resource_store_changed', None)
@@ -4,9 +4,10 @@ from datetime import datetime
 from sqlalchemy.dialects.postgresql import UUID as postgresql_uuid
 
 from app.utils.demographics import validate_phone, validate_contact_type, format_phone
-from app.models.extensions import BaseExtension
+from app.models.extensions import BaseExtension, trigram_index
 from fhirclient.models import contactpoint
-import hashlib, json
+import json
+from app.utils.json_backend import hash_data
 
 
 ##################################################################################################
@@ -16,6 +17,7 @@ class PhoneNumber(db.Model):
     __tablename__ = 'phone_number'
     __versioned__ = {}
     __mapper_args__ = {'extension': BaseExtension()}
+    __table_args__ = (trigram_index('ix_phone_number_number_trgm', 'number'),)
 
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column("number", db.Text)
@@ -40,13 +42,16 @@ class PhoneNumber(db.Model):
         self.patient_id = patient_id
         self._fhir = None
 
+    @staticmethod
+    def hash_row(values):
+        """
+        The row_hash of a phone number row from a dict of its column values.  Used by generate_row_hash, and by bulk
+        loads that write rows without ORM objects.
+        """
+        return hash_data({column: str(values.get(column)) for column in ('number', 'type', 'active')})
+
     def generate_row_hash(self):
-        data = {"number": self.number, "type": self.type, "active": self.active}
-        for key in data:
-            data[key] = str(data[key])
-        data_str = json.dumps(data, sort_keys=True)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+        return self.hash_row({"number": self.number, "type": self.type, "active": self.active})
 
     def before_insert(self):
         self.row_hash = self.generate_row_hash()
@@ -107,6 +112,28 @@ class PhoneNumber(db.Model):
 
         self._fhir = fhir_contact
 
+    def build_fhir_dict(self):
+        """
+        Build the FHIR ContactPoint JSON of the phone number directly as a dict, without the fhirclient object
+        :return:
+            dict equal to the as_json() output of the fhirclient ContactPoint
+        """
+        fhir_contact = {'system': 'phone'}
+
+        if self.active:
+            fhir_contact['use'] = self.type.lower()
+            fhir_contact['rank'] = 1 if self.primary else 2
+        else:
+            fhir_contact['use'] = 'old'
+            fhir_contact['rank'] = 3
+
+        if self.number:
+            value = self.formatted_phone
+            if value is not None:
+                fhir_contact['value'] = value
+
+        return fhir_contact
+
     def dump_fhir_json(self):
         self.create_fhir_object()
         return self.fhir.as_json()
@@ -1,4 +1,4 @@
-import os, hashlib, json, base64
+import os, json, base64
 from flask import current_app, g, url_for
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_login import UserMixin, AnonymousUserMixin, current_user
@@ -19,7 +19,7 @@ from app.models.app_group import user_app_group, AppGroup, AppGroupSchema
 from app.security import app_permission_useractivation, app_permission_userforceconfirmation, \
     app_permission_userpasswordchange, app_permission_userrolechange, app_permission_userappgroupupdate
 from app.utils.demographics import *
-from app.utils.general import json_serial
+from app.utils.json_backend import hash_data
 from sqlalchemy_continuum import version_class
 
 
@@ -628,9 +628,7 @@ class User(UserMixin, db.Model):
                 "last_password_hash": self.last_password_hash, "password_timestamp": self.password_timestamp,
                 "description": self.description, "confirmed": self.confirmed, "active": self.active,
                 "last_seen": self.last_seen, "created_at": self.created_at, "updated_at": self.updated_at}
-        data_str = json.dumps(data, sort_keys=True, default=json_serial)
-        data_hash = hashlib.sha1(data_str.encode('utf-8')).hexdigest()
-        return data_hash
+        return hash_data(data)
 
     def before_insert(self):
         self.row_hash = self.generate_row_hash()
@@ -1,3 +1,6 @@
+import isodate
+from datetime import date, datetime, time
+from flask import current_app, has_app_context
 from fhirclient.models import humanname, fhirdate
 from app.utils.type_validation import validate_datetime
 
@@ -55,3 +58,96 @@ def fhir_gen_datetime(value=None, to_date=False, error_out=False):
         return fhir_date_obj
     fhir_date_obj.date = None
     return fhir_date_obj
+
+
+##############################################################################################
+# Dict serializer helpers, each rendering the same JSON as the fhirclient helper above
+##############################################################################################
+def use_fhirclient_serializer():
+    """
+    Whether resources are serialized through the fhirclient object graph, which validates every element on as_json(),
+    instead of being built directly as dicts.  Set with FHIR_SERIALIZER = 'fhirclient' in the app config.
+    """
+    return has_app_context() and current_app.config.get('FHIR_SERIALIZER') == 'fhirclient'
+
+
+def fhir_humanname_json(use='official', first_name=None, last_name=None, middle_name=None, suffix=None,
+                        prefix=None):
+    """
+    Build the JSON of a FHIR HumanName as a dict, equal to fhir_gen_humanname(...).as_json()
+    :return:
+        dict
+    """
+    hn = {}
+    if use:
+        hn['use'] = use
+    if last_name is not None:
+        hn['family'] = last_name
+    given_name = []
+    if first_name:
+        given_name.append(first_name)
+    if middle_name:
+        given_name.append(middle_name)
+    if given_name:
+        hn['given'] = given_name
+    if suffix:
+        hn['suffix'] = [suffix]
+    if prefix:
+        hn['prefix'] = [prefix]
+
+    hn['text'] = '{}{}{}{}'.format(last_name + ',' if last_name else '',
+                                   ' ' + first_name if first_name else '',
+                                   ' ' + middle_name if middle_name else '',
+                                   ' ' + suffix if suffix else '')
+    return hn
+
+
+def codeable_concept_json(system=None, code=None, display=None, text=None):
+    """
+    Build the JSON of a FHIR CodeableConcept with a single Coding as a dict.  Empty values are left out, as
+    fhirclient's as_json() does.
+    :return:
+        dict
+    """
+    fhir_coding = {}
+    if code is not None:
+        fhir_coding['code'] = code
+    if system is not None:
+        fhir_coding['system'] = system
+    if display is not None:
+        fhir_coding['display'] = display
+    cc = {'coding': [fhir_coding]}
+    if text is not None:
+        cc['text'] = text
+    return cc
+
+
+def fhir_datetime_json(value=None, to_date=False):
+    """
+    Render a date or datetime as FHIR JSON, equal to fhir_gen_datetime(...).as_json().  Date and datetime values are
+    converted directly instead of being parsed from strings.
+    :return:
+        ISO 8601 string, or None if no datetime can be constructed
+    """
+    if isinstance(value, datetime):
+        dt = value.date() if to_date else value
+    elif isinstance(value, date):
+        dt = value if to_date else datetime.combine(value, time())
+    else:
+        dt = validate_datetime(value=value, to_date=to_date, error_out=False)
+    if not dt:
+        return None
+    return fhir_date_json(dt)
+
+
+def fhir_date_json(value):
+    """
+    Render a date or datetime object as FHIR JSON, equal to the as_json() of a fhirclient FHIRDate holding the value
+    :return:
+        ISO 8601 string, or None when value is None
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return isodate.datetime_isoformat(value)
+    return isodate.date_isoformat(value)
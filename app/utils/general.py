@@ -1,4 +1,8 @@
+import re
+from collections import OrderedDict
 from datetime import date, datetime
+from threading import Lock
+import unidecode
 
 
 def json_serial(obj):
@@ -9,3 +13,69 @@ def json_serial(obj):
         return serial
 
     raise TypeError("Type %s not serializable" % type(obj))
+
+
+def fold_search_key(value):
+    """
+    Fold a string to the form stored in search key columns:  accents transliterated to ASCII, upper case,
+    punctuation removed and whitespace collapsed.  ex: "O'Brien-Núñez " -> "OBRIENNUNEZ"
+    :param value:
+        str to fold
+    :return:
+        Folded str, or None if nothing is left after folding
+    """
+    if value is None:
+        return None
+    value = unidecode.unidecode(str(value)).upper()
+    value = re.sub(r'[^A-Z0-9\s]', '', value)
+    return ' '.join(value.split()) or None
+
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe in-process mapping.  Once maxsize keys are stored, the least recently used key is evicted.
+    Hits and misses are counted so cache effectiveness can be inspected.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,155 @@
+# JSON encoding used by API responses, searchset bundles and row hashes
+# Responses are encoded with the fastest installed encoder:  orjson, then ujson, then the standard library json
+# module.  The JSON_BACKEND config value pins one of them, ex: JSON_BACKEND = 'json'
+# orjson and ujson are optional and not in requirements.txt:  pip install orjson (or ujson) to use them
+import hashlib
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from flask import current_app, has_app_context
+from app.utils.general import json_serial
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+# Installed encoders, fastest first
+BACKENDS = [name for name, module in [('orjson', orjson), ('ujson', ujson)] if module is not None] + ['json']
+
+
+def json_default(obj):
+    """
+    Encode the values the JSON encoders do not support natively, the same way with every backend:  dates and
+    datetimes as ISO 8601 strings and Decimals as numbers
+    """
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return json_serial(obj)
+
+
+def get_backend():
+    """
+    The name of the encoder used for responses:  the JSON_BACKEND config value when it names an installed encoder,
+    otherwise the fastest installed encoder
+    """
+    if has_app_context():
+        name = current_app.config.get('JSON_BACKEND', 'auto')
+        if name in BACKENDS:
+            return name
+    return BACKENDS[0]
+
+
+def dumpb(obj, pretty=False, sort_keys=False, backend=None):
+    """
+    Encode a JSON serializable object as UTF-8 JSON text
+    :param obj:
+        dict, list or scalar.  Dates, datetimes and Decimals are encoded with json_default.
+    :param pretty:
+        Indent the output, for humans reading responses
+    :param sort_keys:
+        Sort the keys of objects
+    :param backend:
+        Name of the encoder, defaults to get_backend()
+    :return:
+        bytes
+    """
+    backend = backend or get_backend()
+    if backend == 'orjson':
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=json_default, option=option)
+    if backend == 'ujson':
+        # ujson does not call a default function, so values it can not encode are converted up front
+        return ujson.dumps(_encodable(obj), ensure_ascii=False, escape_forward_slashes=False,
+                           sort_keys=sort_keys, indent=2 if pretty else 0).encode('utf-8')
+    if pretty:
+        return json.dumps(obj, default=json_default, sort_keys=sort_keys, indent=2).encode('utf-8')
+    return json.dumps(obj, default=json_default, sort_keys=sort_keys, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj, pretty=False, sort_keys=False, backend=None):
+    """
+    Encode a JSON serializable object as JSON text, see dumpb
+    :return:
+        str
+    """
+    return dumpb(obj, pretty=pretty, sort_keys=sort_keys, backend=backend).decode('utf-8')
+
+
+def loads(data, backend=None):
+    """
+    Decode JSON text with the configured backend
+    :param data:
+        str or UTF-8 bytes
+    :return:
+        The decoded object.  ValueError is raised for invalid JSON, whichever backend decodes it.
+    """
+    backend = backend or get_backend()
+    if backend == 'orjson':
+        return orjson.loads(data)
+    if backend == 'ujson':
+        return ujson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _encodable(obj):
+    if isinstance(obj, dict):
+        return {k: _encodable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encodable(v) for v in obj]
+    if isinstance(obj, (datetime, date, Decimal)):
+        return json_default(obj)
+    return obj
+
+
+def jsonify(*args, **kwargs):
+    """
+    Drop-in replacement for flask.jsonify that encodes with the configured backend.  Output is indented when the
+    JSONIFY_PRETTYPRINT_REGULAR config value is set, and compact otherwise.  Keys are sorted when JSON_SORT_KEYS
+    is set.
+    :return:
+        Flask response with the JSONIFY_MIMETYPE mimetype
+    """
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    config = current_app.config
+    body = dumpb(data, pretty=config.get('JSONIFY_PRETTYPRINT_REGULAR', False),
+                 sort_keys=config.get('JSON_SORT_KEYS', True))
+    return current_app.response_class(body + b'\n', mimetype=config.get('JSONIFY_MIMETYPE', 'application/json'))
+
+
+##############################################################################################
+# Row hashes
+##############################################################################################
+def canonical_dumps(data):
+    """
+    Encode data in the canonical form that row_hash and data_hash values are computed from:  sorted keys and the
+    standard library's default separators and ASCII escaping.  Stored hashes depend on every byte of this form, so it
+    is always produced by the standard library encoder, whichever backend encodes responses.
+    :return:
+        str
+    """
+    return json.dumps(data, sort_keys=True, default=json_serial)
+
+
+def hash_data(data):
+    """
+    The SHA1 hex digest of the canonical JSON form of data, as stored in row_hash and data_hash columns
+    """
+    return hashlib.sha1(canonical_dumps(data).encode('utf-8')).hexdigest()
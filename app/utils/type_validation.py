@@ -1,5 +1,10 @@
+import re
 from dateutil import parser as dateparser
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# ISO-8601 / FHIR date, dateTime and instant values, down to any supplied precision
+fhir_date_regex = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?'
+                             r'(Z|[+-]\d{2}:?\d{2})?)?)?)?$')
 
 
 class DatetimeParseError(ValueError):
@@ -74,3 +79,58 @@ def validate_bool(value, error=False):
     if error:
         raise ValueError
     return None
+
+
+def parse_fhir_date_range(value):
+    """
+    Parse a FHIR date search value into the half-open range of time it represents, based on its precision.
+    ex: 1980 -> [1980-01-01, 1981-01-01), 1980-05 -> [1980-05-01, 1980-06-01), 1980-05-04T10:30 -> one minute
+    ISO-8601 values are parsed with a regular expression.  Other formats fall back to dateutil.
+    :param value:
+        A str representing a date or datetime
+    :return:
+        Tuple of (start, end) naive datetime objects in UTC.  Values without a timezone are taken as UTC.
+        DatetimeParseError is raised if the value cannot be parsed
+    """
+    value = str(value).strip()
+    match = fhir_date_regex.match(value)
+    if match:
+        year, month, day, hour, minute, second, fraction, tz = match.groups()
+        try:
+            if not month:
+                start = datetime(int(year), 1, 1)
+                end = datetime(int(year) + 1, 1, 1)
+            elif not day:
+                start = datetime(int(year), int(month), 1)
+                end = datetime(int(year) + int(month) // 12, int(month) % 12 + 1, 1)
+            elif not hour:
+                start = datetime(int(year), int(month), int(day))
+                end = start + timedelta(days=1)
+            else:
+                start = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0))
+                if fraction:
+                    start = start.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+                    end = start + timedelta(microseconds=10 ** max(0, 6 - len(fraction)))
+                elif second:
+                    end = start + timedelta(seconds=1)
+                else:
+                    end = start + timedelta(minutes=1)
+                if tz and tz != 'Z':
+                    offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[-2:]))
+                    if tz[0] == '-':
+                        offset = -offset
+                    start, end = start - offset, end - offset
+        except (ValueError, OverflowError):
+            raise DatetimeParseError("An invalid date was supplied")
+        return start, end
+
+    # Not ISO-8601, so fall back on the general purpose parser
+    try:
+        dt = dateparser.parse(value)
+    except (ValueError, OverflowError):
+        raise DatetimeParseError("An unknown string format for datetime was supplied")
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    if dt.time() == datetime.min.time():
+        return dt, dt + timedelta(days=1)
+    return dt, dt + timedelta(seconds=1)
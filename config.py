@@ -30,6 +30,48 @@ class Config:
     SESSION_TYPE = 'redis'
 
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # Encoder of API responses:  'auto' picks the fastest installed of 'orjson', 'ujson' and 'json'.  orjson and ujson
+    # are optional packages, see app.utils.json_backend
+    JSON_BACKEND = 'auto'
+    JSONIFY_PRETTYPRINT_REGULAR = False
+    # Responses of at least COMPRESS_MIN_SIZE bytes are compressed with the best encoding the client accepts
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = {'br': 4, 'zstd': 3, 'gzip': 6}
+    COMPRESS_CACHE_SIZE = 256
+    # 'dict' builds FHIR JSON directly from ORM rows, 'fhirclient' builds and validates fhirclient objects
+    FHIR_SERIALIZER = 'dict'
+    # Serve Patient resources from the patient_resource table, rebuilt by rq jobs on the 'unkani' queue
+    USE_RESOURCE_STORE = True
+    # Seconds before a read of a stale or missing stored resource may queue another rebuild of the same patient
+    RESOURCE_STORE_REQUEUE_AFTER = 60
+    USE_SEARCH_CACHE = True
+    SEARCH_CACHE_TIMEOUT = 60
+    # Seconds between checks that a process's cache of ValueSet concepts matches the codesystem and valueset tables
+    TERMINOLOGY_CACHE_CHECK_INTERVAL = 30
+    # Searchset pages with a _count of at least the threshold are streamed, reading rows in batches of the batch size.
+    # None disables streaming of pages.
+    BUNDLE_STREAM_THRESHOLD = 100
+    BUNDLE_STREAM_BATCH_SIZE = 100
+
+    # FHIR Bulk Data $export files are written to a directory of each export under BULK_EXPORT_DIR by rq jobs
+    BULK_EXPORT_DIR = os.environ.get('BULK_EXPORT_DIR') or os.path.join(basedir, 'exports')
+    BULK_EXPORT_BATCH_SIZE = 1000
+    # Seconds an export job may run, and seconds its status and files are kept after its last update
+    BULK_EXPORT_TIMEOUT = 3600
+    BULK_EXPORT_EXPIRES = 86400
+    # Number of NDJSON Patient resources loaded per transaction by $import and the import_patients command
+    BULK_IMPORT_BATCH_SIZE = 5000
+
+    # PostgreSQL statement_timeout in milliseconds for the queries of a search, by FHIR resource
+    SEARCH_STATEMENT_TIMEOUT = {'default': 10000,
+                                'Patient': 5000,
+                                'Organization': 5000}
+    # Searches whose page query has a planner cost estimate above the limit are rejected before they run, by FHIR
+    # resource.  None disables the pre-flight EXPLAIN.
+    SEARCH_MAX_PLAN_COST = {'default': None,
+                            'Patient': 100000,
+                            'Organization': 100000}
     BROKER_TRANSPORT = 'redis',
 
     CODESYSTEM_IMPORT = {'organization-type': 'http://hl7.org/fhir/organization-type',
@@ -76,6 +118,7 @@ class DevelopmentConfig(Config):
     SENTRY_DISABLE = True
     USE_RATE_LIMITS = True
     WTF_CSRF_ENABLED = False
+    JSONIFY_PRETTYPRINT_REGULAR = True
 
 
 class TestingConfig(Config):
@@ -88,6 +131,8 @@ class TestingConfig(Config):
     SSL_DISABLE = True
     SENTRY_DISABLE = True
     USE_RATE_LIMITS = False
+    USE_SEARCH_CACHE = False
+    USE_RESOURCE_STORE = False
     SERVER_SESSION = False
 
 
@@ -0,0 +1,32 @@
+"""patient resource store
+
+Revision ID: 569cffa616da
+Revises: 943dff848481
+Create Date: 2026-10-17 13:21:07.284516
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '569cffa616da'
+down_revision = '943dff848481'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Populate the table with 'flask rebuild_resources'
+    op.create_table('patient_resource',
+                    sa.Column('patient_id', sa.Integer(), nullable=False),
+                    sa.Column('source_hash', sa.Text(), nullable=False),
+                    sa.Column('etag', sa.Text(), nullable=True),
+                    sa.Column('resource', postgresql.JSONB(), nullable=False),
+                    sa.Column('rendered_at', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['patient_id'], ['patient.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('patient_id'))
+
+
+def downgrade():
+    op.drop_table('patient_resource')
@@ -0,0 +1,26 @@
+"""valueset expansion display index
+
+Revision ID: 5d2f1a9c7e40
+Revises: cbb7d49c7e1b
+Create Date: 2026-10-18 14:21:36.106452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5d2f1a9c7e40'
+down_revision = 'cbb7d49c7e1b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Serves the case insensitive display prefix match of the $expand filter parameter
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_valueset_expansion_display_trgm', 'valueset_expansion', ['display'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'display': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_valueset_expansion_display_trgm', table_name='valueset_expansion')
@@ -0,0 +1,35 @@
+"""valueset expansion
+
+Revision ID: 8e8207293d01
+Revises: 569cffa616da
+Create Date: 2026-10-18 09:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8e8207293d01'
+down_revision = '569cffa616da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Populate the table with 'flask refresh_expansions'
+    op.add_column('valueset', sa.Column('expanded_at', sa.DateTime(), nullable=True))
+    op.create_table('valueset_expansion',
+                    sa.Column('valueset_id', sa.Integer(), nullable=False),
+                    sa.Column('system', sa.Text(), nullable=False),
+                    sa.Column('code', sa.Text(), nullable=False),
+                    sa.Column('display', sa.Text(), nullable=True),
+                    sa.ForeignKeyConstraint(['valueset_id'], ['valueset.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('valueset_id', 'system', 'code'))
+    op.create_index('ix_valueset_expansion_code', 'valueset_expansion', ['valueset_id', 'code'], unique=False,
+                    postgresql_ops={'code': 'text_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_valueset_expansion_code', table_name='valueset_expansion')
+    op.drop_table('valueset_expansion')
+    op.drop_column('valueset', 'expanded_at')
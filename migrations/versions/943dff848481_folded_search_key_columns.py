@@ -0,0 +1,39 @@
+"""folded search key columns
+
+Revision ID: 943dff848481
+Revises: c149800fe44d
+Create Date: 2026-10-17 10:48:55.730412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '943dff848481'
+down_revision = 'c149800fe44d'
+branch_labels = None
+depends_on = None
+
+# (table, key column) of the folded search key columns.  Populate existing rows with 'flask backfill_search_keys'
+search_key_columns = [('patient', 'first_name_key'),
+                      ('patient', 'middle_name_key'),
+                      ('patient', 'last_name_key'),
+                      ('address', 'address1_key'),
+                      ('address', 'address2_key'),
+                      ('address', 'city_key'),
+                      ('address', 'state_key'),
+                      ('address', 'zipcode_key'),
+                      ('address', 'country_key')]
+
+
+def upgrade():
+    for table, column in search_key_columns:
+        op.add_column(table, sa.Column(column, sa.Text(), nullable=True))
+        op.create_index('ix_{}_{}'.format(table, column), table, [column], unique=False,
+                        postgresql_ops={column: 'text_pattern_ops'})
+
+
+def downgrade():
+    for table, column in reversed(search_key_columns):
+        op.drop_index('ix_{}_{}'.format(table, column), table_name=table)
+        op.drop_column(table, column)
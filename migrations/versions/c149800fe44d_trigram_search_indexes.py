@@ -0,0 +1,37 @@
+"""trigram search indexes
+
+Revision ID: c149800fe44d
+Revises: cdfd25d969a6
+Create Date: 2026-10-17 10:02:17.284610
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c149800fe44d'
+down_revision = 'cdfd25d969a6'
+branch_labels = None
+depends_on = None
+
+# (index name, table, column) of the GIN trigram indexes serving FHIR string search
+trigram_indexes = [('ix_patient_first_name_trgm', 'patient', 'first_name'),
+                   ('ix_patient_middle_name_trgm', 'patient', 'middle_name'),
+                   ('ix_patient_last_name_trgm', 'patient', 'last_name'),
+                   ('ix_address_address1_trgm', 'address', 'address1'),
+                   ('ix_address_address2_trgm', 'address', 'address2'),
+                   ('ix_address_city_trgm', 'address', 'city'),
+                   ('ix_email_address_email_trgm', 'email_address', 'email'),
+                   ('ix_phone_number_number_trgm', 'phone_number', 'number')]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in trigram_indexes:
+        op.create_index(name, table, [column], unique=False, postgresql_using='gin',
+                        postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    for name, table, column in reversed(trigram_indexes):
+        op.drop_index(name, table_name=table)
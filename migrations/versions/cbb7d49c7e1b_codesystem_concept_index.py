@@ -0,0 +1,44 @@
+"""codesystem concept index
+
+Revision ID: cbb7d49c7e1b
+Revises: 8e8207293d01
+Create Date: 2026-10-18 11:40:03.927615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'cbb7d49c7e1b'
+down_revision = '8e8207293d01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Populate the tables with 'flask refresh_expansions'
+    op.create_table('codesystem_concept',
+                    sa.Column('codesystem_id', sa.Integer(), nullable=False),
+                    sa.Column('code', sa.Text(), nullable=False),
+                    sa.Column('display', sa.Text(), nullable=True),
+                    sa.Column('definition', sa.Text(), nullable=True),
+                    sa.Column('parent_code', sa.Text(), nullable=True),
+                    sa.ForeignKeyConstraint(['codesystem_id'], ['codesystem.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['codesystem_id', 'parent_code'],
+                                            ['codesystem_concept.codesystem_id', 'codesystem_concept.code']),
+                    sa.PrimaryKeyConstraint('codesystem_id', 'code'))
+    op.create_table('concept_closure',
+                    sa.Column('codesystem_id', sa.Integer(), nullable=False),
+                    sa.Column('ancestor_code', sa.Text(), nullable=False),
+                    sa.Column('descendant_code', sa.Text(), nullable=False),
+                    sa.Column('depth', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['codesystem_id'], ['codesystem.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('codesystem_id', 'ancestor_code', 'descendant_code'))
+    op.create_index('ix_concept_closure_descendant', 'concept_closure',
+                    ['codesystem_id', 'descendant_code', 'ancestor_code'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_concept_closure_descendant', table_name='concept_closure')
+    op.drop_table('concept_closure')
+    op.drop_table('codesystem_concept')
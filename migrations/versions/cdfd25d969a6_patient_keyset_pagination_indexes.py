@@ -0,0 +1,29 @@
+"""patient keyset pagination indexes
+
+Revision ID: cdfd25d969a6
+Revises: 43b2beea5ab3
+Create Date: 2026-10-17 09:12:41.503128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'cdfd25d969a6'
+down_revision = '43b2beea5ab3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_patient_last_name_id', 'patient', ['last_name', 'id'], unique=False)
+    op.create_index('ix_patient_first_name_id', 'patient', ['first_name', 'id'], unique=False)
+    op.create_index('ix_patient_dob_id', 'patient', ['dob', 'id'], unique=False)
+    op.create_index('ix_patient_updated_at_id', 'patient', ['updated_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_patient_updated_at_id', table_name='patient')
+    op.drop_index('ix_patient_dob_id', table_name='patient')
+    op.drop_index('ix_patient_first_name_id', table_name='patient')
+    op.drop_index('ix_patient_last_name_id', table_name='patient')
@@ -0,0 +1,111 @@
+import json
+import shutil
+import tempfile
+from flask import url_for
+from redis.exceptions import RedisError
+from tests.test_client_utils import BaseClientTestCase
+from app import db, redis
+from app.models import Role
+from app.jobs import run_bulk_export
+from app.api_v1.utils.bulk_export import BulkExport
+
+
+class BulkExportTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(BulkExportTestCase, self).setUp()
+        try:
+            redis.ping()
+        except RedisError:
+            self.skipTest('Redis is not available')
+        self.export_dir = tempfile.mkdtemp()
+        self.app.config['BULK_EXPORT_DIR'] = self.export_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir, ignore_errors=True)
+        super(BulkExportTestCase, self).tearDown()
+
+    def get_admin_headers(self):
+        headers = self.get_api_headers()
+        user = self.get_test_user()
+        user.role = Role.query.filter_by(name='Super Admin').first()
+        db.session.commit()
+        headers['Prefer'] = 'respond-async'
+        return headers
+
+    def test_export_requires_patient_admin_and_respond_async(self):
+        headers = self.get_api_headers()
+        headers['Prefer'] = 'respond-async'
+        self.assert403(self.client.get(url_for('api_v1.system_export'), headers=headers))
+
+        headers = self.get_admin_headers()
+        del headers['Prefer']
+        self.assert400(self.client.get(url_for('api_v1.system_export'), headers=headers))
+
+    def test_patient_export_writes_ndjson_files(self):
+        self.create_seed_patients(number=7)
+        headers = self.get_admin_headers()
+        self.assert400(self.client.get(url_for('api_v1.patient_export', _type='Organization'), headers=headers))
+
+        response = self.client.get(url_for('api_v1.patient_export', _type='Patient'), headers=headers)
+        self.assertEqual(response.status_code, 202)
+        status_url = response.headers['Content-Location']
+        export_id = status_url.rstrip('/').split('/')[-1]
+
+        response = self.client.get(status_url, headers=headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Patient', response.headers['X-Progress'])
+
+        # Run the queued job in this process
+        self.app.config['BULK_EXPORT_BATCH_SIZE'] = 3
+        run_bulk_export(export_id)
+        response = self.client.get(status_url, headers=headers)
+        self.assert200(response)
+        manifest = json.loads(response.get_data(as_text=True))
+        self.assertEqual([(o['type'], o['count']) for o in manifest['output']], [('Patient', 7)])
+
+        file_url = manifest['output'][0]['url']
+        response = self.client.get(file_url, headers=headers)
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/fhir+ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertTrue(all(json.loads(line)['resourceType'] == 'Patient' for line in lines))
+
+        # A _since after every change exports nothing
+        response = self.client.get(url_for('api_v1.patient_export', _since=manifest['transactionTime']),
+                                   headers=headers)
+        since_id = response.headers['Content-Location'].split('/')[-1]
+        run_bulk_export(since_id)
+        manifest = json.loads(self.client.get(response.headers['Content-Location'], headers=headers)
+                              .get_data(as_text=True))
+        self.assertEqual(manifest['output'], [])
+
+        # Only the patient admin who requested the export can see it
+        self.create_test_user(username='other.admin', email='OTHER.ADMIN@EXAMPLE.COM')
+        other = self.get_test_user(username='other.admin')
+        other.role = Role.query.filter_by(name='Super Admin').first()
+        other_headers = dict(headers, Authorization='Bearer {}'.format(other.generate_api_auth_token()))
+        db.session.commit()
+        self.assert404(self.client.get(status_url, headers=other_headers))
+        self.assert404(self.client.get(file_url, headers=other_headers))
+        self.assertEqual(self.client.delete(status_url, headers=other_headers).status_code, 404)
+
+        self.assertEqual(self.client.delete(status_url, headers=headers).status_code, 202)
+        self.assert404(self.client.get(status_url, headers=headers))
+
+    def test_cancelled_export_is_not_overwritten_by_its_job(self):
+        self.create_seed_patients(number=4)
+        headers = self.get_admin_headers()
+        response = self.client.get(url_for('api_v1.patient_export'), headers=headers)
+        status_url = response.headers['Content-Location']
+        export = BulkExport.load(status_url.split('/')[-1])
+        export.cancel()
+
+        # The job's state is stale, but its update does not undo the cancellation
+        export.status = BulkExport.IN_PROGRESS
+        self.assertFalse(export.update())
+        self.assertEqual(BulkExport.load(export.id).status, BulkExport.CANCELLED)
+        run_bulk_export(export.id)
+        self.assertEqual(BulkExport.load(export.id).status, BulkExport.CANCELLED)
+        self.assert404(self.client.get(status_url, headers=headers))
@@ -0,0 +1,60 @@
+import json
+import uuid
+from flask import url_for
+from tests.test_client_utils import BaseClientTestCase
+from app import db
+from app.models import Role
+from app.models.fhir.patient import Patient
+from app.utils.demographics import normalize_name, validate_phone
+
+
+class BulkImportTestCase(BaseClientTestCase):
+
+    def get_admin_headers(self):
+        headers = self.get_api_headers()
+        user = self.get_test_user()
+        user.role = Role.query.filter_by(name='Super Admin').first()
+        db.session.commit()
+        headers['Content-Type'] = 'application/fhir+ndjson'
+        return headers
+
+    def test_import_requires_patient_admin_and_ndjson(self):
+        self.assert403(self.client.post(url_for('api_v1.patient_import'), headers=self.get_api_headers(), data=''))
+        headers = self.get_admin_headers()
+        headers['Content-Type'] = 'application/fhir+json'
+        self.assert400(self.client.post(url_for('api_v1.patient_import'), headers=headers, data=''))
+
+    def test_imported_patients_match_orm_patients(self):
+        patients = self.create_seed_patients(number=5)
+        resources = [pt.build_fhir_dict() for pt in patients]
+        lines = [json.dumps(r) for r in resources]
+        # The same resources with new identifiers are loaded as new patients
+        new_uuids = []
+        for resource in resources:
+            new_uuids.append(uuid.uuid4())
+            resource['identifier'][0]['value'] = str(new_uuids[-1])
+            lines.append(json.dumps(resource))
+        lines.append('{"resourceType": "Patient", "birthDate": "not a date"}')
+
+        response = self.client.post(url_for('api_v1.patient_import'), headers=self.get_admin_headers(),
+                                    data='\n'.join(lines) + '\n')
+        self.assert200(response)
+        outcome = json.loads(response.get_data(as_text=True))
+        self.assertIn('5 imported, 5 skipped as already loaded, 1 rejected', outcome['issue'][0]['details']['text'])
+        self.assertEqual(outcome['issue'][1]['location'], ['line 11'])
+        self.assertEqual(Patient.query.count(), 10)
+
+        for source, new_uuid in zip(patients, new_uuids):
+            imported = Patient.query.filter(Patient.uuid == new_uuid).one()
+            self.assertEqual(imported.last_name, normalize_name(source.last_name))
+            self.assertEqual(imported.dob, source.dob)
+            self.assertEqual(imported.ssn, source.ssn)
+            self.assertEqual(imported.row_hash, imported.generate_row_hash())
+            self.assertEqual(imported.first_name_key, source.first_name_key)
+            self.assertEqual(imported.email, source.email)
+            self.assertEqual(sorted(validate_phone(ph.number) for ph in source.phone_numbers),
+                             sorted(ph.number for ph in imported.phone_numbers))
+            for address in imported.addresses:
+                self.assertEqual(address.row_hash, address.generate_row_hash())
+                self.assertEqual(address.address_hash, address.generate_address_hash())
+            self.assertEqual(imported.versions.count(), 1)
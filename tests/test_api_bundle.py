@@ -0,0 +1,71 @@
+import json
+import uuid
+from flask import url_for
+from tests.test_client_utils import BaseClientTestCase
+from app import db
+from app.models import Role
+from app.models.fhir.patient import Patient
+
+
+class BundleTransactionTestCase(BaseClientTestCase):
+
+    def get_admin_headers(self):
+        headers = self.get_api_headers()
+        user = self.get_test_user()
+        user.role = Role.query.filter_by(name='Super Admin').first()
+        db.session.commit()
+        return headers
+
+    def post_bundle(self, bundle_type, entries):
+        return self.client.post(url_for('api_v1.fhir_bundle'), headers=self.get_admin_headers(),
+                                data=json.dumps({'resourceType': 'Bundle', 'type': bundle_type, 'entry': entries}))
+
+    def test_transaction_creates_reads_updates_and_deletes_patients(self):
+        existing, removed = self.create_seed_patients(number=2)
+        updated = existing.build_fhir_dict()
+        updated['name'][0]['family'] = 'TRANSACTED'
+        full_url = 'urn:uuid:{}'.format(uuid.uuid4())
+        response = self.post_bundle('transaction', [
+            {'fullUrl': full_url, 'resource': {'resourceType': 'Patient', 'gender': 'female',
+                                               'name': [{'family': 'Created', 'given': ['Bundle']}]},
+             'request': {'method': 'POST', 'url': 'Patient'}},
+            {'request': {'method': 'GET', 'url': full_url}},
+            {'resource': updated, 'request': {'method': 'PUT', 'url': 'Patient/{}'.format(existing.id)}},
+            {'request': {'method': 'DELETE', 'url': 'Patient/{}'.format(removed.id)}}])
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+        self.assertEqual(bundle['type'], 'transaction-response')
+        self.assertEqual([e['response']['status'] for e in bundle['entry']],
+                         ['201 Created', '200 OK', '200 OK', '204 No Content'])
+
+        db.session.expire_all()
+        created = Patient.query.filter(Patient.uuid == uuid.UUID(full_url[len('urn:uuid:'):])).one()
+        self.assertEqual(bundle['entry'][0]['response']['location'], 'Patient/{}'.format(created.id))
+        self.assertEqual(bundle['entry'][1]['resource']['name'][0]['family'], 'CREATED')
+        self.assertEqual(Patient.query.get(existing.id).last_name, 'TRANSACTED')
+        self.assertIsNone(Patient.query.get(removed.id))
+
+    def test_failed_entries(self):
+        pt = self.create_seed_patients(number=1)[0]
+        missing = {'request': {'method': 'DELETE', 'url': 'Patient/{}'.format(pt.id + 1000)}}
+        read = {'request': {'method': 'GET', 'url': 'Patient/{}'.format(pt.id)}}
+
+        # A failed entry fails a transaction as a whole
+        response = self.post_bundle('transaction', [read, missing])
+        self.assert404(response)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['resourceType'], 'OperationOutcome')
+
+        # A failed entry of a batch gets its own OperationOutcome
+        response = self.post_bundle('batch', [read, missing])
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+        self.assertEqual(bundle['type'], 'batch-response')
+        self.assertEqual(bundle['entry'][0]['response']['status'], '200 OK')
+        self.assertEqual(bundle['entry'][1]['response']['status'], '404 Not Found')
+        self.assertEqual(bundle['entry'][1]['response']['outcome']['resourceType'], 'OperationOutcome')
+
+        # Search entries are rejected as not supported
+        search = {'request': {'method': 'GET', 'url': 'Patient?name={}'.format(pt.last_name)}}
+        bundle = json.loads(self.post_bundle('batch', [read, search]).get_data(as_text=True))
+        self.assertEqual(bundle['entry'][1]['response']['status'], '405 Method Not Allowed')
+        self.assertEqual(bundle['entry'][1]['response']['outcome']['issue'][0]['code'], 'not-supported')
@@ -0,0 +1,43 @@
+import json
+from flask import url_for
+from tests.test_client_utils import BaseClientTestCase, CODESYSTEM, load_codeset
+
+
+class CodeSystemOperationsTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(CodeSystemOperationsTestCase, self).setUp()
+        load_codeset(CODESYSTEM)
+
+    def get_parameters(self, endpoint, **kwargs):
+        response = self.client.get(url_for(endpoint, **kwargs), headers=self.get_api_headers())
+        self.assert200(response)
+        return json.loads(response.get_data(as_text=True))['parameter']
+
+    def test_lookup(self):
+        parameters = self.get_parameters('api_v1.codesystem_lookup', resource_id='test-colors', code='R')
+        self.assertIn({'name': 'display', 'valueString': 'Red'}, parameters)
+        self.assertIn({'name': 'property', 'part': [{'name': 'code', 'valueCode': 'child'},
+                                                    {'name': 'value', 'valueCode': 'C'}]}, parameters)
+
+        parameters = self.get_parameters('api_v1.codesystem_lookup', system=CODESYSTEM['url'], code='C')
+        self.assertIn({'name': 'property', 'part': [{'name': 'code', 'valueCode': 'parent'},
+                                                    {'name': 'value', 'valueCode': 'R'}]}, parameters)
+
+        headers = self.get_api_headers()
+        self.assert404(self.client.get(url_for('api_v1.codesystem_lookup', resource_id='test-colors', code='X'),
+                                       headers=headers))
+        self.assert400(self.client.get(url_for('api_v1.codesystem_lookup', code='R'), headers=headers))
+
+    def test_subsumes(self):
+        def outcome(code_a, code_b):
+            parameters = self.get_parameters('api_v1.codesystem_subsumes', system=CODESYSTEM['url'],
+                                             codeA=code_a, codeB=code_b)
+            return parameters[0]['valueCode']
+
+        self.assertEqual(outcome('R', 'C'), 'subsumes')
+        self.assertEqual(outcome('C', 'R'), 'subsumed-by')
+        self.assertEqual(outcome('C', 'C'), 'equivalent')
+        self.assertEqual(outcome('B', 'C'), 'not-subsumed')
+        self.assert400(self.client.get(url_for('api_v1.codesystem_subsumes', resource_id='test-colors',
+                                               codeA='R', codeB='X'), headers=self.get_api_headers()))
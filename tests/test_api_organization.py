@@ -0,0 +1,61 @@
+import json
+from flask import url_for
+from tests.test_client_utils import BaseClientTestCase, load_codeset
+from app import db
+from app.models import Organization
+
+# A hierarchy of organization types, to search with the :below and :above modifiers
+ORGANIZATION_TYPES = {'resourceType': 'CodeSystem', 'id': 'test-organization-type',
+                      'url': 'http://hl7.org/fhir/organization-type', 'status': 'active', 'content': 'complete',
+                      'concept': [{'code': 'prov', 'display': 'Healthcare Provider',
+                                   'concept': [{'code': 'dept', 'display': 'Hospital Department'}]},
+                                  {'code': 'ins', 'display': 'Insurance Company'}]}
+
+
+class OrganizationSearchTestCase(BaseClientTestCase):
+
+    def create_organizations(self):
+        acme = Organization(name='ACME HEALTH')
+        other = Organization(name='OTHER HEALTH')
+        db.session.add_all([acme, other])
+        db.session.flush()
+        children = [Organization(name='ACME CARDIOLOGY', parent_id=acme.id),
+                    Organization(name='ACME ONCOLOGY', parent_id=acme.id),
+                    Organization(name='OTHER CARDIOLOGY', parent_id=other.id)]
+        db.session.add_all(children)
+        db.session.commit()
+        return acme, other, children
+
+    def search(self, **kwargs):
+        response = self.client.get(url_for('api_v1.organization_search', _count=50, **kwargs),
+                                   headers=self.get_api_headers())
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+        return sorted(e['resource']['name'] for e in bundle.get('entry', []))
+
+    def test_chained_search_finds_children_by_parent_name(self):
+        self.create_organizations()
+        self.assertEqual(self.search(**{'partof.name': 'acme'}), ['ACME CARDIOLOGY', 'ACME ONCOLOGY'])
+        self.assertEqual(self.search(**{'partof:Organization.name:exact': 'OTHER HEALTH'}), ['OTHER CARDIOLOGY'])
+
+    def test_reverse_chained_search_finds_parents_by_child_name(self):
+        self.create_organizations()
+        self.assertEqual(self.search(**{'_has:Organization:partof:name:contains': 'cardio'}),
+                         ['ACME HEALTH', 'OTHER HEALTH'])
+        self.assertEqual(self.search(**{'_has:Organization:partof:name': 'acme onc'}), ['ACME HEALTH'])
+
+    def test_undeclared_chains_are_rejected(self):
+        headers = self.get_api_headers()
+        for arg in ['partof.partof.name', 'parent.name', '_has:Patient:organization:name']:
+            response = self.client.get(url_for('api_v1.organization_search', **{arg: 'x'}), headers=headers)
+            self.assert400(response)
+
+    def test_token_subsumption_modifiers(self):
+        load_codeset(ORGANIZATION_TYPES)
+        acme, other, children = self.create_organizations()
+        acme.type, other.type, children[0].type = 'prov', 'ins', 'dept'
+        db.session.commit()
+        self.assertEqual(self.search(**{'type:below': 'prov'}), ['ACME CARDIOLOGY', 'ACME HEALTH'])
+        self.assertEqual(self.search(**{'type:below': 'http://hl7.org/fhir/organization-type|dept'}),
+                         ['ACME CARDIOLOGY'])
+        self.assertEqual(self.search(**{'type:above': 'dept'}), ['ACME CARDIOLOGY', 'ACME HEALTH'])
@@ -0,0 +1,510 @@
+import gzip
+import json
+from flask import url_for
+from sqlalchemy import event
+from redis.exceptions import RedisError
+from tests.test_client_utils import BaseClientTestCase
+from app import db, redis
+from app.models import Patient, Address, PhoneNumber, Role, PatientResource
+from app.api_v1.resources.Patient import patient_search_cache
+
+
+class PatientSearchTestCase(BaseClientTestCase):
+
+    def search(self, **kwargs):
+        response = self.client.get(url_for('api_v1.patient_search', **kwargs), headers=self.get_api_headers())
+        self.assert200(response)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_cursor_pagination_walks_every_patient_once(self):
+        self.create_seed_patients(number=25)
+        seen = []
+        bundle = self.search(_cursor='first', _count=10, _sort='birthdate')
+        while True:
+            seen.extend([e['resource']['birthDate'] for e in bundle.get('entry', [])])
+            next_links = [l['url'] for l in bundle['link'] if l['relation'] == 'next']
+            self.assertNotIn('total', bundle)
+            if not next_links:
+                break
+            response = self.client.get(next_links[0], headers=self.get_api_headers())
+            self.assert200(response)
+            bundle = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_cursor_pagination_rejects_tampered_cursor(self):
+        self.create_seed_patients(number=3)
+        response = self.client.get(url_for('api_v1.patient_search', _cursor='not-a-cursor'),
+                                   headers=self.get_api_headers())
+        self.assert400(response)
+
+    def test_sort_on_a_child_table_keeps_each_patient_once(self):
+        patients = self.create_seed_patients(number=4)
+        # One patient with a second address, one with none
+        db.session.add(Address(address1='1 MAIN ST', city='AAA', state='MA', zipcode='02101',
+                               patient_id=patients[0].id))
+        for address in patients[1].addresses.all():
+            db.session.delete(address)
+        db.session.commit()
+
+        for sort in ['address-city', '-address-city']:
+            bundle = self.search(_sort=sort, _count=10)
+            ids = [e['resource']['id'] for e in bundle['entry']]
+            self.assertEqual(bundle['total'], 4)
+            self.assertEqual(sorted(ids), sorted(pt.get_url() for pt in patients))
+
+        # The patient without an address sorts last ascending, and the lowest city sorts first
+        bundle = self.search(_sort='address-city', _count=10)
+        self.assertEqual(bundle['entry'][0]['resource']['id'], patients[0].get_url())
+        self.assertEqual(bundle['entry'][-1]['resource']['id'], patients[1].get_url())
+
+        seen = []
+        bundle = self.search(_cursor='first', _count=1, _sort='address-city')
+        while True:
+            seen.extend(e['resource']['id'] for e in bundle.get('entry', []))
+            next_links = [l['url'] for l in bundle['link'] if l['relation'] == 'next']
+            if not next_links:
+                break
+            bundle = json.loads(self.client.get(next_links[0], headers=self.get_api_headers())
+                                .get_data(as_text=True))
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_cursor_pagination_checks_count(self):
+        self.create_seed_patients(number=3)
+        bundle = self.search(_cursor='first', _count=0)
+        self.assertEqual(bundle.get('entry', []), [])
+        self.assertNotIn('next', [l['relation'] for l in bundle['link']])
+        response = self.client.get(url_for('api_v1.patient_search', _cursor='first', _count=-1),
+                                   headers=self.get_api_headers())
+        self.assert404(response)
+
+    def test_total_modes(self):
+        self.create_seed_patients(number=15)
+        bundle = self.search(_count=10)
+        self.assertEqual(bundle['total'], 15)
+        self.assertIn('last', [l['relation'] for l in bundle['link']])
+
+        bundle = self.search(_count=10, _total='none')
+        self.assertNotIn('total', bundle)
+        self.assertNotIn('last', [l['relation'] for l in bundle['link']])
+        self.assertIn('next', [l['relation'] for l in bundle['link']])
+        self.assertEqual(len(bundle['entry']), 10)
+
+        bundle = self.search(_count=10, _total='estimate')
+        self.assertIsInstance(bundle['total'], int)
+
+        bundle = self.search(_summary='count')
+        self.assertEqual(bundle['total'], 15)
+
+    def test_total_rejects_unknown_mode(self):
+        response = self.client.get(url_for('api_v1.patient_search', _total='sometimes'),
+                                   headers=self.get_api_headers())
+        self.assert400(response)
+
+    def test_search_plans_are_cached_by_shape(self):
+        from app.api_v1.resources.Patient import patient_search_support
+        patient_search_support.plans.clear()
+        self.create_seed_patients(number=5)
+        self.search(family='A', birthdate='ge1900-01-01')
+        self.search(family='B', birthdate='ge1950-06-01')
+        self.assertEqual(patient_search_support.plans.stats['misses'], 1)
+        self.assertEqual(patient_search_support.plans.stats['hits'], 1)
+        # A different prefix is a different shape
+        self.search(family='B', birthdate='lt1950-06-01')
+        self.assertEqual(len(patient_search_support.plans), 2)
+
+    def test_birthdate_precision_and_repeated_ranges(self):
+        self.create_seed_patients(number=25)
+        dobs = [pt.dob for pt in Patient.query.all()]
+        year = dobs[0].year
+
+        bundle = self.search(birthdate=str(year), _count=100)
+        self.assertEqual(bundle['total'], len([d for d in dobs if d.year == year]))
+
+        bundle = self.search(birthdate='{:04d}-{:02d}'.format(year, dobs[0].month), _count=100)
+        self.assertEqual(bundle['total'], len([d for d in dobs if (d.year, d.month) == (year, dobs[0].month)]))
+
+        bundle = self.search(birthdate=['ge1950', 'lt1970'], _count=100)
+        self.assertEqual(bundle['total'], len([d for d in dobs if 1950 <= d.year < 1970]))
+        for entry in bundle.get('entry', []):
+            self.assertTrue('1950' <= entry['resource']['birthDate'] < '1970')
+
+    def test_text_search_is_fuzzy_and_ranked(self):
+        self.create_seed_patients(number=10)
+        pt = Patient.query.filter(Patient.last_name.isnot(None)).first()
+        bundle = self.search(**{'family:text': pt.last_name + 'E'})
+        urls = [e['resource']['id'] for e in bundle.get('entry', [])]
+        self.assertIn(pt.get_url(), urls)
+        scores = [e['search']['score'] for e in bundle['entry']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertTrue(all(0 < score <= 1 for score in scores))
+
+    def test_contains_matches_wildcards_literally(self):
+        self.create_seed_patients(number=5)
+        bundle = self.search(**{'family:contains': '%'})
+        self.assertEqual(bundle['total'], 0)
+
+    def test_default_string_match_is_accent_case_and_punctuation_folded(self):
+        self.create_seed_patients(number=3)
+        pt = Patient.query.first()
+        pt.last_name = "O'Briën"
+        db.session.add(pt)
+        db.session.commit()
+        self.assertEqual(pt.last_name_key, 'OBRIEN')
+        bundle = self.search(family='obrie')
+        self.assertEqual(bundle['total'], 1)
+        self.assertEqual(bundle['entry'][0]['resource']['id'], pt.get_url())
+
+    def test_values_that_fold_to_nothing_are_rejected(self):
+        self.create_seed_patients(number=3)
+        response = self.client.get(url_for('api_v1.patient_search', family="'-."), headers=self.get_api_headers())
+        self.assert400(response)
+
+    def test_related_parameters_use_one_exists_per_table(self):
+        self.create_seed_patients(number=50)
+        expected = set(p.patient_id for p in PhoneNumber.query.filter(PhoneNumber.number.like('%5%')).all())
+        headers = self.get_api_headers()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(url_for('api_v1.patient_search', _count=100,
+                                               **{'phone:contains': '5', 'phone:missing': 'false'}), headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+
+        # Patients with several matching phone numbers are returned once
+        urls = [e['resource']['id'] for e in bundle.get('entry', [])]
+        self.assertEqual(len(urls), len(set(urls)))
+        self.assertEqual(bundle['total'], len(expected))
+
+        # Both phone parameters are merged into a single EXISTS subquery of the one search query
+        search_statements = [s for s in statements if 'FROM patient' in s and 'phone_number' in s]
+        self.assertEqual(len(search_statements), 1)
+        self.assertEqual(search_statements[0].count('EXISTS'), 1)
+        self.assertNotIn('JOIN phone_number', search_statements[0])
+
+    def test_revinclude_of_data_types_adds_a_warning(self):
+        self.create_seed_patients(number=10)
+        headers = self.get_api_headers()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(url_for('api_v1.patient_search', _count=5,
+                                               _revinclude=['Address:patient', 'ContactPoint:patient']),
+                                       headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+
+        # Address and ContactPoint are data types, so they are not bundle entries.  Their data is in each Patient.
+        modes = [e['search']['mode'] for e in bundle['entry']]
+        self.assertEqual(modes, ['match'] * 5 + ['outcome'])
+        self.assertEqual(bundle['total'], 10)
+        outcome = bundle['entry'][-1]['resource']
+        self.assertEqual(outcome['resourceType'], 'OperationOutcome')
+        self.assertEqual([issue['severity'] for issue in outcome['issue']], ['warning', 'warning'])
+
+        # The child rows are still read with one batched IN (...) query per table for the page
+        for table in ['address', 'email_address', 'phone_number']:
+            batched = [s for s in statements if 'FROM {}'.format(table) in s and ' IN (' in s]
+            self.assertEqual(len(batched), 1)
+
+    def test_unsupported_include_is_rejected(self):
+        response = self.client.get(url_for('api_v1.patient_search', _include='Patient:organization'),
+                                   headers=self.get_api_headers())
+        self.assert400(response)
+
+    def test_summary_true_reads_only_the_patient_table(self):
+        self.create_seed_patients(number=100)
+        headers = self.get_api_headers()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(url_for('api_v1.patient_search', _summary='true', _count=100),
+                                       headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assert200(response)
+        bundle = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(bundle['entry']), 100)
+
+        resource = bundle['entry'][0]['resource']
+        self.assertIn('name', resource)
+        self.assertEqual(resource['meta']['tag'][0]['code'], 'SUBSETTED')
+        for element in ['text', 'telecom', 'address', 'maritalStatus', 'extension']:
+            self.assertNotIn(element, resource)
+
+        # Only the summary columns of the patient table are read
+        executed = ' '.join(statements)
+        for table in ['address', 'phone_number', 'patient_version', 'valueset']:
+            self.assertNotIn('{}.'.format(table), executed)
+        self.assertNotIn('patient.row_hash', executed)
+
+    def test_search_bundle_query_count_does_not_grow_with_page_size(self):
+        self.create_seed_patients(number=40)
+        headers = self.get_api_headers()
+
+        def count_statements(per_page):
+            statements = []
+
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.client.get(url_for('api_v1.patient_search', _count=per_page), headers=headers)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assert200(response)
+            self.assertEqual(len(json.loads(response.get_data(as_text=True))['entry']), per_page)
+            return len(statements)
+
+        self.assertEqual(count_statements(per_page=10), count_statements(per_page=40))
+
+    def test_streamed_bundle_matches_buffered_bundle(self):
+        self.create_seed_patients(number=12)
+        headers = self.get_api_headers()
+        self.app.config['BUNDLE_STREAM_BATCH_SIZE'] = 4
+
+        def get_bundle(threshold, **args):
+            self.app.config['BUNDLE_STREAM_THRESHOLD'] = threshold
+            response = self.client.get(url_for('api_v1.patient_search', **args), headers=headers)
+            self.assert200(response)
+            # Streamed responses are sent without a Content-Length
+            self.assertEqual('Content-Length' in response.headers, threshold is None)
+            return json.loads(response.get_data(as_text=True))
+
+        try:
+            for args in [{'_count': 5}, {'_count': 5, 'page': 3}, {'_count': 20}, {'_count': 5, '_cursor': 'first'},
+                         {'_count': 5, '_sort': '-birthdate', '_cursor': 'first'}]:
+                streamed = get_bundle(threshold=5, **args)
+                self.assertEqual(streamed, get_bundle(threshold=None, **args))
+        finally:
+            self.app.config['BUNDLE_STREAM_THRESHOLD'] = 100
+            self.app.config['BUNDLE_STREAM_BATCH_SIZE'] = 100
+
+    def test_responses_are_compressed_once_per_representation(self):
+        self.create_seed_patients(number=20)
+        headers = self.get_api_headers()
+        compress = self.app.extensions['compress']
+        compress.cache.clear()
+        url = url_for('api_v1.patient_search', _count=20)
+
+        plain = self.client.get(url, headers=headers)
+        self.assert200(plain)
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        headers['Accept-Encoding'] = 'gzip'
+        for expected_hits in [0, 1]:
+            response = self.client.get(url, headers=headers)
+            self.assert200(response)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(response.get_data()).decode('utf-8')),
+                             json.loads(plain.get_data(as_text=True)))
+            self.assertEqual(compress.cache.hits, expected_hits)
+
+        # Streamed bundles are sent uncompressed
+        response = self.client.get(url_for('api_v1.patient_search', _count=100), headers=headers)
+        self.assert200(response)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_elements_renders_requested_elements(self):
+        self.create_seed_patients(number=3)
+        headers = self.get_api_headers()
+        response = self.client.get(url_for('api_v1.patient_search', _elements='birthDate,telecom'), headers=headers)
+        self.assert200(response)
+        resource = json.loads(response.get_data(as_text=True))['entry'][0]['resource']
+        self.assertIn('telecom', resource)
+        self.assertNotIn('name', resource)
+        self.assertNotIn('text', resource)
+
+        response = self.client.get(url_for('api_v1.patient_search', _elements='favoriteColor'), headers=headers)
+        self.assert400(response)
+        response = self.client.get(url_for('api_v1.patient_search', _summary='true', _elements='name'),
+                                   headers=headers)
+        self.assert400(response)
+
+    def test_search_cache_is_invalidated_by_commits(self):
+        try:
+            redis.ping()
+        except RedisError:
+            self.skipTest('Redis is not available')
+        self.app.config['USE_SEARCH_CACHE'] = True
+        patients = self.create_seed_patients(number=3)
+        headers = self.get_api_headers()
+        before = patient_search_cache.stats()
+
+        first = self.client.get(url_for('api_v1.patient_search', _count=5, family=patients[0].last_name),
+                                headers=headers)
+        again = self.client.get(url_for('api_v1.patient_search', family=patients[0].last_name, _count=5),
+                                headers=headers)
+        self.assert200(again)
+        self.assertEqual(first.headers['X-Search-Cache'], 'MISS')
+        self.assertEqual(again.headers['X-Search-Cache'], 'HIT')
+        self.assertEqual(first.get_data(), again.get_data())
+
+        # The validators are stored with the entry, so a conditional hit runs neither the search nor its validator
+        self.assertEqual(again.headers['ETag'], first.headers['ETag'])
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(url_for('api_v1.patient_search', _count=5, family=patients[0].last_name),
+                                       headers=dict(headers, **{'If-None-Match': first.headers['ETag']}))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any('FROM patient' in statement for statement in statements))
+
+        # A committed change to a related table bumps the Patient generation
+        patients[0].addresses.first().city = 'SPRINGFIELD'
+        db.session.commit()
+        after_write = self.client.get(url_for('api_v1.patient_search', _count=5, family=patients[0].last_name),
+                                      headers=headers)
+        self.assertEqual(after_write.headers['X-Search-Cache'], 'MISS')
+
+        stats = patient_search_cache.stats()
+        self.assertEqual(stats['hits'] - before['hits'], 2)
+        self.assertEqual(stats['misses'] - before['misses'], 2)
+        self.assertGreater(stats['generation'], before['generation'])
+
+    def test_stored_resource_is_used_until_a_source_row_changes(self):
+        self.app.config['USE_RESOURCE_STORE'] = True
+        pt = self.create_seed_patients(number=1)[0]
+        headers = self.get_api_headers()
+        with self.app.test_request_context():
+            self.assertEqual(PatientResource.rebuild(patient_ids=[pt.id]), 1)
+            self.assertEqual(PatientResource.rebuild(patient_ids=[pt.id]), 0)
+            self.assertEqual(PatientResource.load([pt])[pt.id], pt.build_fhir_dict())
+
+        response = self.client.get(url_for('api_v1.patient_read', id=pt.id), headers=headers)
+        self.assert200(response)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['id'], url_for('api_v1.patient_read', id=pt.id,
+                                                                                    _external=True))
+
+        # A committed change to a child row makes the stored resource stale until it is rebuilt
+        pt.addresses.first().city = 'SPRINGFIELD'
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertNotIn(pt.id, PatientResource.load([pt]))
+        response = self.client.get(url_for('api_v1.patient_read', id=pt.id), headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['address'][0]['city'], 'SPRINGFIELD')
+        with self.app.test_request_context():
+            self.assertEqual(PatientResource.rebuild(patient_ids=[pt.id]), 1)
+            self.assertIn(pt.id, PatientResource.load([pt]))
+
+    def test_repeated_reads_of_a_stale_patient_queue_one_rebuild(self):
+        from app import redis
+        from app.jobs import get_queue
+        pt = self.create_seed_patients(number=1)[0]
+        queue = get_queue()
+        redis.delete(PatientResource.queued_key(pt.id))
+        before = queue.count
+        self.app.config['USE_RESOURCE_STORE'] = True
+        try:
+            with self.app.test_request_context():
+                for _ in range(3):
+                    self.assertNotIn(pt.id, PatientResource.load([pt]))
+        finally:
+            self.app.config['USE_RESOURCE_STORE'] = False
+        self.assertEqual(queue.count - before, 1)
+
+    def test_conditional_read_is_answered_from_validators(self):
+        pt = self.create_seed_patients(number=1)[0]
+        headers = self.get_api_headers()
+        url = url_for('api_v1.patient_read', id=pt.id)
+        response = self.client.get(url, headers=headers)
+        self.assert200(response)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag.startswith('W/"'))
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        # Only the validator query ran, the patient was not serialized
+        self.assertFalse(any('address.address1' in statement for statement in statements))
+
+        response = self.client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers=dict(headers, **{'If-Match': 'W/"stale"'}))
+        self.assertEqual(response.status_code, 412)
+        # If-Match uses strong comparison:  only the exact ETag, W/ prefix included, meets the precondition
+        response = self.client.get(url, headers=dict(headers, **{'If-Match': etag}))
+        self.assert200(response)
+        response = self.client.get(url, headers=dict(headers, **{'If-Match': etag[2:]}))
+        self.assertEqual(response.status_code, 412)
+
+        # A change to a child row changes the validators
+        pt.addresses.first().city = 'SPRINGFIELD'
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assert200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_conditional_search_is_answered_from_validators(self):
+        patients = self.create_seed_patients(number=3)
+        headers = self.get_api_headers()
+        url = url_for('api_v1.patient_search', family=patients[0].last_name)
+        etag = self.client.get(url, headers=headers).headers['ETag']
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        patients[0].addresses.first().address2 = 'APT 2'
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assert200(response)
+
+    def test_costly_search_is_rejected_with_operation_outcome(self):
+        self.create_seed_patients(number=5)
+        self.app.config['SEARCH_MAX_PLAN_COST'] = {'default': None, 'Patient': 0.01}
+        response = self.client.get(url_for('api_v1.patient_search', **{'name:contains': 'a'}),
+                                   headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 422)
+        outcome = json.loads(response.get_data(as_text=True))
+        self.assertEqual(outcome['resourceType'], 'OperationOutcome')
+        self.assertEqual(outcome['issue'][0]['code'], 'too-costly')
+
+    def test_explain_requires_patient_admin(self):
+        self.create_seed_patients(number=5)
+        headers = self.get_api_headers()
+        response = self.client.get(url_for('api_v1.patient_search', family='a', _explain='true'), headers=headers)
+        self.assert403(response)
+
+        user = self.get_test_user()
+        user.role = Role.query.filter_by(name='Super Admin').first()
+        db.session.commit()
+        response = self.client.get(url_for('api_v1.patient_search', family='a', _explain='true'), headers=headers)
+        self.assert200(response)
+        explain = json.loads(response.get_data(as_text=True))
+        self.assertIn('last_name_key LIKE', explain['sql'])
+        self.assertIn('Plan', explain['plan'])
+        self.assertIsNotNone(explain['timing']['execution_ms'])
@@ -0,0 +1,61 @@
+import json
+from flask import url_for
+from tests.test_client_utils import BaseClientTestCase, CODESYSTEM, VALUESETS, load_codeset
+from app.models.fhir.codesets import terminology_cache
+
+
+class ValueSetOperationsTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(ValueSetOperationsTestCase, self).setUp()
+        for data in [CODESYSTEM] + VALUESETS:
+            load_codeset(data)
+
+    def tearDown(self):
+        terminology_cache.clear()
+        super(ValueSetOperationsTestCase, self).tearDown()
+
+    def get_json(self, endpoint, **kwargs):
+        response = self.client.get(url_for(endpoint, **kwargs), headers=self.get_api_headers())
+        return response, json.loads(response.get_data(as_text=True))
+
+    def test_expand(self):
+        response, data = self.get_json('api_v1.valueset_expand', resource_id='test-all-colors', count=2)
+        self.assert200(response)
+        self.assertEqual(data['expansion']['total'], 3)
+        self.assertEqual([c['code'] for c in data['expansion']['contains']], ['B', 'C'])
+
+        # The same expansion is served with the same identifier and ETag, and answers If-None-Match with 304
+        url = url_for('api_v1.valueset_expand', resource_id='test-all-colors', count=2)
+        again = self.client.get(url, headers=self.get_api_headers())
+        self.assertEqual(json.loads(again.get_data(as_text=True))['expansion']['identifier'],
+                         data['expansion']['identifier'])
+        self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+        headers = dict(self.get_api_headers(), **{'If-None-Match': response.headers['ETag']})
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 304)
+
+        response, data = self.get_json('api_v1.valueset_expand', resource_id='test-all-colors', offset=2)
+        self.assertEqual([c['code'] for c in data['expansion']['contains']], ['R'])
+
+        response, data = self.get_json('api_v1.valueset_expand', resource_id='test-all-colors', filter='cri')
+        self.assertEqual(data['expansion']['contains'],
+                         [{'system': CODESYSTEM['url'], 'code': 'C', 'display': 'Crimson'}])
+
+        response, data = self.get_json('api_v1.valueset_expand', resource_id='test-all-colors', count=-1)
+        self.assert400(response)
+        response, data = self.get_json('api_v1.valueset_expand', resource_id='missing')
+        self.assert404(response)
+
+    def test_validate_code(self):
+        def result(**kwargs):
+            response, data = self.get_json('api_v1.valueset_validate_code', resource_id='test-blue', **kwargs)
+            self.assert200(response)
+            return {p['name']: p.get('valueBoolean', p.get('valueString')) for p in data['parameter']}
+
+        self.assertEqual(result(code='B'), {'result': True, 'display': 'Blue'})
+        self.assertTrue(result(code='B', system=CODESYSTEM['url'], display='Blue')['result'])
+        self.assertFalse(result(code='B', display='Navy')['result'])
+        self.assertFalse(result(code='B', system='http://example.org/other')['result'])
+        self.assertFalse(result(code='R')['result'])
+        self.assert400(self.client.get(url_for('api_v1.valueset_validate_code', resource_id='test-blue'),
+                                       headers=self.get_api_headers()))
@@ -1,7 +1,12 @@
+import json
+import os
+from datetime import datetime
 from flask import url_for
 from flask_testing import TestCase
 from app import db, create_app as create_application
-from app.models import User, Role, AppPermission
+from app.models import User, Role, AppPermission, Patient
+from app.models.source_data import SourceData
+from app.models.fhir.codesets import process_fhir_codeset
 
 # Default user information for testing authentication
 user_dict = dict(email="JOHN.DOE@EXAMPLE.COM",
@@ -12,6 +17,46 @@ user_dict = dict(email="JOHN.DOE@EXAMPLE.COM",
                  confirmed=True)
 
 
+# Pipe delimited file of demographics used to seed patients for testing
+seed_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'demographic_seed.txt')
+
+
+def read_demographic_seed(number=10):
+    """Return the first 'number' rows of the demographic seed file as a list of dicts"""
+    rows = []
+    with open(seed_path) as f:
+        header = f.readline().strip().split('|')
+        for line in f:
+            if len(rows) >= number:
+                break
+            values = [v if v else None for v in line.rstrip('\n').split('|')]
+            rows.append(dict(zip(header, values)))
+    return rows
+
+
+# A small CodeSystem and ValueSets of colors used by the terminology tests
+CODESYSTEM = {'resourceType': 'CodeSystem', 'id': 'test-colors', 'url': 'http://example.org/CodeSystem/colors',
+              'status': 'active', 'content': 'complete',
+              'concept': [{'code': 'R', 'display': 'Red',
+                           'concept': [{'code': 'C', 'display': 'Crimson'}]},
+                          {'code': 'B', 'display': 'Blue'}]}
+
+VALUESETS = [{'resourceType': 'ValueSet', 'id': 'test-all-colors', 'url': 'http://example.org/ValueSet/all-colors',
+              'status': 'active', 'compose': {'include': [{'system': 'http://example.org/CodeSystem/colors'}]}},
+             {'resourceType': 'ValueSet', 'id': 'test-blue', 'url': 'http://example.org/ValueSet/blue',
+              'status': 'active',
+              'compose': {'include': [{'system': 'http://example.org/CodeSystem/colors', 'concept': [{'code': 'B'}]}]}}]
+
+
+def load_codeset(data):
+    """Load a JSON FHIR CodeSystem or ValueSet the way a posted resource is processed"""
+    route = '/{}'.format(data['resourceType'].lower())
+    sd = SourceData(route=route, payload=json.dumps(data), method='POST')
+    db.session.add(sd)
+    db.session.commit()
+    process_fhir_codeset(source_data=sd)
+
+
 # Common setup, teardown and utility methods to be re-used with each test module
 # Subclasses flask_testings TestCase, which is itself a subclass of unittest.TestCase
 class BaseClientTestCase(TestCase):
@@ -58,6 +103,38 @@ class BaseClientTestCase(TestCase):
     def get_test_user(self, username=user_dict.get("username")):
         return User.query.filter_by(_username=username.upper()).first()
 
+    def get_api_headers(self):
+        """Create the default test user if needed and return headers authenticated with its API token"""
+        user = self.get_test_user()
+        if not user:
+            self.create_test_user()
+            user = self.get_test_user()
+        token = user.generate_api_auth_token()
+        db.session.add(user)
+        db.session.commit()
+        return {'Authorization': 'Bearer {}'.format(token),
+                'Accept': 'application/fhir+json',
+                'Content-Type': 'application/fhir+json'}
+
+    def create_seed_patients(self, number=10):
+        """Persist 'number' patients from the demographic seed file and return them"""
+        patient_list = []
+        for d in read_demographic_seed(number=number):
+            pt = Patient(first_name=d.get('first_name'), last_name=d.get('last_name'),
+                         middle_name=d.get('middle_name'), suffix=d.get('suffix'), sex=d.get('sex'),
+                         dob=datetime.strptime(d.get('dob'), '%Y-%m-%d').date(), ssn=d.get('ssn'),
+                         race=d.get('race'), ethnicity=d.get('ethnicity'), email=d.get('email'),
+                         home_phone=d.get('home_phone'), mobile_phone=d.get('mobile_phone'),
+                         work_phone=d.get('work_phone'), preferred_language=d.get('preferred_language'),
+                         addresses=[{'address1': d.get('address1'), 'address2': d.get('address2'),
+                                     'city': d.get('city'), 'state': d.get('state'), 'zipcode': d.get('zipcode'),
+                                     'primary': True}])
+            pt.marital_status = d.get('marital_status')
+            patient_list.append(pt)
+        db.session.add_all(patient_list)
+        db.session.commit()
+        return patient_list
+
     # Improve the assertMessageFlashed method
     def assertMessageFlashed(self, message=None, category=None):
         """
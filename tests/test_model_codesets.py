@@ -0,0 +1,65 @@
+from tests.test_client_utils import BaseClientTestCase, CODESYSTEM, VALUESETS, load_codeset
+from app import db
+from app.models.fhir.codesets import CodeSystem, ConceptClosure, ValueSet, ValueSetExpansion, \
+    refresh_codesystem_concepts, terminology_cache
+
+
+class TerminologyCacheTestCase(BaseClientTestCase):
+
+    def setUp(self):
+        super(TerminologyCacheTestCase, self).setUp()
+        for data in [CODESYSTEM] + VALUESETS:
+            load_codeset(data)
+
+    def tearDown(self):
+        terminology_cache.clear()
+        super(TerminologyCacheTestCase, self).tearDown()
+
+    def test_concepts_are_looked_up_by_valueset_url_and_code(self):
+        concept = ValueSet.get_valueset_concept('http://example.org/ValueSet/all-colors', 'C')
+        self.assertEqual(concept.display, 'Crimson')
+        self.assertEqual(concept.system, 'http://example.org/CodeSystem/colors')
+        # Included concepts without a display are displayed as the CodeSystem defines them
+        self.assertEqual(ValueSet.get_valueset_concept('http://example.org/ValueSet/blue', 'B').display, 'Blue')
+        self.assertIsNone(ValueSet.get_valueset_concept('http://example.org/ValueSet/blue', 'R'))
+        self.assertIsNone(ValueSet.get_valueset_concept('http://example.org/ValueSet/missing', 'R'))
+
+    def test_expansions_and_cache_are_refreshed_when_codesets_change(self):
+        url = 'http://example.org/ValueSet/all-colors'
+        self.assertEqual(ValueSet.get_valueset_concept(url, 'R').display, 'Red')
+
+        # Committed in this process:  the ValueSets including the CodeSystem are expanded again
+        load_codeset(dict(CODESYSTEM, concept=[{'code': 'R', 'display': 'Scarlet'}]))
+        self.assertEqual(ValueSet.get_valueset_concept(url, 'R').display, 'Scarlet')
+        self.assertIsNone(ValueSet.get_valueset_concept(url, 'B'))
+        self.assertEqual(ValueSet.query.filter(ValueSet.url == url).one().code_set, {'R'})
+
+        # Committed by another process, found by the signature check
+        db.session.execute(ValueSetExpansion.__table__.update().values(display='Ruby'))
+        db.session.execute(ValueSet.__table__.update().values(expanded_at=None))
+        db.session.commit()
+        self.assertEqual(ValueSet.get_valueset_concept(url, 'R').display, 'Scarlet')
+        terminology_cache.checked_at = 0
+        self.assertEqual(ValueSet.get_valueset_concept(url, 'R').display, 'Ruby')
+
+    def test_codesystem_concepts_are_flattened_with_their_closure(self):
+        cs = CodeSystem.query.filter(CodeSystem.url == CODESYSTEM['url']).one()
+        self.assertEqual(cs.code_set, {'R', 'C', 'B'})
+        concept = cs.get_concept('C')
+        self.assertEqual((concept.display, concept.parent_code), ('Crimson', 'R'))
+        self.assertIsNone(cs.get_concept('X'))
+        closure = db.session.query(ConceptClosure.ancestor_code, ConceptClosure.descendant_code,
+                                   ConceptClosure.depth).filter(ConceptClosure.codesystem_id == cs.id).all()
+        self.assertEqual(sorted(closure), [('B', 'B', 0), ('C', 'C', 0), ('R', 'C', 1), ('R', 'R', 0)])
+
+    def test_closure_merges_every_occurrence_of_a_polyhierarchy(self):
+        cs = CodeSystem.query.filter(CodeSystem.url == CODESYSTEM['url']).one()
+        # P is nested under R and B, and its child is only listed under R.  The concept without a code is skipped.
+        cs.data = dict(CODESYSTEM, concept=[{'code': 'R', 'concept': [{'code': 'P', 'concept': [{'code': 'M'}]}]},
+                                            {'code': 'B', 'concept': [{'code': 'P'}, {'display': 'No code'}]}])
+        self.assertEqual(refresh_codesystem_concepts(cs), 4)
+        closure = db.session.query(ConceptClosure.ancestor_code, ConceptClosure.descendant_code,
+                                   ConceptClosure.depth).filter(ConceptClosure.codesystem_id == cs.id).all()
+        self.assertEqual(sorted(closure), [('B', 'B', 0), ('B', 'M', 2), ('B', 'P', 1), ('M', 'M', 0),
+                                           ('P', 'M', 1), ('P', 'P', 0), ('R', 'M', 2), ('R', 'P', 1),
+                                           ('R', 'R', 0)])
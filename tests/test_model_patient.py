@@ -0,0 +1,60 @@
+import hashlib
+import json
+from datetime import date
+from tests.test_client_utils import BaseClientTestCase
+from app.models import Patient
+from app.utils.general import json_serial
+from app.utils.json_backend import BACKENDS, dumps, get_backend, hash_data
+from app import db
+
+
+class PatientSerializerTestCase(BaseClientTestCase):
+
+    def test_dict_serializer_matches_fhirclient(self):
+        patients = self.create_seed_patients(number=25)
+        patients[0].deceased = True
+        patients[0].deceased_date = date(2017, 3, 4)
+        patients[1].active = False
+        patients[2].addresses.first().end_date = date(2017, 5, 6)
+        db.session.commit()
+
+        with self.app.test_request_context():
+            for pt in Patient.query.order_by(Patient.id).all():
+                self.assertEqual(pt.build_fhir_dict(), pt.build_fhir_object().as_json())
+                self.assertEqual(pt.build_fhir_dict(include_narrative=False),
+                                 pt.build_fhir_object(include_narrative=False).as_json())
+                for elements in [Patient.fhir_summary_elements, ['telecom', 'address'], []]:
+                    self.assertEqual(pt.build_fhir_dict(elements=elements),
+                                     pt.build_fhir_object(elements=elements).as_json())
+
+    def test_fhirclient_serializer_can_be_configured(self):
+        pt = self.create_seed_patients(number=1)[0]
+        with self.app.test_request_context():
+            data = pt.dump_fhir_json()
+            self.app.config['FHIR_SERIALIZER'] = 'fhirclient'
+            try:
+                self.assertEqual(pt.dump_fhir_json(), data)
+            finally:
+                self.app.config['FHIR_SERIALIZER'] = 'dict'
+
+    def test_json_backends_encode_identical_documents(self):
+        pt = self.create_seed_patients(number=1)[0]
+        with self.app.test_request_context():
+            resource = pt.build_fhir_dict()
+            for backend in BACKENDS:
+                self.assertEqual(json.loads(dumps(resource, backend=backend)), resource)
+                self.assertEqual(json.loads(dumps(resource, pretty=True, sort_keys=True, backend=backend)), resource)
+
+    def test_row_hash_is_unchanged_by_json_backend(self):
+        data = {'dob': date(1980, 2, 3), 'first_name': 'Zoë', 'active': True, 'suffix': None}
+        legacy = hashlib.sha1(json.dumps(data, sort_keys=True, default=json_serial).encode('utf-8')).hexdigest()
+        for backend in ['orjson', 'ujson', 'json']:
+            with self.subTest(backend=backend):
+                if backend not in BACKENDS:
+                    self.skipTest('{} is not installed'.format(backend))
+                self.app.config['JSON_BACKEND'] = backend
+                try:
+                    self.assertEqual(get_backend(), backend)
+                    self.assertEqual(hash_data(data), legacy)
+                finally:
+                    self.app.config['JSON_BACKEND'] = 'auto'
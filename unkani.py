@@ -186,3 +186,206 @@ def patients():
         t2 = time.clock()
         print("{} total patients created in {} seconds".format(patient_create_number, str(round(t2 - t1, 3))))
         print("Patient create time was {} seconds".format(round((t2 - t1) / patient_create_number, 3)))
+
+
+@app.cli.command()
+@click.option('--iterations', default=1000, help='Number of searches to time for each query string')
+def search_benchmark(iterations):
+    """Micro-benchmark of FHIR search parsing and query building for the Patient endpoint.  Compares compiling a
+    search plan on every request (the behaviour before plans were cached) with binding values to a cached plan.
+    No queries are executed."""
+    from werkzeug.datastructures import MultiDict
+    from app.api_v1.utils.search import SearchSupport
+    from app.api_v1.resources.Patient import patient_model_support, patient_search_support
+
+    searches = [[('family', 'Smi'), ('given', 'Jo'), ('_sort', '-birthdate')],
+                [('birthdate', 'ge1980-01-01'), ('active', 'true'), ('gender:exact', 'male')],
+                [('name:contains', 'ann'), ('address-city', 'Bos'), ('_lastUpdated', 'lt2017-01-01')],
+                [('identifier', 'http://hl7.org/fhir/sid/us-ssn|123-45-6789')]]
+
+    print("Timing {} iterations per search, values are microseconds per request".format(iterations))
+    print("{:<90}{:>12}{:>12}".format('Search', 'Uncached', 'Cached'))
+    for search in searches:
+        args = MultiDict(search)
+        with app.test_request_context():
+            t1 = time.perf_counter()
+            for _ in range(iterations):
+                support = SearchSupport(base=Patient, model_support=patient_model_support, cache_size=0)
+                support.search(args=args, query=Patient.query)
+            t2 = time.perf_counter()
+            patient_search_support.plans.clear()
+            for _ in range(iterations):
+                patient_search_support.search(args=args, query=Patient.query)
+            t3 = time.perf_counter()
+        label = '&'.join('{}={}'.format(k, v) for k, v in search)
+        print("{:<90}{:>12}{:>12}".format(label, round((t2 - t1) / iterations * 1e6, 1),
+                                          round((t3 - t2) / iterations * 1e6, 1)))
+    print("Plan cache: {}".format(patient_search_support.plans.stats))
+
+
+@app.cli.command()
+@click.option('--number', default=100, help='Number of existing patients to serialize')
+@click.option('--iterations', default=10, help='Number of times each patient is serialized')
+def serialization_benchmark(number, iterations):
+    """Micro-benchmark of FHIR Patient serialization.  Compares the fhirclient object graph and its validating
+    as_json() with the dict serializer, on patients already in the database.  Related rows are prefetched up front,
+    so no queries are timed."""
+    patients = Patient.query.order_by(Patient.id).limit(number).all()
+    if not patients:
+        print("No patients found, create some with 'flask patients'")
+        return
+
+    serializers = [('fhirclient', lambda pt, narrative: pt.build_fhir_object(include_narrative=narrative).as_json()),
+                   ('dict', lambda pt, narrative: pt.build_fhir_dict(include_narrative=narrative))]
+    print("Serializing {} patients {} times, values are microseconds per resource".format(len(patients), iterations))
+    print("{:<20}{:>16}{:>16}".format('Serializer', 'Narrative', 'No narrative'))
+    with app.test_request_context():
+        Patient.prefetch_fhir(patients)
+        for label, serialize in serializers:
+            timings = []
+            for narrative in [True, False]:
+                t1 = time.perf_counter()
+                for _ in range(iterations):
+                    for pt in patients:
+                        serialize(pt, narrative)
+                t2 = time.perf_counter()
+                timings.append(round((t2 - t1) / (iterations * len(patients)) * 1e6, 1))
+            print("{:<20}{:>16}{:>16}".format(label, *timings))
+
+
+@app.cli.command()
+@click.option('--number', default=100, help='Number of existing patients to encode')
+@click.option('--iterations', default=10, help='Number of times each document is encoded')
+def json_benchmark(number, iterations):
+    """Micro-benchmark of the installed JSON encoders on Patient read payloads and a searchset bundle of the same
+    patients.  Resources are rendered up front, so only encoding is timed."""
+    from app.utils.json_backend import BACKENDS, dumpb
+    patients = Patient.query.order_by(Patient.id).limit(number).all()
+    if not patients:
+        print("No patients found, create some with 'flask patients'")
+        return
+
+    with app.test_request_context():
+        Patient.prefetch_fhir(patients)
+        resources = [pt.build_fhir_dict() for pt in patients]
+    bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'total': len(resources),
+              'entry': [{'fullUrl': r['id'], 'resource': r, 'search': {'mode': 'match', 'score': 1}}
+                        for r in resources]}
+    print("Encoding {} patients {} times, values are microseconds per resource".format(len(patients), iterations))
+    print("{:<20}{:>16}{:>16}{:>16}".format('Backend', 'Read', 'Bundle', 'Bundle bytes'))
+    for backend in BACKENDS:
+        t1 = time.perf_counter()
+        for _ in range(iterations):
+            for resource in resources:
+                dumpb(resource, sort_keys=True, backend=backend)
+        t2 = time.perf_counter()
+        for _ in range(iterations):
+            body = dumpb(bundle, sort_keys=True, backend=backend)
+        t3 = time.perf_counter()
+        per_resource = float(iterations * len(resources)) / 1e6
+        print("{:<20}{:>16}{:>16}{:>16}".format(backend, round((t2 - t1) / per_resource, 1),
+                                               round((t3 - t2) / per_resource, 1), len(body)))
+
+
+@app.cli.command()
+@click.option('--batch-size', default=500, help='Number of patients rendered per batch')
+@click.option('--workers', default=4, help='Number of processes rendering batches in parallel')
+@click.option('--queue/--no-queue', default=False, help='Queue the batches as rq jobs instead of running them')
+def rebuild_resources(batch_size, workers, queue):
+    """Rebuild the materialized Patient resource store.  Only patients whose source rows changed since their
+    resource was stored are re-rendered."""
+    from concurrent.futures import ProcessPoolExecutor
+    from app.jobs import get_queue, rebuild_patient_resources
+
+    ids = [row[0] for row in db.session.query(Patient.id).order_by(Patient.id).all()]
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    if queue:
+        for batch in batches:
+            get_queue().enqueue(rebuild_patient_resources, batch)
+        print("{} batches of up to {} patients were queued".format(len(batches), batch_size))
+        return
+
+    t1 = time.perf_counter()
+    # Worker processes must open their own database connections
+    db.session.remove()
+    db.engine.dispose()
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count in executor.map(rebuild_patient_resources, batches):
+            written += count
+            print(written, end='...', flush=True)
+    t2 = time.perf_counter()
+    print()
+    print("{} of {} patient resources rebuilt in {} seconds".format(written, len(ids), round(t2 - t1, 3)))
+
+
+@app.cli.command()
+@click.option('--batch-size', default=1000, help='Number of rows updated per transaction')
+def backfill_search_keys(batch_size):
+    """Populate the folded search key columns of existing Patient and Address rows, in batches.  Rows are updated
+    directly on the table, so updated_at, row_hash and version history are left untouched."""
+    from sqlalchemy import bindparam
+    from app.utils.general import fold_search_key
+
+    for model in [Patient, Address]:
+        table = model.__table__
+        columns = list(model.search_keys.keys())
+        statement = table.update().where(table.c.id == bindparam('b_id')).values(
+            {key_column: bindparam('b_' + key_column) for key_column in model.search_keys.values()})
+        last_id = 0
+        total = 0
+        while True:
+            rows = db.session.query(model.id, *[getattr(model, column) for column in columns]) \
+                .filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            params = []
+            for row in rows:
+                p = {'b_id': row[0]}
+                for column, value in zip(columns, row[1:]):
+                    p['b_' + model.search_keys[column]] = fold_search_key(value)
+                params.append(p)
+            db.session.execute(statement, params)
+            db.session.commit()
+            last_id = rows[-1][0]
+            total += len(rows)
+            print("{} {} rows backfilled...".format(total, table.name), flush=True)
+        print("Search keys backfilled for {} {} rows".format(total, table.name))
+
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=None, type=int, help='Number of patients loaded per transaction')
+def import_patients(path, batch_size):
+    """Bulk load an NDJSON file of FHIR Patient resources, one resource per line.  Resources whose unkani
+    identifier already exists are skipped, and lines that can not be loaded are reported."""
+    from app.api_v1.utils.bulk_import import PatientImport
+
+    t1 = time.perf_counter()
+    with open(path, 'rb') as f:
+        patient_import = PatientImport(batch_size=batch_size).run(f)
+    t2 = time.perf_counter()
+    for error in patient_import.errors:
+        print("Line {}: {}".format(error['line'], error['message']))
+    print("{} patients read: {} imported, {} skipped, {} rejected".format(
+        patient_import.read, patient_import.imported, patient_import.skipped, patient_import.rejected))
+    print("Imported in {} seconds ({} patients per second)".format(
+        round(t2 - t1, 3), round(patient_import.read / (t2 - t1)) if t2 > t1 else patient_import.read))
+
+
+@app.cli.command()
+def refresh_expansions():
+    """Rebuild the concept index of every CodeSystem and the materialized expansion of every ValueSet from the stored
+    CodeSystems and ValueSets."""
+    from app.models.fhir.codesets import refresh_codesystem_concepts, refresh_valueset_expansions
+
+    t1 = time.perf_counter()
+    concepts = 0
+    for cs in CodeSystem.query.order_by(CodeSystem.id).all():
+        concepts += refresh_codesystem_concepts(cs)
+    urls = [row[0] for row in db.session.query(ValueSet.url).all()]
+    refreshed = refresh_valueset_expansions(valueset_urls=urls)
+    db.session.commit()
+    t2 = time.perf_counter()
+    print("{} CodeSystem concepts were indexed and {} ValueSet expansions were rebuilt in {} seconds".format(
+        concepts, refreshed, round(t2 - t1, 3)))